@@ -19,6 +19,16 @@ LOG = logging.getLogger('alerta.plugins.opendxl')
 DXL_CLIENT_CONFIG_FILE = os.environ.get('DXL_CLIENT_CONFIG_FILE') or app.config.get('DXL_CLIENT_CONFIG_FILE')
 DXL_PUB_TOPIC = os.environ.get('DXL_PUB_TOPIC') or app.config.get('DXL_PUB_TOPIC')
 
+# The plugin runs on Python 3 within Alerta and can't use the robobluekit codec, prefer orjson when it is available
+try:
+    import orjson
+
+    def encode(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def encode(obj: Any) -> str:
+        return json.dumps(obj)
+
 
 class OpenDxlPublisher(PluginBase):
 
@@ -42,7 +52,7 @@ class OpenDxlPublisher(PluginBase):
     def post_receive(self, alert: 'Alert') -> Optional['Alert']:
         try:
             event = Event(DXL_PUB_TOPIC)
-            event.payload = json.dumps(alert.get_body(history=False))
+            event.payload = encode(alert.get_body(history=False))
             LOG.info('broadcasting alert %s', alert.id)
             self.dxl_client.send_event(event)
         except BaseException as e:
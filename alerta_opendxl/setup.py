@@ -27,7 +27,9 @@ REQUIRED = [
 ]
 
 # What packages are optional?
-EXTRAS = {}
+EXTRAS = {
+    'orjson': ['orjson']
+}
 
 CLASSIFIERS = [
     # Trove classifiers
@@ -1,6 +1,4 @@
 from .application import GRRApplication
 
 app = GRRApplication()
-app.bootstrap()
-app.run()
-app.destroy()
+app.main()
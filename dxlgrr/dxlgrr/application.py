@@ -4,9 +4,10 @@ import os.path as path
 from dxlclient.client_config import DxlClientConfig
 
 from robobluekit import Application
-from robobluekit.monitor import MonitoringContext
+from robobluekit.monitor import Registrations
 from robobluekit.kit import InvalidConfigException
 from robobluekit.dxl import MonitorableDxlClient, DxlClientMonitor
+from robobluekit.reload import ConfigSnapshot
 
 from .config import GRRConfig
 from .switchboard import SwitchBoard
@@ -23,6 +24,9 @@ class GRRApplication(Application):
         self.switch = None
         self.dxl_config = None
         self.svc_config = None
+        self.__dxl_snapshot = None
+        self.__svc_snapshot = None
+        self.__registrations = None
         Application.__init__(self)
 
     @staticmethod
@@ -56,14 +60,17 @@ class GRRApplication(Application):
 
     def load_configuration(self):
         logger.debug('loading dxl client configuration from %s', path.abspath(self.args.dxl_config))
+        self.__dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
         self.dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
 
         logger.debug('loading service configuration from %s', path.abspath(self.args.service_config))
+        self.__svc_snapshot = ConfigSnapshot(self.args.service_config)
         self.svc_config = GRRConfig(self.args.service_config)
 
     def initialize(self):
+        self.__registrations = Registrations(self.monitoring_context)
         self.switch = GRRApplication.make_switchboard(self.dxl_config, self.svc_config,
-                                                      self.monitoring_context.register)
+                                                      self.__registrations.register)
         self.switch.initialize()
 
     def reload(self):
@@ -71,6 +78,8 @@ class GRRApplication(Application):
         logger.info('dxlgrr configuration loading from: {}'.format(path.abspath(self.args.service_config)))
 
         try:
+            new_dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
+            new_svc_snapshot = ConfigSnapshot(self.args.service_config)
             new_dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
             new_svc_config = GRRConfig(self.args.service_config)
         except InvalidConfigException as e:
@@ -80,25 +89,59 @@ class GRRApplication(Application):
             logger.error('failed config reload: invalid DXL client configuration')
             logger.error('dxlclient configuration error: ' + str(e))
         else:
+            dxl_changes = new_dxl_snapshot.changes(self.__dxl_snapshot)
+            svc_changes = new_svc_snapshot.changes(self.__svc_snapshot)
+            if not dxl_changes and not svc_changes:
+                logger.info('dxlclient and dxlgrr configuration unchanged, nothing to reload')
+                return
             try:
-                logger.info('began swapping out the running dxlgrr service')
-                new_monitoring_context = MonitoringContext()
-
-                new_svc = GRRApplication.make_switchboard(new_dxl_config, new_svc_config,
-                                                          new_monitoring_context.register)
-
-                new_svc.initialize()
-                self.switch.destroy()
-
+                # Monitors of the same name carry over to the replacement
+                new_registrations = Registrations(self.monitoring_context)
+                if dxl_changes:
+                    logger.info('began swapping out the running dxlgrr service')
+                    new_svc = GRRApplication.make_switchboard(new_dxl_config, new_svc_config,
+                                                              new_registrations.register)
+
+                    new_svc.initialize()
+                    # The replaced service responds to the requests in flight before disconnecting
+                    drain = self.start_drain('reload')
+                    self.switch.drain(drain)
+                    drain.finish()
+                    self.switch.destroy()
+                else:
+                    logger.info('began re-registering the dxlgrr service over the running connection')
+                    # The connection monitor stays with the running client
+                    new_registrations.register(DxlClientMonitor('connection'))
+                    # The connector to GRR is kept unless its configuration changed
+                    new_svc = SwitchBoard(new_svc_config, self.switch.dxlc, new_registrations.register,
+                                          None if 'GRR' in svc_changes else self.switch.grr)
+
+                    # Services registered on one client share its subscriptions and callback, unregistering
+                    # either drops them for both. The running service is unregistered first, its endpoints
+                    # going unanswered until the replacement registers, and registered again should the
+                    # replacement fail to
+                    self.switch.unregister()
+                    try:
+                        new_svc.register()
+                    except BaseException:
+                        self.switch.register()
+                        raise
+
+                self.__registrations.release(new_registrations)
+                self.__registrations = new_registrations
                 self.switch = new_svc
                 self.dxl_config = new_dxl_config
                 self.svc_config = new_svc_config
-                self.monitoring_context = new_monitoring_context
+                self.__dxl_snapshot = new_dxl_snapshot
+                self.__svc_snapshot = new_svc_snapshot
 
             except BaseException as e:
                 logger.error('failed to swap out dxlgrr with reloaded configuration: {}'.format(e.message))
             else:
                 logger.info('reloaded dxlgrr with new configuration')
 
+    def drain(self, drain):
+        self.switch.drain(drain)
+
     def destroy(self):
         self.switch.destroy()
@@ -35,15 +35,28 @@ class Dispatcher(RequestCallback):
 
     def on_request(self, request):
         # type: (Request) -> None
-        self.__monitor.register_request()
+        in_flight = self.__board.dxlc.in_flight
+        in_flight.enter()
+        received = self.__monitor.register_request()
+        if not self.__monitor.submit(in_flight.run, self.__dispatch, request, received):
+            # Shed the load rather than queue up requests the endpoint can't get to in time
+            self.__monitor.register_error(received)
+            in_flight.run(self.__board.dxlc.send_response,
+                          ErrorResponse(request, 503, 'service endpoint overloaded, try again later'))
+
+    def __dispatch(self, request, received):
+        trace = self.__monitor.trace()
         response = Response(request)
         try:
             args = None
             if self.__args is not None:  # If input's expected, try parsing the incoming JSON
-                args = json_format.Parse(request.payload, self.__args())
-            grrr = self.__board.grr.SendRequest(self.__endpoint.name, args=args)
+                with trace.span('parse'):
+                    args = json_format.Parse(request.payload, self.__args())
+            with trace.span('upstream'):
+                grrr = self.__board.grr.SendRequest(self.__endpoint.name, args=args)
             if grrr is not None:
-                response.payload = json_format.MessageToJson(grrr)
+                with trace.span('serialize'):
+                    response.payload = json_format.MessageToJson(grrr)
         except (json_format.ParseError, BuildError, grr_errors.Error) as e:
             # Failed to compose request or otherwise bad request
             response = ErrorResponse(request, 400, 'invalid request: {}'.format(str(e)))
@@ -54,12 +67,15 @@ class Dispatcher(RequestCallback):
             logger.exception('%s: %s', type(e).__name__, str(e))
             response = ErrorResponse(request, 500, 'failed processing request: {}'.format(str(e)))
         finally:
-            if isinstance(response, ErrorResponse) and response.error_code >= 500:
+            error = isinstance(response, ErrorResponse) and response.error_code >= 500
+            if error:
                 # Error count doesn't include client errors
-                self.__monitor.register_error()
+                self.__monitor.register_error(received)
             else:
-                self.__monitor.register_success()
-            self.__board.dxlc.send_response(response)
+                self.__monitor.register_success(received)
+            with trace.span('send'):
+                self.__board.dxlc.send_response(response)
+            trace.finish(error)
 
 
 class SwitchBoard:
@@ -67,12 +83,16 @@ class SwitchBoard:
     Switchboard handles the Dispatchers responsible for wrapping the various HTTP endpoints
     """
 
-    def __init__(self, config, dxl_conn, register_monitor):
+    def __init__(self, config, dxl_conn, register_monitor, grr=None):
+        """
+        :param grr: Connector to the GRR API to reuse, a new one is created when omitted
+        """
         self.dxlc = dxl_conn
         self.__config = config
-        self.grr = HttpConnector(api_endpoint=config.http_endpoint, auth=config.auth)
+        self.grr = grr if grr is not None else HttpConnector(api_endpoint=config.http_endpoint, auth=config.auth)
         self.__endpoints = None
         self.__register_monitor = register_monitor
+        self.__svc = None
 
     def __register_service(self):
         """
@@ -87,6 +107,7 @@ class SwitchBoard:
                           Dispatcher(endpoint, self,
                                      self.__register_monitor(ServiceEndpointMonitor('endpoints.' + topic))))
         self.dxlc.register_service_sync(svc, 5)
+        self.__svc = svc
 
     def __load_endpoints(self):
         """
@@ -102,8 +123,33 @@ class SwitchBoard:
 
     def initialize(self):
         self.dxlc.connect()
+        self.register()
+
+    def register(self):
+        """
+        Register the service with the OpenDXL service fabric over the already connected client
+        :return: None
+        """
         self.__load_endpoints()
         self.__register_service()
 
+    def unregister(self):
+        """
+        Unregister the service, leaving the client connected for a replacing switchboard
+        :return: None
+        """
+        if self.__svc is not None:
+            self.dxlc.unregister_service_sync(self.__svc, 5)
+            self.__svc = None
+
+    def drain(self, drain):
+        """
+        Unregister the service and wait for the requests in flight to be responded to, leaving the client connected
+        :param drain: robobluekit Drain bounding the wait
+        :return: None
+        """
+        self.unregister()
+        drain.wait(lambda: self.dxlc.in_flight.count, 'callbacks')
+
     def destroy(self):
         self.dxlc.disconnect()
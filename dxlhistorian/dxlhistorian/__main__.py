@@ -2,6 +2,4 @@ from .application import HistorianApplication
 
 app = HistorianApplication()
 
-app.bootstrap()
-app.run()
-app.destroy()
+app.main()
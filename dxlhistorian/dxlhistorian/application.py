@@ -6,14 +6,19 @@ from dxlclient.client_config import DxlClientConfig
 from robobluekit import Application
 from robobluekit.dxl import MonitorableDxlClient, DxlClientMonitor
 from robobluekit.kit import InvalidConfigException
-from robobluekit.monitor import MonitoringContext
+from robobluekit.monitor import Registrations
+from robobluekit.reload import ConfigSnapshot
 
 from .config import HistorianConfig
 from .historian import Historian
 from .recorder import initialize_recorder, RecorderMonitor
+from .service import QueryService
 
 logger = logging.getLogger(__name__)
 
+# Sections of the historian configuration that are swapped in place on reload, without replacing the recorders
+FILTER_SECTIONS = {'Rules', 'Deduplication'}
+
 
 class HistorianApplication(Application):
     """
@@ -21,11 +26,17 @@ class HistorianApplication(Application):
 
     """
 
+    # Every worker would receive and record every event
+    WORKERS_SUPPORTED = False
+
     def __init__(self):
         Application.__init__(self)
         self.__dxl_config = None
         self.__historian_config = None
         self.__historian = None
+        self.__dxl_snapshot = None
+        self.__historian_snapshot = None
+        self.__registrations = None
 
     def register_arguments(self):
         logger.debug('registering CLI arguments')
@@ -59,22 +70,51 @@ class HistorianApplication(Application):
         # Client's responsible for connecting to the mesh
         dxl_client = MonitorableDxlClient(dxl_config, register_monitor(DxlClientMonitor('connection')))
 
-        # The recorder performs actions on the received Events
-        recorder_type, recorder_conf = historian_config.recorder_config
-        recorder = initialize_recorder(recorder_type, recorder_conf,
-                                       register_monitor(RecorderMonitor('recorder.{}'.format(recorder_type))))
+        return HistorianApplication.build_historian(dxl_client, historian_config, register_monitor)
+
+    @staticmethod
+    def build_historian(dxl_client, historian_config, register_monitor, deduplicator=None, recorders=None):
+        """
+        Static helper function to put together a new Historian instance on top of the given client
 
-        return Historian(historian_config, dxl_client, recorder, register_monitor)
+        :param dxl_client: Client connecting the Historian to the fabric
+        :param historian_config: Service specific configuration
+        :param register_monitor: function for registering monitors with the monitoring context
+        :param deduplicator: Deduplicator to carry over from a replaced Historian
+        :param recorders: dictionary of recorder type to Recorder carried over from a replaced Historian
+        :return: The prepared Historian instance
+        """
+
+        # The recorders perform actions on the received Events, every event is fanned out to all of them
+        kept = recorders or {}
+        recorders = []
+        for recorder_type, recorder_conf in historian_config.recorder_configs:
+            monitor = register_monitor(RecorderMonitor('recorder.{}'.format(recorder_type)))
+            if recorder_type in kept:
+                recorder = kept[recorder_type]
+            else:
+                recorder = initialize_recorder(recorder_type, recorder_conf, monitor)
+            recorders.append((recorder, monitor, historian_config.backpressure_of(recorder_type)))
+
+        # The query service answers questions about the recorded events
+        service = None
+        if historian_config.query_service_config is not None:
+            service = QueryService(historian_config.query_service_config, dxl_client, register_monitor)
+
+        return Historian(historian_config, dxl_client, recorders, register_monitor, service, deduplicator)
 
     def load_configuration(self):
         logger.debug('loading dxl client configuration from %s', path.abspath(self.args.dxl_config))
+        self.__dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
         self.__dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
         logger.debug('loading historian configuration from %s', path.abspath(self.args.service_config))
+        self.__historian_snapshot = ConfigSnapshot(self.args.service_config)
         self.__historian_config = HistorianConfig(self.args.service_config)
 
     def initialize(self):
+        self.__registrations = Registrations(self.monitoring_context)
         self.__historian = HistorianApplication.initialize_historian(
-            self.__dxl_config, self.__historian_config, self.monitoring_context.register
+            self.__dxl_config, self.__historian_config, self.__registrations.register
         )
         self.__historian.start()
 
@@ -84,6 +124,8 @@ class HistorianApplication(Application):
         logger.info('dxlhistorian configuration loading from: {}'.format(path.abspath(self.args.service_config)))
 
         try:
+            new_dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
+            new_svc_snapshot = ConfigSnapshot(self.args.service_config)
             new_dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
             new_svc_config = HistorianConfig(self.args.service_config)
         except InvalidConfigException as e:
@@ -93,25 +135,94 @@ class HistorianApplication(Application):
             logger.error('failed config reload: invalid DXL client configuration')
             logger.error('dxlclient configuration error: {}'.format(e.message))
         else:
+            dxl_changes = new_dxl_snapshot.changes(self.__dxl_snapshot)
+            svc_changes = new_svc_snapshot.changes(self.__historian_snapshot)
+            if not dxl_changes and not svc_changes:
+                logger.info('dxlclient and dxlhistorian configuration unchanged, nothing to reload')
+                return
             try:
-                logger.info('began swapping out the running dxlhistorian')
-                new_monitoring_context = MonitoringContext()
-                new_historian = HistorianApplication.initialize_historian(
-                    new_dxl_config, new_svc_config, new_monitoring_context.register
-                )
-
-                new_historian.start()
-                self.__historian.stop()
+                # The message ids remembered carry over unless the deduplication configuration changed
+                deduplicator = self.__historian.deduplicator if 'Deduplication' not in svc_changes else None
+                if not dxl_changes and svc_changes <= FILTER_SECTIONS:
+                    logger.info('began swapping the filtering of the running dxlhistorian')
+                    self.__historian.refilter(new_svc_config, self.__registrations.register, deduplicator is not None)
+                else:
+                    # Monitors of the same name carry over to the replacement
+                    new_registrations = Registrations(self.monitoring_context)
+                    if dxl_changes:
+                        logger.info('began swapping out the running dxlhistorian')
+                        dxl_client = MonitorableDxlClient(
+                            new_dxl_config, new_registrations.register(DxlClientMonitor('connection'))
+                        )
+                        keep = ()
+                    else:
+                        logger.info('began swapping out the running dxlhistorian over the running connection')
+                        # The connection monitor stays with the running client
+                        new_registrations.register(DxlClientMonitor('connection'))
+                        dxl_client = self.__historian.dxl
+                        # The client stays subscribed to the topics the replacement records
+                        keep = set(new_svc_config.subscribe_to)
+
+                    # Recorders of unchanged configuration carry over along with their spools and archives
+                    recorders = self.__carried_over_recorders(new_svc_config, svc_changes)
+                    reopened = [recorder_type for recorder_type, _ in new_svc_config.recorder_configs
+                                if recorder_type in self.__recorder_types() and recorder_type not in recorders]
+                    if reopened:
+                        # The replacements would write to the same directories, the events received until they are
+                        # opened aren't recorded
+                        logger.info('closing recorders %s before reopening them', ', '.join(reopened))
+                        self.__drain_historian(keep, recorders.values())
+                        new_historian = HistorianApplication.build_historian(
+                            dxl_client, new_svc_config, new_registrations.register, deduplicator, recorders
+                        )
+                        new_historian.start(connect=bool(dxl_changes))
+                    else:
+                        new_historian = HistorianApplication.build_historian(
+                            dxl_client, new_svc_config, new_registrations.register, deduplicator, recorders
+                        )
+                        # Subscribed before the replaced historian removes its callbacks for no events to be missed
+                        new_historian.start(connect=bool(dxl_changes),
+                                            replacing=self.__historian if not dxl_changes else None)
+                        self.__drain_historian(keep, recorders.values())
+                    self.__historian.stop(disconnect=bool(dxl_changes))
+
+                    self.__registrations.release(new_registrations)
+                    self.__registrations = new_registrations
+                    self.__historian = new_historian
 
-                self.__historian = new_historian
                 self.__dxl_config = new_dxl_config
                 self.__historian_config = new_svc_config
-                self.monitoring_context = new_monitoring_context
+                self.__dxl_snapshot = new_dxl_snapshot
+                self.__historian_snapshot = new_svc_snapshot
 
             except BaseException as e:
                 logger.error('failed to swap out dxlhistorian with reloaded configuration: {}'.format(e.message))
             else:
                 logger.info('reloaded dxlhistorian with new configuration')
 
+    def __recorder_types(self):
+        return [recorder_type for recorder_type, _ in self.__historian_config.recorder_configs]
+
+    def __carried_over_recorders(self, config, changes):
+        """
+        Recorders of the running historian whose configuration section is the same in the reloaded configuration
+        :return: dictionary of recorder type to Recorder
+        """
+        types = set(recorder_type for recorder_type, _ in config.recorder_configs)
+        return dict(
+            (recorder_type, recorder)
+            for recorder_type, recorder in zip(self.__recorder_types(), self.__historian.recorders)
+            if recorder_type in types and recorder_type not in changes
+        )
+
+    def __drain_historian(self, keep=(), keep_recorders=()):
+        # The replaced historian records the events it has queued and flushes its recorders within the deadline
+        drain = self.start_drain('reload')
+        self.__historian.drain(drain, keep, keep_recorders)
+        drain.finish()
+
+    def drain(self, drain):
+        self.__historian.drain(drain)
+
     def destroy(self):
         self.__historian.stop()
@@ -0,0 +1,171 @@
+"""
+Compressed, append-only archive of recorded events.
+
+An archive is a directory of segments. Each segment is a gzip file made up of independently compressed blocks (gzip
+members) of JSON Lines records, accompanied by a sparse index file holding a JSON line per block with the block's
+offset, length, time range and topics. Reading a time range or topic only decompresses the blocks that may contain
+matching records.
+
+Usage: python -m dxlhistorian.archive [--start UNIX_TIMESTAMP] [--end UNIX_TIMESTAMP] [--topic TOPIC] DIRECTORY
+"""
+import argparse
+import glob
+import logging
+import os
+import os.path as path
+import sys
+import threading
+import zlib
+
+from robobluekit import codec
+from robobluekit.kit import format_timestamp
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FORMAT = 'segment-{:020d}.jsonl.gz'
+INDEX_FORMAT = 'segment-{:020d}.idx'
+
+
+def list_segments(directory):
+    """
+    List the sequence numbers of the segments in the archive in the order they were written
+    :param directory: Archive directory
+    :return: list of sequence numbers
+    """
+    return sorted(
+        int(path.basename(p)[len('segment-'):-len('.jsonl.gz')])
+        for p in glob.glob(path.join(directory, 'segment-*.jsonl.gz'))
+    )
+
+
+class ArchiveWriter:
+    """
+        ArchiveWriter appends blocks of records to the current segment of the archive, rotating segments once they
+        reach the configured size and removing the oldest segments beyond the configured retention
+    """
+
+    def __init__(self, directory, segment_size, max_segments, compression_level):
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__max_segments = max_segments
+        self.__compression_level = compression_level
+        self.__lock = threading.Lock()
+        self.__segment = None
+        self.__index = None
+
+        if not path.isdir(directory):
+            os.makedirs(directory)
+        segments = list_segments(directory)
+        self.__seq = segments[-1] + 1 if segments else 0
+
+    def __open(self):
+        self.__segment = open(path.join(self.__directory, SEGMENT_FORMAT.format(self.__seq)), 'ab')
+        self.__index = open(path.join(self.__directory, INDEX_FORMAT.format(self.__seq)), 'ab')
+
+    def __rotate(self):
+        self.__segment.close()
+        self.__index.close()
+        self.__segment = None
+        self.__index = None
+        self.__seq += 1
+
+        if self.__max_segments is not None:
+            for seq in list_segments(self.__directory)[:-self.__max_segments]:
+                logger.info('removing archive segment %d', seq)
+                os.remove(path.join(self.__directory, SEGMENT_FORMAT.format(seq)))
+                if path.isfile(path.join(self.__directory, INDEX_FORMAT.format(seq))):
+                    os.remove(path.join(self.__directory, INDEX_FORMAT.format(seq)))
+
+    def write_block(self, records):
+        """
+        Compress and append a block of records to the archive
+        :param records: list of (received, topic, JSON line) tuples, received being a format_timestamp timestamp
+        :return: None
+        """
+        compressor = zlib.compressobj(self.__compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        block = compressor.compress(''.join(line + '\n' for _, _, line in records)) + compressor.flush()
+        entry = {
+            'length': len(block),
+            'first': min(received for received, _, _ in records),
+            'last': max(received for received, _, _ in records),
+            'count': len(records),
+            'topics': sorted(set(topic for _, topic, _ in records))
+        }
+
+        with self.__lock:
+            if self.__segment is None:
+                self.__open()
+            offset = self.__segment.tell()
+            self.__segment.write(block)
+            self.__segment.flush()
+            # The index entry only ever refers to a block that has been written in full
+            entry['offset'] = offset
+            self.__index.write(codec.dumps(entry) + '\n')
+            self.__index.flush()
+            if offset + len(block) >= self.__segment_size:
+                self.__rotate()
+
+    def close(self):
+        with self.__lock:
+            if self.__segment is not None:
+                self.__rotate()
+
+
+class ArchiveReader:
+    """
+        ArchiveReader extracts records from an archive, using the segment indices to skip blocks that can't contain
+        matching records
+    """
+
+    def __init__(self, directory):
+        self.__directory = directory
+
+    def __blocks(self, seq):
+        index = path.join(self.__directory, INDEX_FORMAT.format(seq))
+        if not path.isfile(index):
+            return
+        with open(index, 'rb') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    yield codec.loads(line)
+
+    def read(self, start=None, end=None, topic=None):
+        """
+        Iterate over the records received within the time range on the topic
+        :param start: Inclusive floating point unix timestamp, unbounded when None
+        :param end: Exclusive floating point unix timestamp, unbounded when None
+        :param topic: Destination topic of the records, any topic when None
+        :return: Generator of records
+        """
+        start = format_timestamp(start)
+        end = format_timestamp(end)
+        for seq in list_segments(self.__directory):
+            with open(path.join(self.__directory, SEGMENT_FORMAT.format(seq)), 'rb') as segment:
+                for block in self.__blocks(seq):
+                    if (start is not None and block['last'] < start) or (end is not None and block['first'] >= end) \
+                            or (topic is not None and topic not in block['topics']):
+                        continue
+                    segment.seek(block['offset'])
+                    data = zlib.decompress(segment.read(block['length']), 16 + zlib.MAX_WBITS)
+                    for line in data.splitlines():
+                        record = codec.loads(line)
+                        if (start is not None and record['received'] < start) \
+                                or (end is not None and record['received'] >= end) \
+                                or (topic is not None and record['destination_topic'] != topic):
+                            continue
+                        yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract records from a dxlhistorian archive as JSON Lines')
+    parser.add_argument('directory', help='archive directory')
+    parser.add_argument('--start', type=float, help='unix timestamp of the start of the time range')
+    parser.add_argument('--end', type=float, help='unix timestamp of the end of the time range')
+    parser.add_argument('--topic', help='destination topic of the records')
+    args = parser.parse_args()
+    for record in ArchiveReader(args.directory).read(args.start, args.end, args.topic):
+        sys.stdout.write(codec.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
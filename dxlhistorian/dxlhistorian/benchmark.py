@@ -0,0 +1,267 @@
+"""
+Throughput benchmark of the historian recording pipeline.
+
+Synthetic events are injected straight into the recording callbacks of a Historian connected to a stand-in fabric, so
+no broker is needed. Elasticsearch is replaced by a local stub HTTP server accepting every write. Every scenario runs
+in a process of its own and reports the events recorded per second, the latency of handing an event to the callback,
+the latency of recording an event, from being handed to the callback until written by the slowest of the recorders,
+and the peak memory use of the process.
+
+Recorders report how many events they've written rather than which ones, the events written are matched to the events
+handed to the callback in order. With several recorder workers the order, and so the record latency, is approximate.
+
+Usage: python -m dxlhistorian.benchmark [-n EVENTS] [--payload-size BYTES] [--latency MS] [SCENARIO...]
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import argparse
+import logging
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+from dxlclient.message import Event
+
+from robobluekit import codec
+from robobluekit.monitor import MonitoringContext
+
+from .application import HistorianApplication
+from .config import HistorianConfig
+from .recorder import RecorderMonitor
+
+TOPIC = '/dxlhistorian/benchmark'
+
+# Scenarios as (recorder types, application overrides, recorder overrides) tuples
+SCENARIOS = {
+    'es-single': (['Elasticsearch'], {}, {}),
+    'es-batch': (['Elasticsearch'], {}, {'BatchSize': '500'}),
+    'es-batch-queue': (['Elasticsearch'], {'QueueSize': '10000', 'Workers': '4'}, {'BatchSize': '500'}),
+    'es-batch-compressed': (['Elasticsearch'], {}, {'BatchSize': '500', 'CompressPayload': 'True'}),
+    'file': (['File'], {}, {}),
+    'file-queue': (['File'], {'QueueSize': '10000'}, {}),
+    # Blocking for every event to be recorded by both recorders
+    'es-file-fanout': (['Elasticsearch', 'File'], {'QueueSize': '10000', 'Backpressure': 'Block'}, {'BatchSize': '500'})
+}
+
+
+class StubElasticsearchHandler(BaseHTTPRequestHandler):
+    """
+    Request handler acknowledging every Elasticsearch request the recorders make
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def __respond(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def __handle(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.path.split('?')[0].endswith('/_bulk'):
+            self.__respond('{"took": 1, "errors": false, "items": []}')
+        elif self.command in ('PUT', 'POST') and '/event/' in self.path:
+            self.__respond('{"result": "created", "_version": 1}')
+        else:
+            self.__respond('{"acknowledged": true}')
+
+    do_HEAD = __handle
+    do_GET = __handle
+    do_PUT = __handle
+    do_POST = __handle
+    do_DELETE = __handle
+
+    def log_message(self, *args):
+        pass
+
+
+class StubElasticsearch(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server standing in for Elasticsearch, adding the configured latency to every request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubElasticsearchHandler)
+        self.latency = latency
+        thread = threading.Thread(name='StubElasticsearch', target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class SyntheticFabric:
+    """
+    Stand-in for the DXL client handing the synthetic events to the subscribed callbacks
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def add_event_callback(self, topic, callback):
+        self.callbacks.append(callback)
+
+    def remove_event_callback(self, topic, callback, unsubscribe_from_topic=True):
+        self.callbacks.remove(callback)
+
+
+class WriteClock:
+    """
+    Clock of the events written by a recorder, timing them as the recorder monitor is notified of the writes. Buffering
+    recorders are notified of every flush, the others of every event written
+    """
+
+    def __init__(self, monitor, buffered):
+        # type: (RecorderMonitor, bool) -> None
+        self.times = []
+        self.__lock = threading.Lock()
+        if buffered:
+            record_flush = monitor.record_flush
+
+            def flushed(size, latency, failed):
+                record_flush(size, latency, failed)
+                self.__written(size)
+            monitor.record_flush = flushed
+        else:
+            record_success = monitor.record_success
+
+            def succeeded():
+                record_success()
+                self.__written(1)
+            monitor.record_success = succeeded
+
+    def __written(self, count):
+        now = time.time()
+        with self.__lock:
+            self.times.extend([now] * count)
+
+
+def make_events(count, payload_size):
+    """
+    Put together synthetic events with JSON payloads of roughly the given size
+    """
+    events = []
+    for i in range(count):
+        event = Event(TOPIC)
+        event.payload = codec.dumps({
+            'sequence': i,
+            'source': 'benchmark',
+            'data': 'x' * max(payload_size - 50, 0)
+        })
+        events.append(event)
+    return events
+
+
+def run_scenario(name, events, latency, results):
+    """
+    Run a single scenario, meant to be run in a process of its own for the peak memory use to be meaningful
+    """
+    recorders, application, overrides = SCENARIOS[name]
+    server = StubElasticsearch(latency)
+    directory = tempfile.mkdtemp(prefix='dxlhistorian-benchmark-')
+    try:
+        parsed = {
+            'Application': dict({'SubscribeTo': TOPIC, 'Recorder': recorders}, **application),
+            'Elasticsearch': dict({
+                'Host': '127.0.0.1',
+                'Port': str(server.server_address[1]),
+                'Index': 'benchmark'
+            }, **overrides),
+            'File': {'Directory': directory}
+        }
+        config = HistorianConfig(parsed)
+        buffered = dict((recorder_type, recorder_type == 'File' or getattr(recorder_config, 'batching', False))
+                        for recorder_type, recorder_config in config.recorder_configs)
+        clocks = []
+        context = MonitoringContext()
+
+        def register(monitor):
+            if isinstance(monitor, RecorderMonitor):
+                clocks.append(WriteClock(monitor, buffered[monitor.name[len('recorder.'):]]))
+            return context.register(monitor)
+
+        fabric = SyntheticFabric()
+        historian = HistorianApplication.build_historian(fabric, config, register)
+        historian.start()
+        callback = fabric.callbacks[0]
+
+        handed = []
+        hand_off_latencies = []
+        started = time.time()
+        for event in events:
+            received = time.time()
+            handed.append(received)
+            callback.on_event(event)
+            hand_off_latencies.append(time.time() - received)
+        # Stopping waits for the queues to drain and the buffers to be flushed
+        historian.stop()
+        elapsed = time.time() - started
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # Events some recorder hasn't written have no record latency
+    written = min(len(clock.times) for clock in clocks)
+    record_latencies = [max(clock.times[i] for clock in clocks) - handed[i] for i in range(written)]
+    results.put((len(events) / elapsed, percentiles(hand_off_latencies), percentiles(record_latencies),
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def percentiles(latencies):
+    """
+    :return: (p50, p99) tuple of the latencies, None when there are none
+    """
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return latencies[len(latencies) // 2], latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DXL Historian throughput benchmark')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run, one of: {}. Runs all when omitted'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('-n', '--events', type=int, default=20000, help='events injected per scenario')
+    parser.add_argument('--payload-size', type=int, default=512, help='approximate size of an event payload in bytes')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds the stub Elasticsearch takes to answer a request')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+    logging.basicConfig(level=logging.WARN)
+
+    events = make_events(args.events, args.payload_size)
+    print '{:<20} {:>12} {:>18} {:>18} {:>18} {:>18} {:>10}'.format(
+        'scenario', 'events/s', 'hand-off p50 (us)', 'hand-off p99 (us)', 'record p50 (ms)', 'record p99 (ms)',
+        'rss (MB)')
+    for name in args.scenarios or sorted(SCENARIOS):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_scenario, args=(name, events, args.latency / 1e3, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print '{:<20} failed with exit code {}'.format(name, process.exitcode)
+            continue
+        rate, hand_off, record, rss = results.get()
+        record = ['{:.1f}'.format(p * 1e3) for p in record] if record is not None else ['-', '-']
+        print '{:<20} {:>12.0f} {:>18.1f} {:>18.1f} {:>18} {:>18} {:>10.1f}'.format(
+            name, rate, hand_off[0] * 1e6, hand_off[1] * 1e6, record[0], record[1], rss)
+
+
+if __name__ == '__main__':
+    main()
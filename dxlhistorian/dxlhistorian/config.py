@@ -1,11 +1,37 @@
+import re
+
 from configobj import ConfigObj
 
 from robobluekit.kit import run_validators, require, require_and_enforce_type, require_and_enforce_values, \
-    require_and_try_coercion
+    require_and_try_coercion, optional_and_try_coercion, optional_and_enforce_values, optional_and_enforce_type, \
+    InvalidConfigException
 
 # String representations of available recorder types
 RECORDER_STDOUT = 'STDOUT'
 RECORDER_ELASTICSEARCH = 'Elasticsearch'
+RECORDER_FILE = 'File'
+
+# String representations of the backpressure policies applied when the ingest queue is full
+BACKPRESSURE_BLOCK = 'Block'
+BACKPRESSURE_DROP_OLDEST = 'DropOldest'
+BACKPRESSURE_DROP_NEWEST = 'DropNewest'
+BACKPRESSURE_POLICIES = [BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST, BACKPRESSURE_DROP_NEWEST]
+
+# String representations of the index rollover strategies
+ROLLOVER_NONE = 'None'
+ROLLOVER_HOURLY = 'Hourly'
+ROLLOVER_DAILY = 'Daily'
+ROLLOVER_SIZE = 'Size'
+
+# String representations of the ways an event payload can be stored
+PAYLOAD_RAW = 'Raw'
+PAYLOAD_PARSED = 'Parsed'
+PAYLOAD_BOTH = 'Both'
+
+# String representations of the actions a rule applies to the events it matches
+ACTION_RECORD = 'Record'
+ACTION_DROP = 'Drop'
+ACTION_SAMPLE = 'Sample'
 
 
 class RecorderConfig:
@@ -25,6 +51,11 @@ class ElasticsearchConfig(RecorderConfig):
     Configuration options for the Elasticsearch backed recorder
     """
 
+    __PAYLOAD_STORAGE_VALIDATORS = [
+        ('PayloadStorage', [PAYLOAD_RAW, PAYLOAD_PARSED, PAYLOAD_BOTH], optional_and_enforce_values),
+        ('CompressPayload', ['True', 'False'], optional_and_enforce_values)
+    ]
+
     def __init__(self, config):
         RecorderConfig.__init__(self, config)
         self.__parsed = config
@@ -34,8 +65,38 @@ class ElasticsearchConfig(RecorderConfig):
         run_validators([
             ('Host', str, require_and_enforce_type),
             ('Index', str, require_and_enforce_type),
-            ('Port', int, require_and_try_coercion)
-        ], self.__parsed)
+            ('Port', int, require_and_try_coercion),
+            ('BatchSize', int, optional_and_try_coercion),
+            ('BatchBytes', int, optional_and_try_coercion),
+            ('BatchAge', float, optional_and_try_coercion),
+            ('SpoolDirectory', str, optional_and_enforce_type),
+            ('SpoolSegmentSize', int, optional_and_try_coercion),
+            ('SpoolMaxSegments', int, optional_and_try_coercion),
+            ('SpoolReplayRate', float, optional_and_try_coercion),
+            ('SpoolRetryInterval', float, optional_and_try_coercion),
+            ('SpoolFsync', ['True', 'False'], optional_and_enforce_values),
+            ('Topics', dict, optional_and_enforce_type),
+            ('Rollover', [ROLLOVER_NONE, ROLLOVER_HOURLY, ROLLOVER_DAILY, ROLLOVER_SIZE], optional_and_enforce_values),
+            ('RolloverSize', str, optional_and_enforce_type),
+            ('Retention', int, optional_and_try_coercion),
+            ('MaintenanceInterval', float, optional_and_try_coercion)
+        ] + self.__PAYLOAD_STORAGE_VALIDATORS, self.__parsed)
+
+        if self.retention is not None and self.retention < 1:
+            raise InvalidConfigException('Retention must keep at least one index')
+        if self.batch_age <= 0:
+            raise InvalidConfigException('BatchAge must be positive')
+        if self.spool_replay_rate <= 0:
+            raise InvalidConfigException('SpoolReplayRate must be positive')
+        if self.spool_retry_interval <= 0:
+            raise InvalidConfigException('SpoolRetryInterval must be positive')
+
+        for topic in self.__parsed.get('Topics', {}):
+            require_and_enforce_type(topic, dict, self.__parsed['Topics'])
+            run_validators(self.__PAYLOAD_STORAGE_VALIDATORS, self.__parsed['Topics'][topic])
+
+    def __payload_storage_of(self, container, default):
+        return container.get('PayloadStorage', default[0]), container.get('CompressPayload', str(default[1])) == 'True'
 
     @property
     def hosts(self):
@@ -48,13 +109,297 @@ class ElasticsearchConfig(RecorderConfig):
     def index(self):
         return self.__parsed['Index']
 
+    @property
+    def rollover(self):
+        return self.__parsed.get('Rollover', ROLLOVER_NONE)
+
+    @property
+    def rollover_size(self):
+        """
+        Size of the index triggering rollover in Elasticsearch byte units, applies to size based rollover
+        """
+        return self.__parsed.get('RolloverSize', '50gb')
+
+    @property
+    def retention(self):
+        """
+        Number of rolled indices to keep, None to keep all
+        """
+        return int(self.__parsed['Retention']) if 'Retention' in self.__parsed else None
+
+    @property
+    def maintenance_interval(self):
+        return float(self.__parsed.get('MaintenanceInterval', 300))
+
+    @property
+    def batching(self):
+        return self.batch_size > 1
+
+    @property
+    def batch_size(self):
+        return int(self.__parsed.get('BatchSize', 1))
+
+    @property
+    def batch_bytes(self):
+        return int(self.__parsed.get('BatchBytes', 5 * 1024 * 1024))
+
+    @property
+    def batch_age(self):
+        return float(self.__parsed.get('BatchAge', 1.0))
+
+    @property
+    def payload_storage(self):
+        """
+        Default payload storage mode and whether to compress the raw payload
+        :return: (mode, compress) tuple
+        """
+        return self.__payload_storage_of(self.__parsed, (PAYLOAD_BOTH, False))
+
+    @property
+    def topic_payload_storage(self):
+        """
+        Payload storage modes overridden per topic
+        :return: dictionary of topic to (mode, compress) tuples
+        """
+        default = self.payload_storage
+        topics = self.__parsed.get('Topics', {})
+        return dict((topic, self.__payload_storage_of(topics[topic], default)) for topic in topics)
+
+    @property
+    def spooling(self):
+        return 'SpoolDirectory' in self.__parsed
+
+    @property
+    def spool_directory(self):
+        return self.__parsed.get('SpoolDirectory')
+
+    @property
+    def spool_segment_size(self):
+        return int(self.__parsed.get('SpoolSegmentSize', 64 * 1024 * 1024))
+
+    @property
+    def spool_max_segments(self):
+        return int(self.__parsed.get('SpoolMaxSegments', 16))
+
+    @property
+    def spool_replay_rate(self):
+        return float(self.__parsed.get('SpoolReplayRate', 1000))
+
+    @property
+    def spool_retry_interval(self):
+        return float(self.__parsed.get('SpoolRetryInterval', 10))
+
+    @property
+    def spool_fsync(self):
+        """
+        Whether spooled entries are synced to disk on every append rather than only when a segment is sealed
+        """
+        return self.__parsed.get('SpoolFsync', 'True') == 'True'
+
+
+class FileConfig(RecorderConfig):
+    """
+    Configuration options for the compressed file archive backed recorder
+    """
+
+    def __init__(self, config):
+        RecorderConfig.__init__(self, config)
+        self.__parsed = config
+        self.__validate()
+
+    def __validate(self):
+        run_validators([
+            ('Directory', str, require_and_enforce_type),
+            ('SegmentSize', int, optional_and_try_coercion),
+            ('MaxSegments', int, optional_and_try_coercion),
+            ('BlockSize', int, optional_and_try_coercion),
+            ('BlockAge', float, optional_and_try_coercion),
+            ('CompressionLevel', int, optional_and_try_coercion)
+        ], self.__parsed)
+
+        if self.block_age <= 0:
+            raise InvalidConfigException('BlockAge must be positive')
+
+    @property
+    def directory(self):
+        return self.__parsed['Directory']
+
+    @property
+    def segment_size(self):
+        return int(self.__parsed.get('SegmentSize', 256 * 1024 * 1024))
+
+    @property
+    def max_segments(self):
+        """
+        Number of segments to keep, None to keep all
+        """
+        return int(self.__parsed['MaxSegments']) if 'MaxSegments' in self.__parsed else None
+
+    @property
+    def block_size(self):
+        """
+        Uncompressed size in bytes of a block, a block being the unit of compression and indexing
+        """
+        return int(self.__parsed.get('BlockSize', 1024 * 1024))
+
+    @property
+    def block_age(self):
+        return float(self.__parsed.get('BlockAge', 5.0))
+
+    @property
+    def compression_level(self):
+        return int(self.__parsed.get('CompressionLevel', 6))
+
+
+class QueryServiceConfig:
+    """
+    Configuration options for the DXL service answering queries about the recorded events
+    """
+
+    def __init__(self, config, elasticsearch_config):
+        # type: (dict, ElasticsearchConfig) -> None
+        self.__parsed = config
+        self.elasticsearch = elasticsearch_config
+        self.__validate()
+
+    def __validate(self):
+        run_validators([
+            ('Type', str, require_and_enforce_type),
+            ('MaxPageSize', int, optional_and_try_coercion),
+            ('MaxCursors', int, optional_and_try_coercion),
+            ('CursorTimeout', int, optional_and_try_coercion)
+        ], self.__parsed)
+
+    @property
+    def type(self):
+        return self.__parsed['Type']
+
+    @property
+    def max_page_size(self):
+        return int(self.__parsed.get('MaxPageSize', 500))
+
+    @property
+    def max_cursors(self):
+        """
+        Maximum number of cursors, and as such Elasticsearch scroll contexts, open at the same time
+        """
+        return int(self.__parsed.get('MaxCursors', 16))
+
+    @property
+    def cursor_timeout(self):
+        """
+        Seconds after which an idle cursor is closed
+        """
+        return int(self.__parsed.get('CursorTimeout', 60))
+
+
+class RuleConfig:
+    """
+    Configuration options of a single filtering or sampling rule
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.__parsed = config
+        self.__validate()
+
+    def __validate(self):
+        run_validators([
+            ('Topics', (list, str), optional_and_enforce_type),
+            ('Field', str, optional_and_enforce_type),
+            ('Equals', str, optional_and_enforce_type),
+            ('Matches', str, optional_and_enforce_type),
+            ('Action', [ACTION_RECORD, ACTION_DROP, ACTION_SAMPLE], require_and_enforce_values),
+            ('SampleRate', float, optional_and_try_coercion)
+        ], self.__parsed)
+
+        if ('Equals' in self.__parsed or 'Matches' in self.__parsed) and 'Field' not in self.__parsed:
+            raise InvalidConfigException('Rule {} compares a value without a Field'.format(self.name))
+        if 'Matches' in self.__parsed:
+            try:
+                re.compile(self.__parsed['Matches'])
+            except re.error as e:
+                raise InvalidConfigException('Rule {} has an invalid Matches expression: {}'.format(self.name, e))
+        if self.action == ACTION_SAMPLE:
+            require('SampleRate', self.__parsed)
+            if not 0 <= self.sample_rate <= 1:
+                raise InvalidConfigException('SampleRate of rule {} must be between 0 and 1'.format(self.name))
+
+    @property
+    def topics(self):
+        """
+        Topic patterns the rule applies to, any topic when empty
+        """
+        topics = self.__parsed.get('Topics', [])
+        return [topics] if isinstance(topics, str) else topics
+
+    @property
+    def field(self):
+        """
+        Dot separated path of the payload field the rule examines, None when the rule doesn't examine the payload
+        """
+        return self.__parsed.get('Field')
+
+    @property
+    def equals(self):
+        return self.__parsed.get('Equals')
+
+    @property
+    def matches(self):
+        return self.__parsed.get('Matches')
+
+    @property
+    def action(self):
+        return self.__parsed['Action']
+
+    @property
+    def sample_rate(self):
+        return float(self.__parsed.get('SampleRate', 1))
+
+
+class DeduplicationConfig:
+    """
+    Configuration options for dropping events whose message id has already been seen
+    """
+
+    def __init__(self, config):
+        self.__parsed = config
+        self.__validate()
+
+    def __validate(self):
+        run_validators([
+            ('Capacity', int, optional_and_try_coercion),
+            ('Window', float, optional_and_try_coercion)
+        ], self.__parsed)
+
+        if self.capacity < 2:
+            raise InvalidConfigException('Deduplication Capacity must be at least 2')
+
+    @property
+    def capacity(self):
+        """
+        Maximum number of message ids remembered
+        """
+        return int(self.__parsed.get('Capacity', 100000))
+
+    @property
+    def window(self):
+        """
+        Seconds a message id is remembered for at most
+        """
+        return float(self.__parsed.get('Window', 300))
+
 
 class HistorianConfig:
     """
     HistorianConfig encapsulates the configuration of the Historian application
     """
 
-    __RECORDER_CONFIG_MAPPING = {RECORDER_ELASTICSEARCH: ElasticsearchConfig, RECORDER_STDOUT: STDOUTConfig}
+    __RECORDER_CONFIG_MAPPING = {
+        RECORDER_ELASTICSEARCH: ElasticsearchConfig,
+        RECORDER_FILE: FileConfig,
+        RECORDER_STDOUT: STDOUTConfig
+    }
 
     def __init__(self, config_file):
         self.__parsed = ConfigObj(config_file)
@@ -64,17 +409,106 @@ class HistorianConfig:
         require('Application', self.__parsed)
         run_validators([
             ('SubscribeTo', (list, str), require_and_enforce_type),
-            ('Recorder', self.__RECORDER_CONFIG_MAPPING, require_and_enforce_values)
+            ('Recorder', (list, str), require_and_enforce_type),
+            ('QueueSize', int, optional_and_try_coercion),
+            ('Workers', int, optional_and_try_coercion),
+            ('Backpressure', BACKPRESSURE_POLICIES, optional_and_enforce_values)
         ], self.__parsed['Application'])
 
+        for recorder in self.__recorders:
+            if recorder not in self.__RECORDER_CONFIG_MAPPING:
+                raise InvalidConfigException('Unknown recorder {}'.format(recorder))
+            if recorder in self.__parsed:
+                optional_and_enforce_values('Backpressure', BACKPRESSURE_POLICIES, self.__parsed[recorder])
+        if len(set(self.__recorders)) != len(self.__recorders):
+            raise InvalidConfigException('Each recorder can be used only once')
+        if len(self.__recorders) > 1 and self.queue_size == 0:
+            raise InvalidConfigException('QueueSize is required to be positive when recording with several recorders')
+
+        optional_and_enforce_type('Rules', dict, self.__parsed)
+        self.__rules = []
+        for name in self.__parsed.get('Rules', {}):
+            require_and_enforce_type(name, dict, self.__parsed['Rules'])
+            self.__rules.append(RuleConfig(name, self.__parsed['Rules'][name]))
+
+        self.__deduplication = None
+        if 'Deduplication' in self.__parsed:
+            require_and_enforce_type('Deduplication', dict, self.__parsed)
+            self.__deduplication = DeduplicationConfig(self.__parsed['Deduplication'])
+
+        self.__query_service = None
+        if 'Service' in self.__parsed:
+            # Queries are answered from Elasticsearch
+            require(RECORDER_ELASTICSEARCH, self.__parsed)
+            self.__query_service = QueryServiceConfig(self.__parsed['Service'],
+                                                      ElasticsearchConfig(self.__parsed[RECORDER_ELASTICSEARCH]))
+
     @property
     def subscribe_to(self):
         sub_to = self.__parsed['Application']['SubscribeTo']
         return [sub_to] if isinstance(sub_to, str) else sub_to
 
     @property
-    def recorder_config(self):
-        recorder = self.__parsed['Application']['Recorder']
-        return recorder, self.__RECORDER_CONFIG_MAPPING[recorder](
-            self.__parsed[recorder] if recorder in self.__parsed else {}
-        )
+    def queue_size(self):
+        """
+        Size of the ingest queue, 0 means events are recorded on the thread they were received on
+        """
+        return int(self.__parsed['Application'].get('QueueSize', 0))
+
+    @property
+    def workers(self):
+        return int(self.__parsed['Application'].get('Workers', 1))
+
+    @property
+    def backpressure(self):
+        """
+        Backpressure policy of the ingest queues. A recorder blocking the receiving thread holds back the others too,
+        the queues of several recorders drop the newest events unless configured otherwise
+        """
+        default = BACKPRESSURE_BLOCK if len(self.__recorders) == 1 else BACKPRESSURE_DROP_NEWEST
+        return self.__parsed['Application'].get('Backpressure', default)
+
+    def backpressure_of(self, recorder):
+        """
+        Backpressure policy of the ingest queue of the recorder, the one of its configuration block if given
+        :param recorder: Recorder type
+        """
+        return self.__parsed.get(recorder, {}).get('Backpressure', self.backpressure)
+
+    @property
+    def rules_config(self):
+        """
+        Filtering and sampling rules in the order they are evaluated
+        """
+        return self.__rules
+
+    @property
+    def deduplication_config(self):
+        """
+        Configuration of message id deduplication, None when deduplication isn't enabled
+        """
+        return self.__deduplication
+
+    @property
+    def query_service_config(self):
+        """
+        Configuration of the query service, None when the service isn't enabled
+        """
+        return self.__query_service
+
+    @property
+    def __recorders(self):
+        recorders = self.__parsed['Application']['Recorder']
+        return [recorders] if isinstance(recorders, str) else recorders
+
+    @property
+    def recorder_configs(self):
+        """
+        Recorders every event is recorded with
+        :return: list of (recorder type, recorder configuration) tuples
+        """
+        return [
+            (recorder, self.__RECORDER_CONFIG_MAPPING[recorder](
+                self.__parsed[recorder] if recorder in self.__parsed else {}
+            )) for recorder in self.__recorders
+        ]
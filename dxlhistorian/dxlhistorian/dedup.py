@@ -0,0 +1,128 @@
+import threading
+import time
+
+from robobluekit import Monitor
+from robobluekit.metrics import Counter, Gauge
+
+from .config import DeduplicationConfig
+
+
+class DeduplicationMonitor(Monitor):
+
+    def __init__(self, name):
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.deduplicator = None
+        Monitor.__init__(self, name)
+
+    def record_lookup(self, hit):
+        with self.__lock:
+            if hit:
+                self.__hits += 1
+            else:
+                self.__misses += 1
+
+    @property
+    def healthy(self):
+        return None
+
+    @property
+    def metrics(self):
+        return [
+            Counter('dxlhistorian_deduplication_hits_total', 'Duplicate events dropped', lambda: self.__hits),
+            Counter('dxlhistorian_deduplication_misses_total', 'Events seen for the first time', lambda: self.__misses),
+            Gauge('dxlhistorian_deduplication_remembered', 'Message ids remembered',
+                  lambda: self.deduplicator.size if self.deduplicator is not None else None)
+        ]
+
+    def report_status(self):
+        return {
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'remembered': self.deduplicator.size if self.deduplicator is not None else None,
+            'capacity': self.deduplicator.capacity if self.deduplicator is not None else None
+        }
+
+
+class Deduplicator:
+    """
+        Deduplicator remembers recently seen message ids in two generations of sets. New ids are added to the current
+        generation, which replaces the previous one once it holds half of the capacity or is half of the window old.
+        Memory is bounded by the capacity and an id is remembered for at least half of the window, unless the
+        capacity is exhausted sooner, and at most the whole window
+    """
+
+    def __init__(self, capacity, window, monitor):
+        # type: (int, float, DeduplicationMonitor) -> None
+        self.capacity = capacity
+        self.__generation_size = capacity // 2
+        self.__generation_age = window / 2
+        self.monitor = monitor
+        self.__lock = threading.Lock()
+        self.__current = set()
+        self.__previous = set()
+        self.__rotated = time.time()
+        monitor.deduplicator = self
+
+    @staticmethod
+    def from_config(config, register_monitor):
+        # type: (DeduplicationConfig, callable) -> Deduplicator
+        return Deduplicator(config.capacity, config.window,
+                            register_monitor(DeduplicationMonitor('deduplication')))
+
+    @property
+    def size(self):
+        return len(self.__current) + len(self.__previous)
+
+    def __rotate(self, now):
+        self.__previous = self.__current
+        self.__current = set()
+        self.__rotated = now
+
+    def __expire(self, now):
+        if now - self.__rotated >= 2 * self.__generation_age:
+            # Both generations fell out of the window while idle
+            self.__current = set()
+            self.__rotate(now)
+        elif now - self.__rotated >= self.__generation_age:
+            self.__rotate(now)
+
+    def seen(self, message_id):
+        """
+        Check whether the message id has been seen within the window. Ids are remembered as the event is handed over to
+        the recorders and forgotten when it is lost on the way, for its redelivery to be recorded
+        :param message_id: Message id of the received event
+        :return: Boolean indicating a duplicate
+        """
+        with self.__lock:
+            self.__expire(time.time())
+            hit = message_id in self.__current or message_id in self.__previous
+        self.monitor.record_lookup(hit)
+        return hit
+
+    def remember(self, message_id):
+        """
+        Remember the message id of an event about to be handed over to the recorders
+        :param message_id: Message id of the event
+        :return: False when the message id was already remembered, by a copy of the event received meanwhile
+        """
+        with self.__lock:
+            now = time.time()
+            self.__expire(now)
+            if message_id in self.__current or message_id in self.__previous:
+                return False
+            if len(self.__current) >= self.__generation_size:
+                self.__rotate(now)
+            self.__current.add(message_id)
+            return True
+
+    def forget(self, message_id):
+        """
+        Forget the message id of an event lost after being handed over, dropped from a queue or failed to be recorded
+        :param message_id: Message id of the event
+        :return: None
+        """
+        with self.__lock:
+            self.__current.discard(message_id)
+            self.__previous.discard(message_id)
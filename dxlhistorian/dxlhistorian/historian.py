@@ -1,4 +1,5 @@
 import logging
+import Queue
 import threading
 import time
 
@@ -6,9 +7,14 @@ from dxlclient.message import Event
 from dxlclient.callbacks import EventCallback
 
 from robobluekit import Monitor
-from robobluekit.kit import format_timestamp
+from robobluekit.drain import InFlight
+from robobluekit.kit import format_timestamp, format_histogram
+from robobluekit.metrics import Counter, LatencyHistogram
 
-from .recorder import Recorder
+from .config import BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_NEWEST
+from .dedup import Deduplicator
+from .recorder import Recorder, RecorderMonitor
+from .rules import RuleSet
 
 logger = logging.getLogger(__name__)
 
@@ -19,53 +25,232 @@ class RecordingMonitor(Monitor):
         self.__first_receipt = None
         self.__last_receipt = None
         self.__last_size = None
-        self.__message_count = 0
+        self.__events = Counter('dxlhistorian_events_total', 'Events received and accepted for recording')
+        self.__latency = LatencyHistogram('dxlhistorian_event_handling_seconds',
+                                          'Time taken to hand a received event over to the recorders')
         self.__lock = threading.Lock()
         Monitor.__init__(self, name)
 
     def record_event_receipt(self, event):
         # type: (Event) -> None
-        with self.__lock:
-            now = time.time()
-            if self.__first_receipt is None:
-                self.__first_receipt = now
-            self.__last_receipt = now
-            self.__last_size = len(event.payload)
-            self.__message_count += 1
+        now = time.time()
+        if self.__first_receipt is None:
+            with self.__lock:
+                if self.__first_receipt is None:
+                    self.__first_receipt = now
+        self.__last_receipt = now
+        self.__last_size = len(event.payload)
+        self.__events.inc()
+
+    def record_latency(self, latency):
+        """
+        Record the time it took to hand the event over to the recorders, including recording it when there's no
+        ingest queue
+        :param latency: Latency in seconds
+        :return: None
+        """
+        self.__latency.record(latency)
 
     @property
     def healthy(self):
         return None
 
+    @property
+    def metrics(self):
+        return [self.__events, self.__latency]
+
     def report_status(self):
         return {
             'first_event_received': format_timestamp(self.__first_receipt),
             'latest_event_received': format_timestamp(self.__last_receipt),
             'latest_event_size': self.__last_size,
-            'event_count': self.__message_count,
+            'event_count': self.__events.value,
+            'latency': format_histogram(self.__latency)
         }
 
 
+def record_event(recorder, event):
+    # type: (Recorder, Event) -> bool
+    """
+    Record the event with the recorder, logging rather than raising any failures
+    :param recorder: Recorder to record the event with
+    :param event: The received event
+    :return: Whether the event was recorded
+    """
+    try:
+        recorder.record(event)
+        return True
+    except BaseException as e:
+        logger.error('failed recording event %s due to error: %s', event.message_id, e.message)
+        return False
+
+
+class IngestQueue:
+    """
+        Bounded queue decoupling the receipt of events from recording them with a single recorder. The queue is
+        drained by a pool of recorder workers, when full the configured backpressure policy is applied to incoming
+        events
+    """
+
+    # Sentinel instructing a worker to stop
+    __STOP = object()
+
+    def __init__(self, recorder, monitor, size, workers, policy, lost=None):
+        # type: (Recorder, RecorderMonitor, int, int, str, callable) -> None
+        """
+        :param lost: Function called with the events dropped from the queue or failed to be recorded
+        """
+        self.__recorder = recorder
+        self.__monitor = monitor
+        self.__policy = policy
+        self.__lost = lost
+        self.__queue = Queue.Queue(size)
+        self.__workers = []
+        for i in range(workers):
+            worker = threading.Thread(name='IngestWorker-{}'.format(i), target=self.__work)
+            worker.daemon = True
+            self.__workers.append(worker)
+
+    @property
+    def depth(self):
+        return self.__queue.qsize()
+
+    def __work(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is self.__STOP:
+                    return
+                event, enqueued = item
+                self.__monitor.record_wait(time.time() - enqueued)
+                if not record_event(self.__recorder, event):
+                    self.__lose(event)
+            finally:
+                self.__queue.task_done()
+
+    def __lose(self, event):
+        if self.__lost is not None:
+            self.__lost(event)
+
+    def put(self, event):
+        # type: (Event) -> bool
+        """
+        Queue the event for recording, applying the backpressure policy if the queue is full
+        :param event: The received event
+        :return: Whether the event was queued
+        """
+        item = (event, time.time())
+        if self.__policy == BACKPRESSURE_BLOCK:
+            self.__queue.put(item)
+            return True
+
+        while True:
+            try:
+                self.__queue.put_nowait(item)
+                return True
+            except Queue.Full:
+                if self.__policy == BACKPRESSURE_DROP_NEWEST:
+                    logger.warn('ingest queue full, dropping event %s', event.message_id)
+                    self.__monitor.record_drop()
+                    return False
+
+            # Make room by dropping the oldest queued event, the workers may have beaten us to it
+            try:
+                dropped_event, _ = self.__queue.get_nowait()
+            except Queue.Empty:
+                continue
+            logger.warn('ingest queue full, dropping event %s', dropped_event.message_id)
+            self.__monitor.record_drop()
+            self.__lose(dropped_event)
+            self.__queue.task_done()
+
+    def start(self):
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the workers once the events queued so far have been recorded
+        :param timeout: Seconds to wait for the events to be recorded, waits for all of them when omitted
+        :return: Number of events left queued once the time is up
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        def remaining():
+            return max(0, deadline - time.time()) if deadline is not None else None
+
+        try:
+            for _ in self.__workers:
+                self.__queue.put(self.__STOP, timeout=remaining())
+        except Queue.Full:
+            pass
+        for worker in self.__workers:
+            worker.join(remaining())
+        with self.__queue.mutex:
+            return sum(1 for item in self.__queue.queue if item is not self.__STOP)
+
+
 class RecordingCallback(EventCallback):
     """
-        The recording callback receives the incoming event and records it to a more permanent storage for future
-        use
+        The recording callback receives the incoming event and fans it out to the recorders for more permanent storage
+        for future use. Recorders with an ingest queue have the event queued for recording instead. Events rejected
+        by the filtering and sampling rules and duplicates of events already seen are not recorded
     """
 
-    def __init__(self, recorder, monitor):
-        # type: (Recorder, RecordingMonitor) -> None
+    def __init__(self, sinks, monitor, rules=None, deduplicator=None, in_flight=None):
+        # type: (list, RecordingMonitor, RuleSet, Deduplicator, InFlight) -> None
+        """
+        :param sinks: list of (Recorder, IngestQueue) tuples, the queue being None when recording on the receiving
+        thread
+        :param in_flight: Callbacks in flight of the historian to count the callback in
+        """
         EventCallback.__init__(self)
-        self.__recorder = recorder
+        self.__sinks = sinks
         self.__monitor = monitor
+        self.__filters = (rules, deduplicator)
+        self.__in_flight = in_flight
+
+    def set_filters(self, rules, deduplicator):
+        """
+        Swap the rules and the deduplicator, events being received meanwhile are filtered by either the old or the new
+        ones
+        """
+        # type: (RuleSet, Deduplicator) -> None
+        self.__filters = (rules, deduplicator)
 
     def on_event(self, event):
         # type: (Event) -> None
+        if self.__in_flight is None:
+            self.__record(event)
+            return
+        self.__in_flight.enter()
+        self.__in_flight.run(self.__record, event)
+
+    def __record(self, event):
         logger.debug('received event %s from the service fabric', event.message_id)
-        try:
-            self.__recorder.record(event)
-            self.__monitor.record_event_receipt(event)
-        except BaseException as e:
-            logger.error('failed recording event %s due to error: %s', event.message_id, e.message)
+        rules, deduplicator = self.__filters
+        if deduplicator is not None and deduplicator.seen(event.message_id):
+            logger.debug('event %s is a duplicate', event.message_id)
+            return
+        if rules is not None and not rules.should_record(event):
+            logger.debug('event %s rejected by rules', event.message_id)
+            return
+        # Remembered before the hand-over for the recorder workers to find it when forgetting a lost event
+        if deduplicator is not None and not deduplicator.remember(event.message_id):
+            logger.debug('event %s is a duplicate', event.message_id)
+            return
+        received = time.time()
+        self.__monitor.record_event_receipt(event)
+        handed = True
+        for recorder, queue in self.__sinks:
+            if queue is not None:
+                handed = queue.put(event) and handed
+            else:
+                handed = record_event(recorder, event) and handed
+        # An event some recorder missed is recorded when redelivered
+        if deduplicator is not None and not handed:
+            deduplicator.forget(event.message_id)
+        self.__monitor.record_latency(time.time() - received)
 
 
 class Historian:
@@ -74,21 +259,147 @@ class Historian:
         on the OpenDXL fabric
     """
 
-    def __init__(self, config, dxl, recorder, register_monitor):
+    def __init__(self, config, dxl, recorders, register_monitor, service=None, deduplicator=None):
+        """
+        :param recorders: list of (Recorder, RecorderMonitor, backpressure policy) tuples the events are fanned out to
+        :param deduplicator: Deduplicator to carry over from a replaced historian, along with the message ids it
+        remembers. A new one is created from the configuration when omitted
+        """
         self.__config = config
         self.__dxl = dxl
-        self.__recorder = recorder
         self.__register_monitor = register_monitor
+        self.__service = service
+        self.__callbacks = []  # (topic, RecordingCallback) tuples
+        # Counted apart from the client, which the callbacks of a replacing historian share
+        self.__in_flight = InFlight()
+        self.__drained = False
+        self.__rules = None
+        self.__deduplicator = None
+        self.__compile_filters(config, register_monitor, deduplicator)
+        # Every recorder gets a queue of its own so that a slow recorder can't hold back the others, unless its queue
+        # blocks the receiving thread when full
+        self.__sinks = []
+        for recorder, monitor, backpressure in recorders:
+            queue = None
+            if config.queue_size > 0:
+                queue = IngestQueue(recorder, monitor, config.queue_size, config.workers, backpressure, self.__lost)
+                monitor.queue = queue
+            self.__sinks.append((recorder, queue))
 
-    def start(self):
-        self.__dxl.connect()
-        logger.info('connected dxlhistorian to service fabric')
+    @property
+    def dxl(self):
+        return self.__dxl
+
+    @property
+    def recorders(self):
+        """
+        Recorders the events are fanned out to, in the order they were given
+        """
+        return [recorder for recorder, _ in self.__sinks]
+
+    def __lost(self, event):
+        # The deduplicator may be swapped by refilter
+        deduplicator = self.__deduplicator
+        if deduplicator is not None:
+            deduplicator.forget(event.message_id)
+
+    @property
+    def deduplicator(self):
+        return self.__deduplicator
+
+    @property
+    def topics(self):
+        return set(topic for topic, _ in self.__callbacks)
+
+    def __compile_filters(self, config, register_monitor, deduplicator):
+        self.__rules = RuleSet.compile(config.rules_config, register_monitor) if config.rules_config else None
+        if deduplicator is not None:
+            register_monitor(deduplicator.monitor)
+        elif config.deduplication_config is not None:
+            deduplicator = Deduplicator.from_config(config.deduplication_config, register_monitor)
+        self.__deduplicator = deduplicator
+
+    def refilter(self, config, register_monitor, keep_deduplicator=False):
+        """
+        Swap the rules and the deduplication for those of the configuration without interrupting the recording
+        :param config: Configuration differing only by the Rules and Deduplication sections
+        :param register_monitor: function for registering monitors with the monitoring context
+        :param keep_deduplicator: Whether to keep the current deduplicator along with the message ids it remembers
+        :return: None
+        """
+        self.__compile_filters(config, register_monitor, self.__deduplicator if keep_deduplicator else None)
+        for _, callback in self.__callbacks:
+            callback.set_filters(self.__rules, self.__deduplicator)
+        self.__config = config
+        logger.info('swapped the dxlhistorian filtering rules and deduplication')
+
+    def start(self, connect=True, replacing=None):
+        """
+        :param connect: Whether to connect the client, a historian replacing another one reuses the connected client
+        :param replacing: Historian replaced over the same client. Services registered on one client share its
+        subscriptions, the query service of the replaced historian is unregistered before this one registers
+        """
+        for _, queue in self.__sinks:
+            if queue is not None:
+                queue.start()
+        if connect:
+            self.__dxl.connect()
+            logger.info('connected dxlhistorian to service fabric')
         for topic in self.__config.subscribe_to:
-            callback = RecordingCallback(self.__recorder,
-                                         self.__register_monitor(RecordingMonitor('recording.{}'.format(topic))))
+            monitor = self.__register_monitor(RecordingMonitor('recording.{}'.format(topic)))
+            callback = RecordingCallback(self.__sinks, monitor, self.__rules, self.__deduplicator, self.__in_flight)
             self.__dxl.add_event_callback(topic, callback)
+            self.__callbacks.append((topic, callback))
             logger.info("subscribed dxlhistorian to topic %s", topic)
+        if self.__service is not None:
+            if replacing is not None:
+                replacing.unregister_service()
+            self.__service.register()
+
+    def unregister_service(self):
+        if self.__service is not None:
+            self.__service.unregister()
+
+    def __pending(self):
+        pending = self.__in_flight.count
+        if self.__service is not None:
+            pending += self.__service.in_flight.count
+        return pending
+
+    def drain(self, drain=None, keep=(), keep_recorders=()):
+        """
+        Stop taking events and queries, then wait for the callbacks in flight and record the events queued, flushing
+        the recorders. The client is left connected
+        :param drain: robobluekit Drain bounding the wait, everything is waited for when omitted
+        :param keep: Topics the replacing historian subscribes to over the same client, the client staying subscribed
+        :param keep_recorders: Recorders carried over to the replacing historian, left open
+        :return: None
+        """
+        if self.__drained:
+            return
+        self.__drained = True
+        for topic, callback in self.__callbacks:
+            self.__dxl.remove_event_callback(topic, callback, unsubscribe_from_topic=topic not in keep)
+        self.__callbacks = []
+        self.unregister_service()
+        if drain is not None:
+            drain.wait(self.__pending, 'callbacks')
+        for recorder, queue in self.__sinks:
+            if queue is not None:
+                left = queue.stop(drain.remaining if drain is not None else None)
+                if drain is not None:
+                    drain.abandon('events', left)
+            if recorder not in keep_recorders:
+                recorder.close()
+        if self.__service is not None:
+            self.__service.close()
 
-    def stop(self):
-        logger.info("disconnecting dxlhistorian from service fabric")
-        self.__dxl.disconnect()
+    def stop(self, disconnect=True):
+        """
+        Drain the historian unless already drained and tear it down
+        :param disconnect: Whether to disconnect the client, otherwise it is left connected for the replacing historian
+        """
+        self.drain()
+        if disconnect:
+            logger.info("disconnecting dxlhistorian from service fabric")
+            self.__dxl.disconnect()
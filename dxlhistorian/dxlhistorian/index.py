@@ -0,0 +1,180 @@
+import logging
+import re
+import threading
+import time
+
+from elasticsearch import Elasticsearch, ElasticsearchException
+
+from robobluekit.kit import InvalidConfigException
+
+from .config import ElasticsearchConfig, ROLLOVER_NONE, ROLLOVER_HOURLY, ROLLOVER_DAILY, ROLLOVER_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Mapping of the documents recorded by the historian
+EVENT_MAPPING = {
+    'event': {
+        'properties': {
+            'destination_topic': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}},
+            'payload': {'type': 'binary'},
+            'payload_compression': {'type': 'keyword'},
+            'deserialized_payload': {'type': 'nested'},
+            'received': {'type': 'date'}
+        }
+    }
+}
+
+# Length of the periods and the index name suffix format of the time rolled indices
+ROLLOVER_PERIODS = {
+    ROLLOVER_HOURLY: (3600, '%Y.%m.%d.%H'),
+    ROLLOVER_DAILY: (86400, '%Y.%m.%d')
+}
+
+# Expressions matching the suffixes of the rolled indices, telling them apart from other indices sharing the prefix
+ROLLOVER_SUFFIXES = {
+    ROLLOVER_HOURLY: r'\d{4}\.\d{2}\.\d{2}\.\d{2}',
+    ROLLOVER_DAILY: r'\d{4}\.\d{2}\.\d{2}',
+    ROLLOVER_SIZE: r'\d{6,}'
+}
+
+
+class IndexManager:
+    """
+        IndexManager resolves the index an event is written to and provisions indices as they are first needed. Indices
+        known to be provisioned are cached so that writes don't need to check for their existence. Rolled indices are
+        named after the configured index, maintenance such as size based rollover and retention pruning is done in the
+        background
+    """
+
+    def __init__(self, esc, config):
+        # type: (Elasticsearch, ElasticsearchConfig) -> None
+        self.__esc = esc
+        self.__prefix = config.index
+        self.__rollover = config.rollover
+        self.__rollover_size = config.rollover_size
+        self.__retention = config.retention
+        self.__interval = config.maintenance_interval
+        self.__period = ROLLOVER_PERIODS.get(self.__rollover)
+        self.__rolled = None
+        if self.__rollover in ROLLOVER_SUFFIXES:
+            self.__rolled = re.compile('{}-{}$'.format(re.escape(self.__prefix), ROLLOVER_SUFFIXES[self.__rollover]))
+        self.__lock = threading.Lock()
+        self.__provisioned = set()
+        self.__template = False
+        self.__current = (None, None, None)  # (period start, period end, index name)
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(name='IndexMaintenance', target=self.__maintain)
+        self.__thread.daemon = True
+
+    @property
+    def search_pattern(self):
+        """
+        Index pattern covering all the indices written to
+        """
+        return self.__prefix if self.__rollover == ROLLOVER_NONE else '{}-*'.format(self.__prefix)
+
+    def ensure_template(self):
+        """
+        Put the index template applied to the rolled indices, once per process
+        :return: None
+        """
+        if self.__template or self.__rollover == ROLLOVER_NONE:
+            return
+        with self.__lock:
+            if not self.__template:
+                self.__esc.indices.put_template(self.__prefix, {
+                    'index_patterns': ['{}-*'.format(self.__prefix)],
+                    'mappings': EVENT_MAPPING
+                })
+                self.__template = True
+
+    def __provision(self, name, body=None):
+        """
+        Create the index unless it already exists
+        """
+        self.ensure_template()
+        with self.__lock:
+            if name in self.__provisioned:
+                return
+            if not self.__esc.indices.exists(name):
+                logger.info('creating index %s', name)
+                # Another historian instance may have beaten us to it
+                self.__esc.indices.create(name, body=body, ignore=400)
+            self.__provisioned.add(name)
+
+    def initialize(self):
+        if self.__rollover == ROLLOVER_NONE:
+            self.__provision(self.__prefix, {'mappings': EVENT_MAPPING})
+        elif self.__rollover == ROLLOVER_SIZE:
+            # Writes go to an alias pointing at the latest generation
+            if not self.__esc.indices.exists_alias(name=self.__prefix):
+                if self.__esc.indices.exists(self.__prefix):
+                    raise InvalidConfigException(
+                        'Index {} already exists, size based rollover requires the name for the alias of the rolled '
+                        'indices'.format(self.__prefix)
+                    )
+                self.__provision('{}-000001'.format(self.__prefix), {'aliases': {self.__prefix: {}}})
+        self.__thread.start()
+
+    def index_for(self, timestamp, provision=True):
+        """
+        Resolve the name of the index the event received at the given time is to be written to
+        :param timestamp: floating point unix timestamp
+        :param provision: Whether to provision the index if it hasn't been yet
+        :return: Index name
+        """
+        if self.__period is None:
+            return self.__prefix
+
+        start, end, name = self.__current
+        if start is not None and start <= timestamp < end:
+            return name
+
+        length, suffix = self.__period
+        start = timestamp - timestamp % length
+        name = '{}-{}'.format(self.__prefix, time.strftime(suffix, time.gmtime(start)))
+        if name not in self.__provisioned:
+            if not provision:
+                return name
+            try:
+                self.__provision(name)
+            except ElasticsearchException as e:
+                # Writing to the index will still create it, provisioning is retried with the next event
+                logger.error('failed provisioning index %s: %s', name, e)
+                return name
+        if self.__current[0] is None or start > self.__current[0]:  # Don't go back in time because of a late event
+            self.__current = (start, start + length, name)
+        return name
+
+    def __maintain(self):
+        while not self.__stopped.wait(self.__interval):
+            try:
+                if self.__rollover == ROLLOVER_SIZE:
+                    result = self.__esc.indices.rollover(self.__prefix, body={
+                        'conditions': {'max_size': self.__rollover_size}
+                    })
+                    if result.get('rolled_over'):
+                        logger.info('rolled index %s over to %s', self.__prefix, result.get('new_index'))
+                if self.__retention is not None and self.__rollover != ROLLOVER_NONE:
+                    self.__prune()
+            except ElasticsearchException as e:
+                logger.error('failed index maintenance: %s', e)
+
+    def __prune(self):
+        """
+        Delete all but the configured number of the latest rolled indices, index names sort in the order they were
+        created once the longer generation numbers of size rolled indices sort last
+        """
+        indices = sorted((name for name in self.__esc.indices.get('{}-*'.format(self.__prefix))
+                          if self.__rolled.match(name)), key=lambda name: (len(name), name))
+        expired = indices[:-self.__retention]
+        if expired:
+            logger.info('deleting expired indices %s', ', '.join(expired))
+            self.__esc.indices.delete(','.join(expired))
+            with self.__lock:
+                self.__provisioned.difference_update(expired)
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
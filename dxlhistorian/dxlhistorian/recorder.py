@@ -1,16 +1,22 @@
 import base64
 import logging
+import sys
 import time
-import json
 import threading
+import zlib
 
 from dxlclient.message import Event
 from elasticsearch import Elasticsearch, TransportError, ElasticsearchException
 
-from robobluekit import Monitor
-from robobluekit.kit import format_timestamp
+from robobluekit import Monitor, codec
+from robobluekit.kit import format_timestamp, format_duration
+from robobluekit.metrics import Counter, Gauge
 
-from .config import RECORDER_STDOUT, RECORDER_ELASTICSEARCH, RecorderConfig
+from .archive import ArchiveWriter
+from .config import RECORDER_STDOUT, RECORDER_ELASTICSEARCH, RECORDER_FILE, RecorderConfig, PAYLOAD_RAW, \
+    PAYLOAD_PARSED
+from .index import IndexManager
+from .spool import Spool, SpoolReplayer, REPLAY_BATCH_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -23,18 +29,82 @@ class RecorderMonitor(Monitor):
         self.__last_error = None
         self.__last_error_ts = None
         self.__started = None
+        self.__flush_count = 0
+        self.__flushed_docs = 0
+        self.__failed_docs = 0
+        self.__last_batch_size = None
+        self.__last_flush_latency = None
+        self.__max_flush_latency = None
+        self.__total_flush_latency = 0.0
+        self.__spooled = 0
+        self.__replayed = 0
+        self.__spool_drops = 0
+        self.__drop_count = 0
+        self.__wait_count = 0
+        self.__total_wait = 0.0
+        self.__max_wait = None
+        self.spool = None
+        self.queue = None
         Monitor.__init__(self, name)
 
     @property
     def healthy(self):
         return not self.__in_error
 
+    @property
+    def metrics(self):
+        return [
+            Counter('dxlhistorian_flushes_total', 'Bulk writes of buffered events', lambda: self.__flush_count),
+            Counter('dxlhistorian_flushed_documents_total', 'Events written in bulk', lambda: self.__flushed_docs),
+            Counter('dxlhistorian_failed_documents_total', 'Events that failed to be written in bulk',
+                    lambda: self.__failed_docs),
+            Counter('dxlhistorian_flush_seconds_total', 'Time spent writing events in bulk',
+                    lambda: self.__total_flush_latency),
+            Counter('dxlhistorian_spooled_events_total', 'Events spooled while the backend was unavailable',
+                    lambda: self.__spooled),
+            Counter('dxlhistorian_replayed_events_total', 'Spooled events replayed', lambda: self.__replayed),
+            Counter('dxlhistorian_dropped_spool_segments_total', 'Spool segments dropped due to the retention',
+                    lambda: self.__spool_drops),
+            Gauge('dxlhistorian_spool_segments', 'Spool segments pending replay',
+                  lambda: self.spool.segment_count if self.spool is not None else None),
+            Gauge('dxlhistorian_queue_depth', 'Events waiting in the ingest queue',
+                  lambda: self.queue.depth if self.queue is not None else None),
+            Counter('dxlhistorian_queue_dropped_events_total', 'Events dropped due to a full ingest queue',
+                    lambda: self.__drop_count)
+        ]
+
     def report_status(self):
         return {
             'started': format_timestamp(self.__started),
             'latest_error': {
                 'timestamp': format_timestamp(self.__last_error_ts),
                 'message': self.__last_error
+            },
+            'flushes': {
+                'count': self.__flush_count,
+                'documents': self.__flushed_docs,
+                'failed_documents': self.__failed_docs,
+                'latest_batch_size': self.__last_batch_size,
+                'average_batch_size': float(self.__flushed_docs) / self.__flush_count if self.__flush_count else None,
+                'latest_latency_ms': format_duration(self.__last_flush_latency),
+                'average_latency_ms': format_duration(
+                    self.__total_flush_latency / self.__flush_count if self.__flush_count else None
+                ),
+                'max_latency_ms': format_duration(self.__max_flush_latency)
+            },
+            'spool': {
+                'pending_segments': self.spool.segment_count if self.spool is not None else None,
+                'spooled': self.__spooled,
+                'replayed': self.__replayed,
+                'dropped_segments': self.__spool_drops
+            },
+            'queue': {
+                'depth': self.queue.depth if self.queue is not None else None,
+                'dropped_events': self.__drop_count,
+                'average_wait_ms': format_duration(
+                    self.__total_wait / self.__wait_count if self.__wait_count else None
+                ),
+                'max_wait_ms': format_duration(self.__max_wait)
             }
         }
 
@@ -43,13 +113,60 @@ class RecorderMonitor(Monitor):
 
     def record_success(self):
         with self.__lock:
+            changed = self.__in_error
             self.__in_error = False
+        if changed:
+            self.notify_health()
 
     def record_error(self, message):
         with self.__lock:
+            changed = not self.__in_error
             self.__in_error = True
             self.__last_error = message
             self.__last_error_ts = time.time()
+        if changed:
+            self.notify_health()
+
+    def record_flush(self, size, latency, failed):
+        """
+        Record a completed bulk flush
+        :param size: Number of documents in the flushed batch
+        :param latency: Time in seconds it took to flush the batch
+        :param failed: Number of documents in the batch that failed
+        :return: None
+        """
+        with self.__lock:
+            self.__flush_count += 1
+            self.__flushed_docs += size
+            self.__failed_docs += failed
+            self.__last_batch_size = size
+            self.__last_flush_latency = latency
+            self.__total_flush_latency += latency
+            if self.__max_flush_latency is None or latency > self.__max_flush_latency:
+                self.__max_flush_latency = latency
+
+    def record_spooled(self, count):
+        with self.__lock:
+            self.__spooled += count
+
+    def record_replayed(self, count):
+        with self.__lock:
+            self.__replayed += count
+
+    def record_spool_drop(self):
+        with self.__lock:
+            self.__spool_drops += 1
+
+    def record_drop(self):
+        with self.__lock:
+            self.__drop_count += 1
+
+    def record_wait(self, wait):
+        with self.__lock:
+            self.__wait_count += 1
+            self.__total_wait += wait
+            if self.__max_wait is None or wait > self.__max_wait:
+                self.__max_wait = wait
 
 
 class Recorder:
@@ -68,6 +185,78 @@ class Recorder:
     def record(self, event):
         raise NotImplementedError
 
+    def close(self):
+        """
+        Release any resources held by the recorder, recorders buffering events are expected to flush them
+        :return: None
+        """
+        pass
+
+
+class BulkBuffer:
+    """
+        Thread safe buffer accumulating bulk items until either the document count, byte size or age limit is reached,
+        at which point the accumulated batch is handed to the flush function
+    """
+
+    def __init__(self, max_docs, max_bytes, max_age, flush):
+        self.__max_docs = max_docs
+        self.__max_bytes = max_bytes
+        self.__max_age = max_age
+        self.__flush = flush
+        self.__lock = threading.Lock()
+        self.__items = []
+        self.__bytes = 0
+        self.__oldest = None
+        self.__closed = threading.Event()
+        self.__flusher = threading.Thread(name='BulkBufferFlusher', target=self.__flush_aged)
+        self.__flusher.daemon = True
+        self.__flusher.start()
+
+    def __take(self):
+        batch = self.__items
+        self.__items = []
+        self.__bytes = 0
+        self.__oldest = None
+        return batch
+
+    def __flush_aged(self):
+        while not self.__closed.wait(min(self.__max_age, 1.0) / 2):
+            with self.__lock:
+                if self.__oldest is None or time.time() - self.__oldest < self.__max_age:
+                    continue
+                batch = self.__take()
+            self.__flush(batch)
+
+    def add(self, item, size):
+        """
+        Add an item to the buffer, flushing the buffer on the calling thread if a size limit was reached
+        :param item: Item to be buffered
+        :param size: Size of the item in bytes
+        :return: None
+        """
+        batch = None
+        with self.__lock:
+            if self.__oldest is None:
+                self.__oldest = time.time()
+            self.__items.append(item)
+            self.__bytes += size
+            if len(self.__items) >= self.__max_docs or self.__bytes >= self.__max_bytes:
+                batch = self.__take()
+        if batch is not None:
+            self.__flush(batch)
+
+    def close(self):
+        """
+        Stop the age based flushing and flush whatever is left in the buffer
+        :return: None
+        """
+        self.__closed.set()
+        with self.__lock:
+            batch = self.__take()
+        if batch:
+            self.__flush(batch)
+
 
 class STDOUTRecorder(Recorder):
     """
@@ -82,68 +271,270 @@ class STDOUTRecorder(Recorder):
 
 class ESRecorder(Recorder):
     """
-        Recorder implementation that records any received events to the configured Elasticsearch index
+        Recorder implementation that records any received events to the configured Elasticsearch index. When batching
+        is configured the events are buffered and written using the bulk API instead of one request per event. When
+        spooling is configured events that could not be written due to the backend being unavailable are spooled to
+        disk and replayed once the backend is available again
     """
 
     # ES document type name
     __DOCUMENT_TYPE = 'event'
 
-    # The ES index where incoming events will be recorded to
-    __idx = ''
-
     def __init__(self, config, monitor):
         self.__esc = Elasticsearch(config.hosts)
-        self.__idx = config.index
+        self.__indices = IndexManager(self.__esc, config)
         self.__monitor = monitor
+        self.__buffer = None
+        self.__spool = None
+        self.__replayer = None
+        self.__backend_down = False
+        # Held deciding whether to spool and resuming writing to the backend once the spool has been replayed
+        self.__spool_lock = threading.RLock()
+        self.__payload_storage = config.payload_storage
+        self.__topic_payload_storage = config.topic_payload_storage
+        if config.spooling:
+            self.__spool = Spool(config.spool_directory, config.spool_segment_size, config.spool_max_segments,
+                                 monitor, config.spool_fsync)
+            self.__replayer = SpoolReplayer(self.__spool, self.__probe, self.__replay, config.spool_replay_rate,
+                                            config.spool_retry_interval, self.__resume)
+            monitor.spool = self.__spool
+            # Events left spooled by a previous run are replayed before new events are written
+            self.__backend_down = self.__spool.pending
+            self.__replayer.start()
+        if config.batching:
+            self.__buffer = BulkBuffer(config.batch_size, config.batch_bytes, config.batch_age, self.__flush)
         Recorder.__init__(self, config, monitor)
 
     def initialize(self):
-        # Ensure index exists
-        if not self.__esc.indices.exists(self.__idx):
-            index_config = {
-                'mappings': {
-                    'event': {
-                        'properties': {
-                            'destination_topic': {'type': 'text'},
-                            'payload': {'type': 'text'},
-                            'deserialized_payload': {'type': 'nested'},
-                            'received': {'type': 'date'}
-                        }
-                    }
-                }
-            }
-            self.__esc.indices.create(self.__idx, body=index_config)
+        self.__indices.initialize()
+
+    def __make_document(self, event, received):
+        # type: (Event, float) -> dict
+        """
+        Put together the document to be stored, the payload is stored as configured for the topic of the event
+        """
+        mode, compress = self.__topic_payload_storage.get(event.destination_topic, self.__payload_storage)
+        doc = {
+            'destination_topic': event.destination_topic,
+            'received': format_timestamp(received)  # ES takes long ms level epoch timestamps
+        }
+
+        if mode != PAYLOAD_RAW:
+            # Try unmarshalling the event before sticking it into storage, might derive additional value from
+            # being able to inspect the event in storage
+            doc['deserialized_payload'] = None
+            try:
+                doc['deserialized_payload'] = codec.loads(event.payload)
+            except codec.DecodeError:
+                mode = PAYLOAD_RAW  # Never lose a payload that can't be parsed
+
+        if mode != PAYLOAD_PARSED:
+            payload = event.payload
+            if compress:
+                payload = zlib.compress(payload)
+                doc['payload_compression'] = 'zlib'
+            doc['payload'] = base64.b64encode(payload)
+
+        return doc
+
+    def __bulk_item(self, message_id, index, doc):
+        """
+        Serialize the document into a (message id, action line, source line) bulk item
+        """
+        action = codec.dumps({'index': {'_index': index, '_type': self.__DOCUMENT_TYPE, '_id': message_id}})
+        return message_id, action, codec.dumps(doc)
 
     def record(self, event):
         # type: (Event) -> None
         logger.debug('recording event %s', event.message_id)
 
-        # Try unmarshalling the event before sticking it into storage, might derive additional value from
-        # being able to inspect the event in storage
-        payload = None
-        try:
-            payload = json.loads(event.payload)
-        except ValueError:
-            pass
+        received = time.time()
+        index = self.__indices.index_for(received, provision=not self.__backend_down)
+        doc = self.__make_document(event, received)
 
-        try:
-            doc = {
-                'destination_topic': event.destination_topic,
-                'payload': base64.b64encode(event.payload),
-                'deserialized_payload': payload,
-                'received': format_timestamp(time.time())  # ES takes long ms level epoch timestamps
-            }
+        if self.__backend_down:
+            # Don't bother the backend until the replayer has replayed the spool, events are written in order
+            with self.__spool_lock:
+                if self.__backend_down:
+                    self.__spool_items([self.__bulk_item(event.message_id, index, doc)])
+                    return
 
-            self.__esc.index(self.__idx, self.__DOCUMENT_TYPE, doc, id=event.message_id)
+        if self.__buffer is not None:
+            item = self.__bulk_item(event.message_id, index, doc)
+            self.__buffer.add(item, len(item[1]) + len(item[2]) + 2)
+            return
+
+        try:
+            self.__esc.index(index, self.__DOCUMENT_TYPE, doc, id=event.message_id)
             logger.debug('recorded event %s', event.message_id)
             self.__monitor.record_success()
         except TransportError as e:
             self.__monitor.record_error(e.error)
+            if self.__spool is not None and is_retriable_status(e.status_code):
+                self.__spool_items([self.__bulk_item(event.message_id, index, doc)], backend_down=True)
+                return
             raise ElasticsearchException(e.error)
         except ElasticsearchException as e:
             self.__monitor.record_error(e.message)
             raise
 
+    def __spool_items(self, items, backend_down=False):
+        """
+        :param backend_down: Whether to spool the events to come too until the spool has been replayed
+        """
+        logger.warn('spooling %d events until the backend is available', len(items))
+        with self.__spool_lock:
+            if backend_down:
+                self.__backend_down = True
+            self.__spool.append(['{}\t{}'.format(action, source) for _, action, source in items])
+        self.__monitor.record_spooled(len(items))
+
+    def __flush(self, batch):
+        """
+        Write a batch of buffered items using the bulk API, failures are handled per item as the batch may have been
+        only partially accepted
+        :param batch: list of (message id, action line, source line) tuples
+        :return: None
+        """
+        started = time.time()
+        failed = 0
+        retry = []
+        backend_down = False
+        try:
+            body = ''.join('{}\n{}\n'.format(action, source) for _, action, source in batch)
+            result = self.__esc.bulk(body)
+            if result.get('errors'):
+                for bulk_item, item in zip(batch, result['items']):
+                    outcome = item.get('index', {})
+                    status = outcome.get('status', 500)
+                    if status < 300:
+                        continue
+                    if self.__spool is not None and is_retriable_status(status):
+                        retry.append(bulk_item)
+                        continue
+                    failed += 1
+                    logger.error('failed recording event %s due to error: %s', bulk_item[0], outcome.get('error'))
+                    self.__monitor.record_error(str(outcome.get('error')))
+        except TransportError as e:
+            logger.error('failed recording a batch of %d events due to error: %s', len(batch), e.error)
+            self.__monitor.record_error(e.error)
+            if self.__spool is not None and is_retriable_status(e.status_code):
+                backend_down = True
+                retry = batch
+            else:
+                failed = len(batch)
+        except ElasticsearchException as e:
+            failed = len(batch)
+            logger.error('failed recording a batch of %d events due to error: %s', failed, e.message)
+            self.__monitor.record_error(e.message)
+
+        if retry:
+            self.__spool_items(retry, backend_down)
+        if failed == 0 and not retry:
+            logger.debug('recorded a batch of %d events', len(batch))
+            self.__monitor.record_success()
+        self.__monitor.record_flush(len(batch), time.time() - started, failed)
+
+    def __probe(self):
+        return self.__esc.ping()
+
+    def __resume(self):
+        """
+        Write new events to the backend again once the events spooled while the spool was being replayed are few enough
+        to be replayed holding the lock, the events to come waiting for them
+        """
+        with self.__spool_lock:
+            tail = self.__spool.tail
+            if tail is None or tail > REPLAY_BATCH_SIZE:
+                return False
+            seq = self.__spool.oldest()
+            if seq is not None:
+                entries = list(self.__spool.read(seq))
+                if entries:
+                    self.__replay(entries)
+                self.__spool.release(seq)
+            self.__backend_down = False
+            return True
+
+    def __replay(self, entries):
+        """
+        Write spooled entries using the bulk API, raising if any of them should be retried later
+        :param entries: list of spooled entries
+        :return: None
+        """
+        self.__indices.ensure_template()
+        result = self.__esc.bulk(''.join(entry.replace('\t', '\n', 1) + '\n' for entry in entries))
+        if result.get('errors'):
+            for item in result['items']:
+                outcome = item.get('index', {})
+                status = outcome.get('status', 500)
+                if status < 300:
+                    continue
+                if is_retriable_status(status):
+                    raise ElasticsearchException('replaying event {} failed with status {}'.format(
+                        outcome.get('_id'), status))
+                logger.error('dropping spooled event %s due to error: %s', outcome.get('_id'), outcome.get('error'))
+                self.__monitor.record_error(str(outcome.get('error')))
+        self.__monitor.record_replayed(len(entries))
+
+    def close(self):
+        if self.__buffer is not None:
+            self.__buffer.close()
+        if self.__replayer is not None:
+            self.__replayer.stop()
+            self.__spool.close()
+        self.__indices.stop()
+
+
+class FileRecorder(Recorder):
+    """
+        Recorder implementation that archives received events as JSON Lines to rotating compressed segment files
+        in the configured directory
+    """
+
+    def __init__(self, config, monitor):
+        self.__monitor = monitor
+        self.__archive = ArchiveWriter(config.directory, config.segment_size, config.max_segments,
+                                       config.compression_level)
+        self.__buffer = BulkBuffer(sys.maxint, config.block_size, config.block_age, self.__write)
+        Recorder.__init__(self, config, monitor)
+
+    def record(self, event):
+        # type: (Event) -> None
+        logger.debug('recording event %s', event.message_id)
+        received = format_timestamp(time.time())
+        line = codec.dumps({
+            'message_id': event.message_id,
+            'destination_topic': event.destination_topic,
+            'payload': base64.b64encode(event.payload),
+            'received': received
+        })
+        self.__buffer.add((received, event.destination_topic, line), len(line) + 1)
+
+    def __write(self, block):
+        started = time.time()
+        try:
+            self.__archive.write_block(block)
+            self.__monitor.record_success()
+            self.__monitor.record_flush(len(block), time.time() - started, 0)
+        except (IOError, OSError) as e:
+            logger.error('failed archiving a block of %d events due to error: %s', len(block), e)
+            self.__monitor.record_error(str(e))
+            self.__monitor.record_flush(len(block), time.time() - started, len(block))
+
+    def close(self):
+        self.__buffer.close()
+        self.__archive.close()
+
+
+def is_retriable_status(status):
+    """
+    Whether a request that failed with the status might succeed later, connection errors carry no status code
+    :param status: Status code of the failed request
+    :return: Boolean
+    """
+    return not isinstance(status, int) or status == 429 or status >= 500
+
 
 def initialize_recorder(name, config, monitor):
     # type: (str, RecorderConfig, RecorderMonitor) -> Recorder
@@ -155,7 +546,11 @@ def initialize_recorder(name, config, monitor):
     :param monitor: Recorder monitor to monitor the recorder
     :return: Recorder implementation instance
     """
-    recorder = {RECORDER_ELASTICSEARCH: ESRecorder, RECORDER_STDOUT: STDOUTRecorder}[name](config, monitor)
+    recorder = {
+        RECORDER_ELASTICSEARCH: ESRecorder,
+        RECORDER_FILE: FileRecorder,
+        RECORDER_STDOUT: STDOUTRecorder
+    }[name](config, monitor)
     if recorder.requires_initialization:
         recorder.initialize()
     return recorder
@@ -0,0 +1,177 @@
+import fnmatch
+import logging
+import re
+import threading
+import time
+import zlib
+
+from dxlclient.message import Event
+
+from robobluekit import Monitor, codec
+from robobluekit.kit import format_timestamp
+from robobluekit.metrics import Counter
+
+from .config import RuleConfig, ACTION_DROP, ACTION_SAMPLE
+
+logger = logging.getLogger(__name__)
+
+
+class RuleMonitor(Monitor):
+
+    def __init__(self, name):
+        self.__lock = threading.Lock()
+        self.__hit_count = 0
+        self.__dropped_count = 0
+        self.__latest_hit = None
+        Monitor.__init__(self, name)
+
+    def record_hit(self, recorded):
+        with self.__lock:
+            self.__latest_hit = time.time()
+            self.__hit_count += 1
+            if not recorded:
+                self.__dropped_count += 1
+
+    @property
+    def healthy(self):
+        return None
+
+    @property
+    def metrics(self):
+        return [
+            Counter('dxlhistorian_rule_hits_total', 'Events matched by the rule', lambda: self.__hit_count),
+            Counter('dxlhistorian_rule_drops_total', 'Events matched and dropped by the rule',
+                    lambda: self.__dropped_count)
+        ]
+
+    def report_status(self):
+        return {
+            'latest_hit': format_timestamp(self.__latest_hit),
+            'hit_count': self.__hit_count,
+            'recorded_count': self.__hit_count - self.__dropped_count,
+            'dropped_count': self.__dropped_count
+        }
+
+
+class Rule:
+    """
+        Rule compiled from its configuration, deciding whether the events it matches are recorded
+    """
+
+    def __init__(self, config, monitor):
+        # type: (RuleConfig, RuleMonitor) -> None
+        self.name = config.name
+        self.__monitor = monitor
+        self.__topics = re.compile('|'.join(fnmatch.translate(t) for t in config.topics)) if config.topics else None
+        self.__field = config.field.split('.') if config.field is not None else None
+        self.__equals = config.equals
+        self.__matches = re.compile(config.matches) if config.matches is not None else None
+        self.__action = config.action
+        # Sampling compares a hash of the message id against the threshold so that every historian instance samples
+        # the same events
+        self.__threshold = int(config.sample_rate * 2 ** 32)
+
+    @property
+    def examines_payload(self):
+        return self.__field is not None
+
+    def applies_to(self, topic):
+        return self.__topics is None or self.__topics.match(topic) is not None
+
+    def matches(self, payload):
+        """
+        Evaluate the field predicate of the rule against the parsed payload
+        :param payload: Parsed payload, None when the payload isn't a JSON object
+        :return: Boolean indicating a match
+        """
+        if self.__field is None:
+            return True
+        value = payload
+        for key in self.__field:
+            if not isinstance(value, dict) or key not in value:
+                return False
+            value = value[key]
+        if self.__equals is None and self.__matches is None:
+            # Presence of the field is enough
+            return True
+        value = value if isinstance(value, basestring) else codec.dumps(value)
+        if self.__equals is not None and value != self.__equals:
+            return False
+        return self.__matches is None or self.__matches.search(value) is not None
+
+    def apply(self, event):
+        # type: (Event) -> bool
+        """
+        Apply the rule's action to a matched event
+        :param event: The matched event
+        :return: Boolean indicating whether the event should be recorded
+        """
+        if self.__action == ACTION_DROP:
+            record = False
+        elif self.__action == ACTION_SAMPLE:
+            record = zlib.crc32(event.message_id) & 0xffffffff < self.__threshold
+        else:
+            record = True
+        self.__monitor.record_hit(record)
+        return record
+
+
+class RuleSet:
+    """
+        RuleSet evaluates the rules in their configured order, the first matching rule decides the fate of the event.
+        Events not matched by any rule are recorded. The rules applying to a topic are resolved once per topic and the
+        payload is only parsed when one of them examines it
+    """
+
+    # Marker of a payload that hasn't been parsed yet, None being the result of a payload that failed to parse
+    __UNPARSED = object()
+
+    # Bound on the number of topics with resolved rules, wildcard subscriptions may deliver any number of topics
+    __CACHE_SIZE = 1024
+
+    def __init__(self, rules):
+        # type: (list) -> None
+        self.__rules = rules
+        self.__by_topic = {}
+
+    @staticmethod
+    def compile(configs, register_monitor):
+        """
+        Compile the configured rules
+        :param configs: list of RuleConfig
+        :param register_monitor: function for registering monitors with the monitoring context
+        :return: The RuleSet
+        """
+        return RuleSet([
+            Rule(config, register_monitor(RuleMonitor('rules.{}'.format(config.name)))) for config in configs
+        ])
+
+    def __rules_for(self, topic):
+        rules = self.__by_topic.get(topic)
+        if rules is None:
+            if len(self.__by_topic) >= self.__CACHE_SIZE:
+                self.__by_topic = {}
+            rules = [rule for rule in self.__rules if rule.applies_to(topic)]
+            self.__by_topic[topic] = rules
+        return rules
+
+    def should_record(self, event):
+        # type: (Event) -> bool
+        """
+        Decide whether the event should be recorded
+        :param event: The received event
+        :return: Boolean
+        """
+        rules = self.__rules_for(event.destination_topic)
+        if not rules:
+            return True
+        payload = self.__UNPARSED
+        for rule in rules:
+            if rule.examines_payload and payload is self.__UNPARSED:
+                try:
+                    payload = codec.loads(event.payload)
+                except codec.DecodeError:
+                    payload = None
+            if rule.matches(payload):
+                return rule.apply(event)
+        return True
@@ -0,0 +1,339 @@
+import base64
+import logging
+import threading
+import time
+import uuid
+import zlib
+
+from dxlclient.callbacks import RequestCallback
+from dxlclient.message import Response, ErrorResponse
+from dxlclient.service import ServiceRegistrationInfo
+from elasticsearch import Elasticsearch, TransportError, ElasticsearchException
+
+from robobluekit import codec
+from robobluekit.drain import InFlight
+from robobluekit.dxl import MonitorableDxlClient
+from robobluekit.kit import ServiceEndpointMonitor, format_timestamp
+
+from .config import QueryServiceConfig
+from .index import IndexManager
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    """
+    Exception indicating that the user's at fault for providing invalid input
+    """
+    pass
+
+
+class TooManyCursors(Exception):
+    """
+    Exception indicating that the maximum number of open cursors has been reached
+    """
+    pass
+
+
+class CursorRegistry:
+    """
+        CursorRegistry pages through query results using Elasticsearch scroll contexts. Each open scroll context is
+        represented by a cursor handed out to the client, the number of open cursors is capped and idle cursors are
+        closed after the configured timeout
+    """
+
+    def __init__(self, esc, index, max_cursors, timeout):
+        # type: (Elasticsearch, str, int, int) -> None
+        self.__esc = esc
+        self.__index = index
+        self.__max_cursors = max_cursors
+        self.__timeout = timeout
+        self.__keep_alive = '{}s'.format(timeout)
+        self.__lock = threading.Lock()
+        self.__cursors = {}  # cursor -> (scroll id or None while in use, last used)
+
+    def __expire(self):
+        """
+        Close cursors that have been idle for longer than the timeout
+        """
+        now = time.time()
+        with self.__lock:
+            expired = [c for c, (scroll_id, used) in self.__cursors.items()
+                       if scroll_id is not None and now - used > self.__timeout]
+            scroll_ids = [self.__cursors.pop(c)[0] for c in expired]
+        if scroll_ids:
+            logger.debug('expiring %d idle cursors', len(scroll_ids))
+            self.__esc.clear_scroll(body={'scroll_id': scroll_ids}, ignore=404)
+
+    def __reserved(self, cursor):
+        """
+        Whether the cursor is reserved by a running request, to be called holding the lock
+        """
+        return cursor in self.__cursors and self.__cursors[cursor][0] is None
+
+    def __page(self, result, cursor):
+        """
+        Turn the search result into a page, keeping the cursor open while there's more to come
+        """
+        hits = result['hits']['hits']
+        scroll_id = result.get('_scroll_id')
+        with self.__lock:
+            # A cursor closed while the request was running stays closed
+            keep = len(hits) > 0 and scroll_id is not None and self.__reserved(cursor)
+            if keep:
+                self.__cursors[cursor] = (scroll_id, time.time())
+            else:
+                self.__cursors.pop(cursor, None)
+        if not keep:
+            cursor = None
+            if scroll_id is not None:
+                self.__esc.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=404)
+        return {
+            'total': result['hits']['total'],
+            'events': [to_event(hit) for hit in hits],
+            'cursor': cursor
+        }
+
+    def open(self, query, size):
+        """
+        Run the query and return its first page
+        :param query: Elasticsearch query
+        :param size: Page size
+        :return: The page
+        """
+        self.__expire()
+        cursor = uuid.uuid4().hex
+        with self.__lock:
+            if len(self.__cursors) >= self.__max_cursors:
+                raise TooManyCursors('maximum number of open cursors reached, close unused cursors or retry later')
+            # Reserve the slot while the search runs
+            self.__cursors[cursor] = (None, time.time())
+        try:
+            result = self.__esc.search(index=self.__index, scroll=self.__keep_alive, size=size, body={
+                'query': query,
+                'sort': [{'received': 'asc'}]
+            })
+        except BaseException:
+            with self.__lock:
+                self.__cursors.pop(cursor, None)
+            raise
+        return self.__page(result, cursor)
+
+    def fetch(self, cursor):
+        """
+        Return the next page of an open cursor
+        :param cursor: The cursor
+        :return: The page
+        """
+        self.__expire()
+        with self.__lock:
+            if cursor not in self.__cursors:
+                raise BadRequest('unknown or expired cursor')
+            scroll_id, _ = self.__cursors[cursor]
+            if scroll_id is None:
+                raise BadRequest('cursor is in use by another request')
+            self.__cursors[cursor] = (None, time.time())
+        try:
+            result = self.__esc.scroll(scroll_id=scroll_id, scroll=self.__keep_alive)
+        except BaseException:
+            with self.__lock:
+                if self.__reserved(cursor):
+                    self.__cursors[cursor] = (scroll_id, time.time())
+            raise
+        return self.__page(result, cursor)
+
+    def close(self, cursor=None):
+        """
+        Close the cursor, or all cursors when none is given
+        :param cursor: The cursor
+        :return: None
+        """
+        with self.__lock:
+            if cursor is None:
+                scroll_ids = [scroll_id for scroll_id, _ in self.__cursors.values()]
+                self.__cursors.clear()
+            else:
+                scroll_ids = [self.__cursors.pop(cursor, (None, None))[0]]
+        scroll_ids = [s for s in scroll_ids if s is not None]
+        if scroll_ids:
+            self.__esc.clear_scroll(body={'scroll_id': scroll_ids}, ignore=404)
+
+
+def to_event(hit):
+    """
+    Turn a search hit into the event representation handed out to clients, the raw payload is always base64 encoded
+    and never compressed
+    :param hit: Search hit
+    :return: dict
+    """
+    source = hit['_source']
+    event = {
+        'message_id': hit['_id'],
+        'destination_topic': source.get('destination_topic'),
+        'received': source.get('received')
+    }
+    if 'deserialized_payload' in source:
+        event['deserialized_payload'] = source['deserialized_payload']
+    if source.get('payload') is not None:
+        event['payload'] = source['payload']
+        if source.get('payload_compression') == 'zlib':
+            event['payload'] = base64.b64encode(zlib.decompress(base64.b64decode(source['payload'])))
+    return event
+
+
+class QueryServiceEndpoint(RequestCallback):
+    """
+    A generic wrapping endpoint taking care of error handling and monitoring of the query service endpoints
+    """
+
+    def __init__(self, monitor, service):
+        # type: (ServiceEndpointMonitor, QueryService) -> None
+        self.__monitor = monitor
+        self.service = service
+        RequestCallback.__init__(self)
+
+    def on_request(self, request):
+        in_flight = self.service.in_flight
+        in_flight.enter()
+        received = self.__monitor.register_request()
+        if not self.__monitor.submit(in_flight.run, self.__dispatch, request, received):
+            # Shed the load rather than queue up requests the endpoint can't get to in time
+            self.__monitor.register_error(received)
+            in_flight.run(self.service.dxl.send_response,
+                          ErrorResponse(request, 503, 'service endpoint overloaded, try again later'))
+
+    def __dispatch(self, request, received):
+        response = Response(request)
+        try:
+            payload = codec.loads(request.payload) if request.payload else {}
+            if not isinstance(payload, dict):
+                raise BadRequest('request payload must be a JSON object')
+            response.payload = codec.dumps(self.handle_request(payload))
+        except BadRequest as e:
+            response = ErrorResponse(request, 400, str(e))
+        except codec.DecodeError:
+            response = ErrorResponse(request, 400, 'request payload must be a well formed JSON string')
+        except TooManyCursors as e:
+            response = ErrorResponse(request, 503, str(e))
+        except TransportError as e:
+            logger.error('failed querying Elasticsearch: %s', e.error)
+            response = ErrorResponse(request, 400 if e.status_code == 400 else 502, 'query failed: {}'.format(e.error))
+        except ElasticsearchException as e:
+            logger.error('failed querying Elasticsearch: %s', e)
+            response = ErrorResponse(request, 502, 'query failed: {}'.format(str(e)))
+        except Exception as e:
+            logger.exception('unknown exception %s of type %s', str(e), type(e).__name__)
+            response = ErrorResponse(request, 500, 'unknown internal error occurred')
+        finally:
+            if isinstance(response, ErrorResponse) and response.error_code >= 500:
+                # Error count doesn't include client errors
+                self.__monitor.register_error(received)
+            else:
+                self.__monitor.register_success(received)
+            self.service.dxl.send_response(response)
+
+    def handle_request(self, payload):
+        # type: (dict) -> dict
+        raise NotImplementedError('requires implementation')
+
+
+class Query(QueryServiceEndpoint):
+    """
+    Service endpoint running a query for events by topic, time range and message id, responding with the first page
+    """
+
+    def handle_request(self, payload):
+        filters = []
+        if payload.get('topic') is not None:
+            filters.append({'term': {'destination_topic.keyword': payload['topic']}})
+        if payload.get('message_id') is not None:
+            filters.append({'ids': {'values': [payload['message_id']]}})
+        if payload.get('from') is not None or payload.get('to') is not None:
+            received = {}
+            try:
+                if payload.get('from') is not None:
+                    received['gte'] = format_timestamp(float(payload['from']))
+                if payload.get('to') is not None:
+                    received['lt'] = format_timestamp(float(payload['to']))
+            except (TypeError, ValueError):
+                raise BadRequest('from and to must be unix timestamps')
+            filters.append({'range': {'received': received}})
+
+        size = payload.get('page_size', self.service.config.max_page_size)
+        # JSON true and false decode to bools, which are ints too
+        if isinstance(size, bool) or not isinstance(size, int) or not 0 < size <= self.service.config.max_page_size:
+            raise BadRequest('page_size must be between 1 and {}'.format(self.service.config.max_page_size))
+
+        return self.service.cursors.open({'bool': {'filter': filters}}, size)
+
+
+class Fetch(QueryServiceEndpoint):
+    """
+    Service endpoint responding with the next page of results of an open cursor
+    """
+
+    def handle_request(self, payload):
+        if not isinstance(payload.get('cursor'), basestring):
+            raise BadRequest('missing cursor')
+        return self.service.cursors.fetch(payload['cursor'])
+
+
+class Close(QueryServiceEndpoint):
+    """
+    Service endpoint closing an open cursor before it is exhausted
+    """
+
+    def handle_request(self, payload):
+        if not isinstance(payload.get('cursor'), basestring):
+            raise BadRequest('missing cursor')
+        self.service.cursors.close(payload['cursor'])
+        return {'cursor': None}
+
+
+# Listing of endpoints provided by the service
+SERVICE_ENDPOINTS = [
+    ('Query', Query),
+    ('Fetch', Fetch),
+    ('Close', Close)
+]
+
+
+class QueryService:
+    """
+    The query service answering queries about the recorded events on the OpenDXL fabric
+    """
+
+    def __init__(self, config, dxl, register_monitor):
+        # type: (QueryServiceConfig, MonitorableDxlClient, callable) -> None
+        self.config = config
+        self.dxl = dxl
+        # Counted apart from the client, which the endpoints of a replacing query service share
+        self.in_flight = InFlight()
+        self.__register_monitor = register_monitor
+        esc = Elasticsearch(config.elasticsearch.hosts)
+        self.cursors = CursorRegistry(esc, IndexManager(esc, config.elasticsearch).search_pattern,
+                                      config.max_cursors, config.cursor_timeout)
+        self.__registration = None
+
+    def register(self):
+        registration = ServiceRegistrationInfo(self.dxl, self.config.type)
+        for name, constructor in SERVICE_ENDPOINTS:
+            topic = '{}/{}'.format(self.config.type, name)
+            registration.add_topic(topic,
+                                   constructor(self.__register_monitor(ServiceEndpointMonitor('endpoints.' + topic)),
+                                               self))
+        self.dxl.register_service_sync(registration, 2)
+        self.__registration = registration
+        logger.info('registered dxlhistorian query service %s', self.config.type)
+
+    def unregister(self):
+        if self.__registration is not None:
+            self.dxl.unregister_service_sync(self.__registration, 2)
+            self.__registration = None
+            logger.info('unregistered dxlhistorian query service %s', self.config.type)
+
+    def close(self):
+        try:
+            self.cursors.close()
+        except ElasticsearchException as e:
+            logger.error('failed closing open cursors: %s', e)
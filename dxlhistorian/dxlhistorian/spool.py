@@ -0,0 +1,246 @@
+import collections
+import glob
+import logging
+import os
+import os.path as path
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bound of entries replayed using a single write
+REPLAY_BATCH_SIZE = 500
+
+
+class Spool:
+    """
+        Spool is a durable, append-only store of entries kept in a directory of size bounded segment files. Entries
+        are single line strings, segments are consumed in the order they were written and removed once consumed. When
+        the configured number of segments is exceeded the oldest segment is dropped. Segments are synced to disk when
+        sealed, and on every append unless fsync is turned off
+    """
+
+    __SEGMENT_FORMAT = 'segment-{:020d}.spool'
+
+    def __init__(self, directory, segment_size, max_segments, monitor, fsync=True):
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__max_segments = max_segments
+        self.__monitor = monitor
+        self.__fsync = fsync
+        self.__lock = threading.Lock()
+        self.__active = None
+        self.__active_seq = None
+        self.__active_size = 0
+        self.__active_count = 0
+
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+        # Pick up any segments left over from a previous run, these are replayed first
+        self.__segments = collections.deque(sorted(
+            int(path.basename(p)[len('segment-'):-len('.spool')])
+            for p in glob.glob(path.join(directory, 'segment-*.spool'))
+        ))
+        self.__next_seq = self.__segments[-1] + 1 if self.__segments else 0
+        if self.__segments:
+            logger.info('found %d spooled segments in %s', len(self.__segments), directory)
+
+    def __path(self, seq):
+        return path.join(self.__directory, self.__SEGMENT_FORMAT.format(seq))
+
+    def __sync_directory(self):
+        # The entry of a new segment in the directory is synced apart from the segment
+        fd = os.open(self.__directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __seal(self):
+        """
+        Close the active segment making it available for consumption, expects the lock to be held
+        :return: None
+        """
+        self.__active.flush()
+        os.fsync(self.__active.fileno())
+        self.__active.close()
+        self.__segments.append(self.__active_seq)
+        self.__active = None
+        self.__active_seq = None
+        self.__active_size = 0
+        self.__active_count = 0
+
+        while len(self.__segments) > self.__max_segments:
+            seq = self.__segments.popleft()
+            logger.error('spool exceeded %d segments, dropping segment %d', self.__max_segments, seq)
+            os.remove(self.__path(seq))
+            self.__monitor.record_spool_drop()
+
+    @property
+    def pending(self):
+        return len(self.__segments) > 0 or self.__active_size > 0
+
+    @property
+    def tail(self):
+        """
+        Number of entries in the active segment when no sealed segments are left, None otherwise
+        """
+        with self.__lock:
+            return self.__active_count if not self.__segments else None
+
+    @property
+    def segment_count(self):
+        return len(self.__segments) + (1 if self.__active is not None else 0)
+
+    def append(self, entries):
+        """
+        Append entries to the end of the spool
+        :param entries: list of single line strings
+        :return: None
+        """
+        with self.__lock:
+            for entry in entries:
+                if self.__active is None:
+                    self.__active_seq = self.__next_seq
+                    self.__next_seq += 1
+                    self.__active = open(self.__path(self.__active_seq), 'ab')
+                    if self.__fsync:
+                        self.__sync_directory()
+                self.__active.write(entry + '\n')
+                self.__active_size += len(entry) + 1
+                self.__active_count += 1
+                if self.__active_size >= self.__segment_size:
+                    self.__seal()
+            if self.__active is not None:
+                self.__active.flush()
+                if self.__fsync:
+                    os.fsync(self.__active.fileno())
+
+    def oldest(self):
+        """
+        Get the oldest segment available for consumption, sealing the active segment if need be
+        :return: Sequence number of the segment or None if the spool is empty
+        """
+        with self.__lock:
+            if not self.__segments and self.__active is not None:
+                self.__seal()
+            return self.__segments[0] if self.__segments else None
+
+    def read(self, seq):
+        """
+        Iterate over the entries of a segment
+        :param seq: Sequence number of the segment
+        :return: Generator of entries
+        """
+        with open(self.__path(seq), 'rb') as segment:
+            for line in segment:
+                if line.endswith('\n'):  # A partially written trailing line is of no use
+                    yield line[:-1]
+
+    def release(self, seq):
+        """
+        Remove a consumed segment from the spool
+        :param seq: Sequence number of the segment
+        :return: None
+        """
+        with self.__lock:
+            if self.__segments and self.__segments[0] == seq:
+                self.__segments.popleft()
+                os.remove(self.__path(seq))
+
+    def close(self):
+        with self.__lock:
+            if self.__active is not None:
+                self.__seal()
+
+
+class SpoolReplayer:
+    """
+        SpoolReplayer periodically checks whether the storage backend is available again and replays the spool in
+        order once it is. The replay rate is throttled in order not to swamp the backend with the backlog. Segments are
+        only released once fully replayed, an interrupted segment is replayed from its beginning on the next attempt so
+        the backend is expected to handle entries idempotently
+    """
+
+    def __init__(self, spool, probe, write, rate, interval, resume=None):
+        """
+        :param spool: Spool to be replayed
+        :param probe: Function reporting whether the backend is available
+        :param write: Function writing a list of entries to the backend, raising on failure
+        :param rate: Maximum number of entries replayed per second
+        :param interval: Seconds between checks for backend availability
+        :param resume: Function called once the sealed segments have been replayed for new entries to go to the
+        backend again, replaying the active segment itself. Returns False when the active segment holds too many entries
+        for that, the segment then being sealed and replayed first
+        """
+        self.__spool = spool
+        self.__probe = probe
+        self.__write = write
+        self.__resume = resume
+        self.__rate = rate
+        self.__interval = interval
+        self.__batch_size = max(1, min(REPLAY_BATCH_SIZE, int(rate)))
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(name='SpoolReplayer', target=self.__run)
+        self.__thread.daemon = True
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval):
+            if not self.__spool.pending:
+                continue
+            try:
+                if not self.__probe():
+                    continue
+            except BaseException as e:
+                logger.error('failed probing backend availability: %s', e)
+                continue
+            logger.info('backend available, replaying spooled entries')
+            self.__replay()
+
+    def __replay(self):
+        while not self.__stopped.is_set():
+            # Only the active segment is left
+            if self.__resume is not None and self.__spool.tail is not None:
+                try:
+                    if self.__resume():
+                        logger.info('finished replaying spooled entries')
+                        return
+                except BaseException as e:
+                    logger.error('failed replaying spooled entries, will retry later: %s', e)
+                    return
+            seq = self.__spool.oldest()
+            if seq is None:
+                logger.info('finished replaying spooled entries')
+                return
+            batch = []
+            for entry in self.__spool.read(seq):
+                batch.append(entry)
+                if len(batch) >= self.__batch_size:
+                    if not self.__send(batch):
+                        return
+                    batch = []
+            if batch and not self.__send(batch):
+                return
+            self.__spool.release(seq)
+
+    def __send(self, batch):
+        started = time.time()
+        try:
+            self.__write(batch)
+        except BaseException as e:
+            logger.error('failed replaying spooled entries, will retry later: %s', e)
+            return False
+
+        # Throttle to the configured rate
+        remaining = float(len(batch)) / self.__rate - (time.time() - started)
+        if remaining > 0:
+            self.__stopped.wait(remaining)
+        return not self.__stopped.is_set()
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
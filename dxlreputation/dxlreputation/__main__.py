@@ -1,6 +1,4 @@
 from .application import ReputationApplication
 
 app = ReputationApplication()
-app.bootstrap()
-app.run()
-app.destroy()
+app.main()
@@ -6,9 +6,10 @@ from dxlclient.service import ServiceRegistrationInfo
 from redis import Redis
 
 from robobluekit import Application
-from robobluekit.monitor import MonitoringContext
+from robobluekit.monitor import Registrations
 from robobluekit.dxl import MonitorableDxlClient, DxlClientMonitor
 from robobluekit.kit import ServiceEndpointMonitor, InvalidConfigException
+from robobluekit.reload import ConfigSnapshot
 
 from .config import ServiceConfig
 from .endpoint import SERVICE_ENDPOINTS
@@ -20,11 +21,24 @@ class ReputationService:
     """
     The service instance itself, encapsulates the endpoint receivers and connections
     """
-    def __init__(self, dxl_config, config, monitoring_context):
-        self.dxl_conn = MonitorableDxlClient(dxl_config, monitoring_context.register(DxlClientMonitor('connection')))
+    def __init__(self, dxl_conn, config, register_monitor, redis_conn=None):
+        """
+        :param dxl_conn: DXL client, connected by initialize
+        :param redis_conn: Redis client to reuse along with its connection pool, a new one is created when omitted
+        """
+        self.dxl_conn = dxl_conn
         self.__config = config
-        self.__monitoring_ctx = monitoring_context
-        self.redis_conn = None
+        self.__register_monitor = register_monitor
+        self.redis_conn = redis_conn
+        self.__registration = None
+
+    @staticmethod
+    def connect(dxl_config, config, register_monitor):
+        """
+        Put together a service instance with a new DXL client
+        """
+        dxl_conn = MonitorableDxlClient(dxl_config, register_monitor(DxlClientMonitor('connection')))
+        return ReputationService(dxl_conn, config, register_monitor)
 
     def __register_service(self):
         registration = ServiceRegistrationInfo(self.dxl_conn, self.__config.type)
@@ -32,17 +46,44 @@ class ReputationService:
             topic = '{}/{}'.format(self.__config.type, name)
             registration.add_topic(topic,
                                    constructor(
-                                       self.__monitoring_ctx.register(ServiceEndpointMonitor('endpoint.' + topic)),
+                                       self.__register_monitor(ServiceEndpointMonitor('endpoint.' + topic)),
                                        self))
         self.dxl_conn.register_service_sync(registration, 2)
+        self.__registration = registration
 
     def initialize(self):
         self.dxl_conn.connect()
-        redis_cfg = self.__config.redis_config
-        self.redis_conn = Redis(
-            host=redis_cfg.hostname, port=redis_cfg.port, db=redis_cfg.db, ssl=redis_cfg.use_ssl, socket_timeout=1)
+        self.register()
+
+    def register(self):
+        """
+        Register the service with the OpenDXL service fabric over the already connected client
+        :return: None
+        """
+        if self.redis_conn is None:
+            redis_cfg = self.__config.redis_config
+            self.redis_conn = Redis(
+                host=redis_cfg.hostname, port=redis_cfg.port, db=redis_cfg.db, ssl=redis_cfg.use_ssl, socket_timeout=1)
         self.__register_service()
 
+    def unregister(self):
+        """
+        Unregister the service, leaving the client connected for a replacing service instance
+        :return: None
+        """
+        if self.__registration is not None:
+            self.dxl_conn.unregister_service_sync(self.__registration, 2)
+            self.__registration = None
+
+    def drain(self, drain):
+        """
+        Unregister the service and wait for the requests in flight to be responded to, leaving the client connected
+        :param drain: robobluekit Drain bounding the wait
+        :return: None
+        """
+        self.unregister()
+        drain.wait(lambda: self.dxl_conn.in_flight.count, 'callbacks')
+
     def destroy(self):
         self.dxl_conn.disconnect()
         # Redis takes care of itself
@@ -57,6 +98,9 @@ class ReputationApplication(Application):
         self.service_config = None
         self.dxl_config = None
         self.__svc = None
+        self.__dxl_snapshot = None
+        self.__svc_snapshot = None
+        self.__registrations = None
         Application.__init__(self)
 
     def register_arguments(self):
@@ -80,13 +124,16 @@ class ReputationApplication(Application):
         logger.debug('loading configuration')
 
         logger.debug('loading dxl client configuration from %s', path.abspath(self.args.dxl_config))
+        self.__dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
         self.dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
 
         logger.debug('loading service specific configuration from %s', path.abspath(self.args.service_config))
+        self.__svc_snapshot = ConfigSnapshot(self.args.service_config)
         self.service_config = ServiceConfig(self.args.service_config)
 
     def initialize(self):
-        self.__svc = ReputationService(self.dxl_config, self.service_config, self.monitoring_context)
+        self.__registrations = Registrations(self.monitoring_context)
+        self.__svc = ReputationService.connect(self.dxl_config, self.service_config, self.__registrations.register)
         self.__svc.initialize()
 
     def reload(self):
@@ -94,6 +141,8 @@ class ReputationApplication(Application):
         logger.info('dxlreputation configuration loading from: {}'.format(path.abspath(self.args.service_config)))
 
         try:
+            new_dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
+            new_svc_snapshot = ConfigSnapshot(self.args.service_config)
             new_dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
             new_svc_config = ServiceConfig(self.args.service_config)
         except InvalidConfigException as e:
@@ -103,24 +152,58 @@ class ReputationApplication(Application):
             logger.error('failed config reload: invalid DXL client configuration')
             logger.error('dxlclient configuration error: ' + str(e))
         else:
+            dxl_changes = new_dxl_snapshot.changes(self.__dxl_snapshot)
+            svc_changes = new_svc_snapshot.changes(self.__svc_snapshot)
+            if not dxl_changes and not svc_changes:
+                logger.info('dxlclient and dxlreputation configuration unchanged, nothing to reload')
+                return
             try:
-                logger.info('began swapping out the running dxlreputation service')
-                new_monitoring_context = MonitoringContext()
-
-                new_svc = ReputationService(new_dxl_config, new_svc_config, new_monitoring_context)
-
-                new_svc.initialize()
-                self.__svc.destroy()
-
+                # Monitors of the same name carry over to the replacement
+                new_registrations = Registrations(self.monitoring_context)
+                if dxl_changes:
+                    logger.info('began swapping out the running dxlreputation service')
+                    new_svc = ReputationService.connect(new_dxl_config, new_svc_config, new_registrations.register)
+
+                    new_svc.initialize()
+                    # The replaced service responds to the requests in flight before disconnecting
+                    drain = self.start_drain('reload')
+                    self.__svc.drain(drain)
+                    drain.finish()
+                    self.__svc.destroy()
+                else:
+                    logger.info('began re-registering the dxlreputation service over the running connection')
+                    # The connection monitor stays with the running client
+                    new_registrations.register(DxlClientMonitor('connection'))
+                    # The Redis connection pool is kept unless the Redis configuration changed
+                    new_svc = ReputationService(self.__svc.dxl_conn, new_svc_config, new_registrations.register,
+                                                None if 'Redis' in svc_changes else self.__svc.redis_conn)
+
+                    # Services registered on one client share its subscriptions and callback, unregistering
+                    # either drops them for both. The running service is unregistered first, its endpoints
+                    # going unanswered until the replacement registers, and registered again should the
+                    # replacement fail to
+                    self.__svc.unregister()
+                    try:
+                        new_svc.register()
+                    except BaseException:
+                        self.__svc.register()
+                        raise
+
+                self.__registrations.release(new_registrations)
+                self.__registrations = new_registrations
                 self.__svc = new_svc
                 self.dxl_config = new_dxl_config
                 self.service_config = new_svc_config
-                self.monitoring_context = new_monitoring_context
+                self.__dxl_snapshot = new_dxl_snapshot
+                self.__svc_snapshot = new_svc_snapshot
 
             except BaseException as e:
                 logger.error('failed to swap out dxlreputation with reloaded configuration: {}'.format(e.message))
             else:
                 logger.info('reloaded dxlreputation with new configuration')
 
+    def drain(self, drain):
+        self.__svc.drain(drain)
+
     def destroy(self):
         self.__svc.destroy()
@@ -1,10 +1,11 @@
-import json
 import logging
 
 from dxlclient.callbacks import RequestCallback
 from dxlclient.message import Request, Response, ErrorResponse
 
+from robobluekit import codec
 from robobluekit.kit import run_validators, require_and_enforce_type, optional_and_enforce_type, InvalidConfigException
+from robobluekit.tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -12,7 +13,7 @@ logger = logging.getLogger(__name__)
 class ReputationServiceEndpoint(RequestCallback):
     """
     A generic wrapping endpoint that lets us focus on the happy path and the happy path alone when actually
-    implementing endpoints
+    implementing endpoints. Requests are traced, implementations time their phases with robobluekit.tracing.span
     """
 
     def __init__(self, monitor, parent):
@@ -21,24 +22,37 @@ class ReputationServiceEndpoint(RequestCallback):
         RequestCallback.__init__(self)
 
     def on_request(self, request):
-        self.__monitor.register_request()
+        in_flight = self.service.dxl_conn.in_flight
+        in_flight.enter()
+        received = self.__monitor.register_request()
+        if not self.__monitor.submit(in_flight.run, self.__dispatch, request, received):
+            # Shed the load rather than queue up requests the endpoint can't get to in time
+            self.__monitor.register_error(received)
+            in_flight.run(self.service.dxl_conn.send_response,
+                          ErrorResponse(request, 503, 'service endpoint overloaded, try again later'))
+
+    def __dispatch(self, request, received):
+        trace = self.__monitor.trace()
         response = Response(request)
         try:
             response = self.handle_request(request, response)
         except BadRequest as e:
             response = ErrorResponse(request, 400, str(e))
-        except ValueError:
+        except codec.DecodeError:
             response = ErrorResponse(request, 400, 'invalid request payload')
         except Exception as e:
             logger.exception('unknown exception %s of type %s', str(e), type(e).__name__)
             response = ErrorResponse(request, 500, 'unknown internal error occurred')
         finally:
-            if isinstance(response, ErrorResponse) and response.error_code >= 500:
+            error = isinstance(response, ErrorResponse) and response.error_code >= 500
+            if error:
                 # Error count doesn't include client errors
-                self.__monitor.register_error()
+                self.__monitor.register_error(received)
             else:
-                self.__monitor.register_success()
-            self.service.dxl_conn.send_response(response)
+                self.__monitor.register_success(received)
+            with trace.span('send'):
+                self.service.dxl_conn.send_response(response)
+            trace.finish(error)
 
     def handle_request(self, request, response):
         # type: (Request, Response) -> Response
@@ -70,19 +84,22 @@ class UpdateReputation(ReputationServiceEndpoint):
     """
 
     def handle_request(self, request, response):
-        payload = json.loads(request.payload)
-        validate_request(payload, [
-            ('type', unicode, require_and_enforce_type),
-            ('key', unicode, require_and_enforce_type),
-            ('reputation', int, optional_and_enforce_type),
-        ])
-        payload['reputation'] = self.service.redis_conn.hincrby(payload['type'], payload['key'],
-                                                                payload.get('reputation', 0))
-        response.payload = json.dumps({
-            'type': payload['type'],
-            'key': payload['key'],
-            'reputation': payload['reputation']
-        })
+        with span('parse'):
+            payload = codec.loads(request.payload)
+            validate_request(payload, [
+                ('type', unicode, require_and_enforce_type),
+                ('key', unicode, require_and_enforce_type),
+                ('reputation', int, optional_and_enforce_type),
+            ])
+        with span('redis'):
+            payload['reputation'] = self.service.redis_conn.hincrby(payload['type'], payload['key'],
+                                                                    payload.get('reputation', 0))
+        with span('serialize'):
+            response.payload = codec.dumps({
+                'type': payload['type'],
+                'key': payload['key'],
+                'reputation': payload['reputation']
+            })
         return response
 
 
@@ -92,17 +109,20 @@ class GetReputation(ReputationServiceEndpoint):
     """
 
     def handle_request(self, request, response):
-        payload = json.loads(request.payload)
-        validate_request(payload, [
-            ('type', unicode, require_and_enforce_type),
-            ('key', unicode, require_and_enforce_type)
-        ])
-        rep = self.service.redis_conn.hget(payload['type'], payload['key'])
-        response.payload = json.dumps({
-            'type': payload['type'],
-            'key': payload['key'],
-            'reputation': 0 if rep is None else int(rep)
-        })
+        with span('parse'):
+            payload = codec.loads(request.payload)
+            validate_request(payload, [
+                ('type', unicode, require_and_enforce_type),
+                ('key', unicode, require_and_enforce_type)
+            ])
+        with span('redis'):
+            rep = self.service.redis_conn.hget(payload['type'], payload['key'])
+        with span('serialize'):
+            response.payload = codec.dumps({
+                'type': payload['type'],
+                'key': payload['key'],
+                'reputation': 0 if rep is None else int(rep)
+            })
         return response
 
 
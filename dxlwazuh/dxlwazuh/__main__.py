@@ -1,6 +1,4 @@
 from .application import WazuhApplication
 
 app = WazuhApplication()
-app.bootstrap()
-app.run()
-app.destroy()
+app.main()
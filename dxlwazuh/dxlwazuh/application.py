@@ -6,8 +6,9 @@ from dxlclient.client_config import DxlClientConfig
 
 from robobluekit import Application
 from robobluekit.kit import InvalidConfigException
-from robobluekit.monitor import MonitoringContext
+from robobluekit.monitor import Registrations
 from robobluekit.dxl import MonitorableDxlClient, DxlClientMonitor
+from robobluekit.reload import ConfigSnapshot
 
 from .config import ServiceConfig, EndpointConfig
 from .switchboard import Switchboard
@@ -25,12 +26,15 @@ class WazuhApplication(Application):
         self.dxl_config = None
         self.service_config = None
         self.__sb = None
+        self.__dxl_snapshot = None
+        self.__svc_snapshot = None
+        self.__registrations = None
 
     @staticmethod
-    def __provision_switchboard(dxl_config, svc_config, monitoring_context):
-        # type: (DxlClientConfig, ServiceConfig, MonitoringContext) -> Switchboard
-        dxl_client = MonitorableDxlClient(dxl_config, monitoring_context.register(DxlClientMonitor('connection')))
-        return Switchboard(dxl_client, svc_config, monitoring_context)
+    def __provision_switchboard(dxl_config, svc_config, register_monitor):
+        # type: (DxlClientConfig, ServiceConfig, callable) -> Switchboard
+        dxl_client = MonitorableDxlClient(dxl_config, register_monitor(DxlClientMonitor('connection')))
+        return Switchboard(dxl_client, svc_config, register_monitor)
 
     def register_arguments(self):
         logger.debug('registering arguments')
@@ -51,9 +55,11 @@ class WazuhApplication(Application):
 
     def load_configuration(self):
         logger.debug('loading dxl client configuration from %s', path.abspath(self.args.dxl_config))
+        self.__dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
         self.dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
 
         logger.debug('loading service configuration from %s', path.abspath(self.args.service_config))
+        self.__svc_snapshot = ConfigSnapshot(self.args.service_config)
         self.service_config = ServiceConfig(self.args.service_config)
 
         # Load the available endpoints and make them part of the service configuration
@@ -65,8 +71,9 @@ class WazuhApplication(Application):
             )
 
     def initialize(self):
+        self.__registrations = Registrations(self.monitoring_context)
         self.__sb = WazuhApplication.__provision_switchboard(self.dxl_config, self.service_config,
-                                                             self.monitoring_context)
+                                                             self.__registrations.register)
         self.__sb.initialize()
 
     def reload(self):
@@ -74,6 +81,8 @@ class WazuhApplication(Application):
         logger.info('dxlwazuh configuration loading from: {}'.format(path.abspath(self.args.service_config)))
 
         try:
+            new_dxl_snapshot = ConfigSnapshot(self.args.dxl_config)
+            new_svc_snapshot = ConfigSnapshot(self.args.service_config)
             new_dxl_config = DxlClientConfig.create_dxl_config_from_file(self.args.dxl_config)
             new_svc_config = ServiceConfig(self.args.service_config)
             # Clone the endpoint list, but replace their parent
@@ -85,25 +94,59 @@ class WazuhApplication(Application):
             logger.error('failed config reload: invalid DXL client configuration')
             logger.error('dxlclient configuration error: ' + str(e))
         else:
+            dxl_changes = new_dxl_snapshot.changes(self.__dxl_snapshot)
+            svc_changes = new_svc_snapshot.changes(self.__svc_snapshot)
+            if not dxl_changes and not svc_changes:
+                logger.info('dxlclient and dxlwazuh configuration unchanged, nothing to reload')
+                return
             try:
-                logger.info('began swapping out the running dxlwazuh service')
-                new_monitoring_context = MonitoringContext()
-
-                new_svc = WazuhApplication.__provision_switchboard(new_dxl_config, new_svc_config,
-                                                                   new_monitoring_context)
-
-                new_svc.initialize()
-                self.__sb.destroy()
-
+                # Monitors of the same name carry over to the replacement
+                new_registrations = Registrations(self.monitoring_context)
+                if dxl_changes:
+                    logger.info('began swapping out the running dxlwazuh service')
+                    new_svc = WazuhApplication.__provision_switchboard(new_dxl_config, new_svc_config,
+                                                                       new_registrations.register)
+
+                    new_svc.initialize()
+                    # The replaced service responds to the requests in flight before disconnecting
+                    drain = self.start_drain('reload')
+                    self.__sb.drain(drain)
+                    drain.finish()
+                    self.__sb.destroy()
+                else:
+                    logger.info('began re-registering the dxlwazuh service over the running connection')
+                    # The connection monitor stays with the running client
+                    new_registrations.register(DxlClientMonitor('connection'))
+                    # The sessions and their connection pools are kept unless the Wazuh API configuration changed
+                    new_svc = Switchboard(self.__sb.dxl, new_svc_config, new_registrations.register,
+                                          None if 'Wazuh' in svc_changes else self.__sb.sessions)
+
+                    # Services registered on one client share its subscriptions and callback, unregistering
+                    # either drops them for both. The running service is unregistered first, its endpoints
+                    # going unanswered until the replacement registers, and registered again should the
+                    # replacement fail to
+                    self.__sb.unregister()
+                    try:
+                        new_svc.register()
+                    except BaseException:
+                        self.__sb.register()
+                        raise
+
+                self.__registrations.release(new_registrations)
+                self.__registrations = new_registrations
                 self.__sb = new_svc
                 self.dxl_config = new_dxl_config
                 self.service_config = new_svc_config
-                self.monitoring_context = new_monitoring_context
+                self.__dxl_snapshot = new_dxl_snapshot
+                self.__svc_snapshot = new_svc_snapshot
 
             except BaseException as e:
                 logger.error('failed to swap out dxlwazuh with reloaded configuration: {}'.format(e.message))
             else:
                 logger.info('reloaded dxlwazuh with new configuration')
 
+    def drain(self, drain):
+        self.__sb.drain(drain)
+
     def destroy(self):
         self.__sb.destroy()
@@ -1,4 +1,3 @@
-import json
 import logging
 
 import requests
@@ -6,9 +5,9 @@ from dxlclient.callbacks import RequestCallback
 from dxlclient.message import Response, ErrorResponse
 from dxlclient.service import ServiceRegistrationInfo
 
+from robobluekit import codec
 from robobluekit.dxl import MonitorableDxlClient
 from robobluekit.kit import ServiceEndpointMonitor
-from robobluekit.monitor import MonitoringContext
 
 from .config import ServiceConfig, EndpointConfig
 
@@ -22,16 +21,25 @@ class Dispatcher(RequestCallback):
     is inspected to determine whether an error has occurred
     """
 
-    def __init__(self, config, monitor, switch):
-        # type: (EndpointConfig, ServiceEndpointMonitor, Switchboard) -> None
+    def __init__(self, config, monitor, switch, session=None):
+        # type: (EndpointConfig, ServiceEndpointMonitor, Switchboard, requests.Session) -> None
+        """
+        :param session: Session to reuse along with its connection pool, a new one is created when omitted
+        """
         self.__monitor = monitor
         self.__config = config
         self.__switch = switch
-        self.__sess = requests.Session()
-        self.__sess.auth = config.auth
-        self.__sess.verify = config.verify_ssl
+        if session is None:
+            session = requests.Session()
+            session.auth = config.auth
+            session.verify = config.verify_ssl
+        self.__sess = session
         RequestCallback.__init__(self)
 
+    @property
+    def session(self):
+        return self.__sess
+
     def __construct_url(self, incoming):
         """
         Put together the URL from its parts and replace any variables
@@ -48,37 +56,51 @@ class Dispatcher(RequestCallback):
         return '/'.join(map(mapper, self.__config.url))
 
     def on_request(self, request):
-        self.__monitor.register_request()
+        in_flight = self.__switch.dxl.in_flight
+        in_flight.enter()
+        received = self.__monitor.register_request()
+        if not self.__monitor.submit(in_flight.run, self.__dispatch, request, received):
+            # Shed the load rather than queue up requests the endpoint can't get to in time
+            self.__monitor.register_error(received)
+            in_flight.run(self.__switch.dxl.send_response,
+                          ErrorResponse(request, 503, 'service endpoint overloaded, try again later'))
+
+    def __dispatch(self, request, received):
+        trace = self.__monitor.trace()
         response = Response(request)
         try:
-            req = json.loads(request.payload)
-            args = {
-                'method': self.__config.type,
-                'url': self.__construct_url(req)
-            }
-
-            # Determine how to treat the rest of the parameters based on the request type
-            if self.__config.type == 'get':
-                args['params'] = req
-            else:
-                args['json'] = req
+            with trace.span('parse'):
+                req = codec.loads(request.payload)
+                args = {
+                    'method': self.__config.type,
+                    'url': self.__construct_url(req)
+                }
+
+                # Determine how to treat the rest of the parameters based on the request type
+                if self.__config.type == 'get':
+                    args['params'] = req
+                else:
+                    args['data'] = codec.dumps(req)
+                    args['headers'] = {'Content-Type': 'application/json'}
 
             # Forward on the request and pass the response back
-            upstream = self.__sess.request(**args)
+            with trace.span('upstream'):
+                upstream = self.__sess.request(**args)
 
             if upstream.status_code >= 400:
                 response = ErrorResponse(request, upstream.status_code, upstream.text)
             else:
                 try:
                     # Errors aren't always indicated with the proper HTTP status code, may need to inspect
-                    res = upstream.json()
+                    with trace.span('inspect'):
+                        res = codec.loads(upstream.content)
                     if res['error'] != 0:
                         response = ErrorResponse(request, res['error'], upstream.text)
                     else:
                         response.payload = upstream.text
-                except (ValueError, KeyError):
+                except (codec.DecodeError, KeyError):
                     response = ErrorResponse(request, 504, 'Invalid upstream response')
-        except ValueError:
+        except codec.DecodeError:
             response = ErrorResponse(request, 400, 'request payload must be a well formed JSON string')
         except KeyError as e:
             response = ErrorResponse(request, 400, 'missing required parameter {} from payload'.format(str(e)))
@@ -86,12 +108,15 @@ class Dispatcher(RequestCallback):
             logger.exception('unknown exception of type %s: ' + str(e), type(e).__name__)
             response = ErrorResponse(request, 500, 'unknown internal error: ' + str(e))
         finally:
-            if isinstance(response, ErrorResponse) and 500 <= response.error_code < 600:
+            error = isinstance(response, ErrorResponse) and 500 <= response.error_code < 600
+            if error:
                 # Error count doesn't include client errors
-                self.__monitor.register_error()
+                self.__monitor.register_error(received)
             else:
-                self.__monitor.register_success()
-            self.__switch.dxl.send_response(response)
+                self.__monitor.register_success(received)
+            with trace.span('send'):
+                self.__switch.dxl.send_response(response)
+            trace.finish(error)
 
 
 class Switchboard:
@@ -99,23 +124,60 @@ class Switchboard:
     The switchboard's responsible for managing a set of dispatchers to ensure proper data flow
     """
 
-    def __init__(self, dxl_client, config, monitoring_context):
-        # type: (MonitorableDxlClient, ServiceConfig, MonitoringContext) -> None
+    def __init__(self, dxl_client, config, register_monitor, sessions=None):
+        # type: (MonitorableDxlClient, ServiceConfig, callable, dict) -> None
+        """
+        :param sessions: Sessions of the Wazuh API endpoints by name to reuse, new ones are created when omitted
+        """
         self.dxl = dxl_client
         self.__config = config
-        self.__monitoring_ctx = monitoring_context
+        self.__register_monitor = register_monitor
+        self.__reused_sessions = sessions if sessions is not None else {}
+        self.__dispatchers = {}
+        self.__service_reg = None
+
+    @property
+    def sessions(self):
+        return dict((name, dispatcher.session) for name, dispatcher in self.__dispatchers.items())
 
     def initialize(self):
         self.dxl.connect()
+        self.register()
 
+    def register(self):
+        """
+        Register the service with the OpenDXL service fabric over the already connected client
+        :return: None
+        """
         service_reg = ServiceRegistrationInfo(self.dxl, self.__config.type)
         # Register the endpoints that the service provides
         for endpoint in self.__config.endpoints:
             topic = '{}/{}'.format(self.__config.type, endpoint.name)
-            monitor = self.__monitoring_ctx.register(ServiceEndpointMonitor('endpoints.{}'.format(topic)))
-            service_reg.add_topic(topic, Dispatcher(endpoint, monitor, self))
+            monitor = self.__register_monitor(ServiceEndpointMonitor('endpoints.{}'.format(topic)))
+            dispatcher = Dispatcher(endpoint, monitor, self, self.__reused_sessions.get(endpoint.name))
+            self.__dispatchers[endpoint.name] = dispatcher
+            service_reg.add_topic(topic, dispatcher)
 
         self.dxl.register_service_sync(service_reg, 2)
+        self.__service_reg = service_reg
+
+    def unregister(self):
+        """
+        Unregister the service, leaving the client connected for a replacing switchboard
+        :return: None
+        """
+        if self.__service_reg is not None:
+            self.dxl.unregister_service_sync(self.__service_reg, 2)
+            self.__service_reg = None
+
+    def drain(self, drain):
+        """
+        Unregister the service and wait for the requests in flight to be responded to, leaving the client connected
+        :param drain: robobluekit Drain bounding the wait
+        :return: None
+        """
+        self.unregister()
+        drain.wait(lambda: self.dxl.in_flight.count, 'callbacks')
 
     def destroy(self):
         self.dxl.disconnect()
@@ -0,0 +1,260 @@
+"""
+Optional asyncio mode of the services.
+
+The request and event callbacks of dxlclient are called on the threads of its callback pool, a callback doing blocking
+I/O holding on to a thread for as long as the upstream takes to answer. The adapters here bridge the callbacks onto an
+event loop running on a thread of its own: the callback thread returns as soon as the handling coroutine is scheduled
+and any number of upstream calls await their answers on the one loop thread.
+
+On Python 2 the event loop is provided by trollius, the backport of asyncio, installed with `pip install .[asyncio]`.
+Handling coroutines are written in the style of trollius, decorated with `asyncio.coroutine` and awaiting with
+`yield asyncio.From(...)`. Blocking calls that have no asynchronous counterpart are run in the executor of the loop with
+`EventLoop.run_blocking`.
+"""
+import logging
+import threading
+import time
+
+from dxlclient import DxlClient
+from dxlclient.callbacks import RequestCallback, EventCallback
+from dxlclient.message import ErrorResponse
+
+from .kit import format_duration
+from .metrics import Counter, Gauge
+from .monitor import Monitor
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+logger = logging.getLogger(__name__)
+
+
+def available():
+    """
+    :return: Whether an asyncio implementation is installed
+    """
+    return asyncio is not None
+
+
+class EventLoop:
+    """
+    Event loop running on a thread of its own. Coroutines are submitted to the loop from any thread, the loop keeps
+    count of the coroutines submitted, finished and failed. A heartbeat scheduled on the loop measures how late the loop
+    gets to its callbacks, which grows when a coroutine blocks the loop
+    """
+
+    # Seconds between heartbeats
+    HEARTBEAT = 1
+
+    def __init__(self):
+        if asyncio is None:
+            raise RuntimeError('the asyncio mode requires trollius, install robobluekit with the asyncio extra')
+        self.loop = asyncio.new_event_loop()
+        self.submitted = Counter('roboblue_event_loop_tasks_total', 'Coroutines submitted to the event loop')
+        self.finished = Counter('roboblue_event_loop_tasks_finished_total', 'Coroutines finished on the event loop')
+        self.failed = Counter('roboblue_event_loop_tasks_failed_total', 'Coroutines failed with an exception')
+        self.lag = 0
+        self.__next_beat = None
+        self.__thread = None
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    @property
+    def pending(self):
+        return self.submitted.value - self.finished.value
+
+    @property
+    def delay(self):
+        """
+        Seconds the loop is late to its callbacks, the latest heartbeat lag or the time past the missed heartbeat
+        """
+        if self.__next_beat is None:
+            return 0
+        return max(self.lag, time.time() - self.__next_beat)
+
+    def start(self):
+        self.__thread = threading.Thread(name='EventLoop', target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.__heartbeat(time.time())
+        self.loop.run_forever()
+
+    def __heartbeat(self, due):
+        now = time.time()
+        self.lag = max(0, now - due)
+        self.__next_beat = now + self.HEARTBEAT
+        self.loop.call_later(self.HEARTBEAT, self.__heartbeat, self.__next_beat)
+
+    def submit(self, coroutine, done=None):
+        """
+        Schedule a coroutine on the loop, safe to call from any thread
+        :param coroutine: The coroutine object
+        :param done: Optional function called on the loop with the finished future
+        :return: None
+        """
+        self.submitted.inc()
+        self.loop.call_soon_threadsafe(self.__schedule, coroutine, done)
+
+    def __schedule(self, coroutine, done):
+        try:
+            task = asyncio.ensure_future(coroutine, loop=self.loop)
+        except Exception:
+            self.failed.inc()
+            self.finished.inc()
+            logger.exception('failed to schedule a coroutine')
+            return
+        task.add_done_callback(lambda future: self.__finished(future, done))
+
+    def __finished(self, future, done):
+        self.finished.inc()
+        if not future.cancelled() and future.exception() is not None:
+            self.failed.inc()
+        if done is not None:
+            try:
+                done(future)
+            except Exception:
+                logger.exception('coroutine completion callback failed')
+
+    def run_blocking(self, function, *args):
+        """
+        Run a blocking call in the executor of the loop, to be awaited on the loop
+        :return: Future of the result of the call
+        """
+        return self.loop.run_in_executor(None, function, *args)
+
+    def stop(self, timeout=5):
+        """
+        Stop the loop and wait for the thread to finish. Coroutines still running are abandoned
+        :param timeout: Seconds to wait for the loop thread
+        :return: None
+        """
+        if not self.running:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            logger.error('event loop failed to stop in %d seconds', timeout)
+            return
+        if self.pending:
+            logger.warn('abandoned %d coroutines on stopping the event loop', self.pending)
+        self.loop.close()
+
+
+class EventLoopMonitor(Monitor):
+    """
+    Event loop monitor reports on the coroutines of the loop and considers the loop unhealthy when it's blocked for
+    longer than MAX_DELAY seconds
+    """
+
+    MAX_DELAY = 5
+
+    # A blocked loop can't notify of it
+    POLLED_HEALTH = True
+
+    def __init__(self, name, event_loop):
+        # type: (str, EventLoop) -> None
+        self.__event_loop = event_loop
+        Monitor.__init__(self, name)
+
+    @property
+    def healthy(self):
+        event_loop = self.__event_loop
+        return event_loop.running and event_loop.delay < self.MAX_DELAY
+
+    @property
+    def metrics(self):
+        event_loop = self.__event_loop
+        return [
+            event_loop.submitted,
+            event_loop.finished,
+            event_loop.failed,
+            Gauge('roboblue_event_loop_tasks_pending', 'Coroutines submitted to the event loop and not yet finished',
+                  lambda: event_loop.pending),
+            Gauge('roboblue_event_loop_delay_seconds', 'Seconds the event loop is late to its callbacks',
+                  lambda: event_loop.delay)
+        ]
+
+    def report_status(self):
+        event_loop = self.__event_loop
+        return {
+            'running': event_loop.running,
+            'submitted': event_loop.submitted.value,
+            'pending': event_loop.pending,
+            'failed': event_loop.failed.value,
+            'delay': format_duration(event_loop.delay)
+        }
+
+
+class AsyncRequestCallback(RequestCallback):
+    """
+    Request callback handling the requests on the event loop. The handle_request coroutine of the implementations
+    returns the response, which is sent once the coroutine finishes. A coroutine failing with an exception is answered
+    with an internal error
+    """
+
+    def __init__(self, event_loop, dxl_client):
+        # type: (EventLoop, DxlClient) -> None
+        self.event_loop = event_loop
+        self.dxl_client = dxl_client
+        RequestCallback.__init__(self)
+
+    def on_request(self, request):
+        self.event_loop.submit(self.handle_request(request), lambda future: self.__respond(request, future))
+
+    def __respond(self, request, future):
+        if future.cancelled():
+            response = ErrorResponse(request, 503, 'request abandoned')
+        elif future.exception() is not None:
+            e = future.exception()
+            logger.error('unknown exception of type %s: %s', type(e).__name__, e)
+            response = ErrorResponse(request, 500, 'unknown internal error: ' + str(e))
+        else:
+            response = future.result()
+        if response is not None:
+            self.dxl_client.send_response(response)
+
+    def handle_request(self, request):
+        """
+        Coroutine handling the request
+        :param request: The dxlclient Request
+        :return: The Response to send, None when the coroutine sends the response on its own
+        """
+        raise NotImplementedError('requires implementation')
+
+
+class AsyncEventCallback(EventCallback):
+    """
+    Event callback handling the events on the event loop with the handle_event coroutine of the implementations
+    """
+
+    def __init__(self, event_loop):
+        # type: (EventLoop) -> None
+        self.event_loop = event_loop
+        EventCallback.__init__(self)
+
+    def on_event(self, event):
+        self.event_loop.submit(self.handle_event(event), self.__handled)
+
+    @staticmethod
+    def __handled(future):
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            logger.error('failed to handle event, exception of type %s: %s', type(e).__name__, e)
+
+    def handle_event(self, event):
+        """
+        Coroutine handling the event
+        :param event: The dxlclient Event
+        :return: None
+        """
+        raise NotImplementedError('requires implementation')
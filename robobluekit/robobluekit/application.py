@@ -5,14 +5,25 @@ import os.path as path
 import signal
 import threading
 
-from .config import HealthServerConfig
+from .aio import EventLoop, EventLoopMonitor
+from .config import HealthServerConfig, TracingConfig
+from .drain import Drain, DrainMonitor
+from .executor import Executor
+from .kit import TracingMonitor
 from .monitor import MonitoringContext, HealthServer
+from .profiler import SamplingProfiler
+from .supervisor import Supervisor, WorkerChannel, WorkerProfiler
+from .tracing import Tracer
 
 logger = logging.getLogger(__name__)
 
 
 class Application:
 
+    # Whether the application can run in several worker processes. Applications subscribing to events receive every
+    # event in every worker and should not
+    WORKERS_SUPPORTED = True
+
     def __init__(self):
         self.__arg_parser = argparse.ArgumentParser(add_help=True)
         self.__reloading_configuration = threading.Lock()
@@ -21,6 +32,14 @@ class Application:
         self.monitoring_context = MonitoringContext()
         self.__monitoring_config = None
         self.__monitoring_server = None
+        self.profiler = None
+        self.tracer = None
+        self.executor = None
+        self.__supervisor = None
+        self.__worker_context = None
+        self.__worker_profiler = None
+        self.__event_loop = None
+        self.__drain_monitor = DrainMonitor('drain')
 
         self.add_argument = self.__arg_parser.add_argument
         self.args = None
@@ -43,6 +62,39 @@ class Application:
             default='./config/monitoring.config'
         )
 
+        self.add_argument(
+            '--profile-directory',
+            help='directory the collapsed stacks of on-demand profiling sessions are written to',
+            metavar='PATH_TO_DIRECTORY',
+            default=None
+        )
+
+        self.add_argument(
+            '--profile-seconds',
+            help='duration of the profiling sessions started with SIGUSR1',
+            metavar='SECONDS',
+            type=float,
+            default=30
+        )
+
+        self.add_argument(
+            '--drain-timeout',
+            help='seconds given to the work in flight to finish and the buffers to be flushed on shutdown and reload\
+                  before the work left is abandoned',
+            metavar='SECONDS',
+            type=float,
+            default=30
+        )
+
+        self.add_argument(
+            '--workers',
+            help='number of worker processes to fork, each connecting to the fabric on its own for the broker to balance\
+                  the requests across them. Defaults to a single process',
+            metavar='N',
+            type=int,
+            default=1
+        )
+
         self.register_arguments()
 
     def __load_configuration(self):
@@ -54,9 +106,24 @@ class Application:
         if hasattr(self.args, 'monitoring_config') and path.isfile(self.args.monitoring_config):
             logger.debug('loading monitoring configuration from: {}'.format(path.abspath(self.args.monitoring_config)))
             self.__monitoring_config = HealthServerConfig(self.args.monitoring_config)
+            self.monitoring_context.endpoint_health = self.__monitoring_config.endpoint_health
         else:
             logger.warn('health endpoint not configured')
 
+        tracing_config = self.__monitoring_config.tracing_config if self.__monitoring_config is not None \
+            else TracingConfig({})
+        self.tracer = Tracer.from_config(tracing_config)
+        self.monitoring_context.tracer = self.tracer
+        self.monitoring_context.register(TracingMonitor('tracing', self.tracer))
+        self.monitoring_context.register(self.__drain_monitor)
+
+        self.executor = Executor.from_config(
+            self.__monitoring_config.executor_config if self.__monitoring_config is not None else None
+        )
+        self.monitoring_context.executor = self.executor
+
+        self.profiler = SamplingProfiler(getattr(self.args, 'profile_directory', None))
+
         self.load_configuration()
 
     def __register_signal_handlers(self):
@@ -64,7 +131,9 @@ class Application:
         # Signals to be handled
         signals = {
             signal.SIGINT: self.__interrupt_handler,
+            signal.SIGTERM: self.__interrupt_handler,
             signal.SIGHUP: self.__reload_configuration,
+            signal.SIGUSR1: self.__profile,
         }
         for sig in signals:
             signal.signal(sig, signals[sig])
@@ -87,12 +156,111 @@ class Application:
 
         self.__reloading_configuration.release()
 
-    def __initialize(self):
+    def __profile(self, sig, frame):
+        seconds = getattr(self.args, 'profile_seconds', 30)
+        if self.profiler.start(seconds) is None:
+            logger.info('ignoring SIGUSR1 - profiling in progress')
+
+    def __serve_health(self):
         if self.__monitoring_config is not None:
             self.__monitoring_server = HealthServer(self.__monitoring_config, self)
             self.__monitoring_server.serve()
 
+    def __initialize(self):
+        self.__serve_health()
+
+        self.__start_executor()
+        self.initialize()
+
+    def __start_executor(self):
+        # Started in the workers rather than before forking, threads don't survive the fork
+        if self.executor is not None:
+            self.executor.start()
+
+    def __shut_down(self):
+        drain = self.start_drain('shutdown')
+        self.drain(drain)
+        if self.__event_loop is not None:
+            drain.wait(lambda: self.__event_loop.pending, 'coroutines')
+        drain.finish()
+        if self.executor is not None:
+            # The requests queued are in flight until responded to, there's nothing left for the threads to run
+            self.executor.stop(drain.remaining)
+        self.destroy()
+        self.__stop_event_loop()
+
+    def __supervise(self, workers):
+        if not self.WORKERS_SUPPORTED:
+            self.__arg_parser.error('{} can not run in several workers'.format(type(self).__name__))
+        # The workers are forked with the monitoring context and profiler of their own, the supervisor gets a
+        # monitoring context standing in for the workers and profiles them instead of itself
+        self.__worker_context = self.monitoring_context
+        self.__worker_profiler = self.profiler
+        self.monitoring_context = MonitoringContext()
+        # The workers drain on their own, killed when the drain overruns by far
+        self.__supervisor = Supervisor(workers, self.__serve_worker, self.monitoring_context,
+                                       self.drain_timeout + Supervisor.SHUTDOWN_TIMEOUT)
+        # The initial workers are forked before any threads are started
+        self.__supervisor.start()
+        self.profiler = WorkerProfiler(self.__supervisor.workers)
+
+        signals = {
+            signal.SIGINT: self.__supervisor.stop,
+            signal.SIGTERM: self.__supervisor.stop,
+            signal.SIGHUP: self.__reload_workers,
+            signal.SIGUSR1: lambda sig, frame: self.__supervisor.forward(signal.SIGUSR1),
+        }
+        for sig in signals:
+            signal.signal(sig, signals[sig])
+
+        self.__serve_health()
+
+    def __reload_workers(self, sig, frame):
+        logger.info('received SIGHUP - will reload the workers')
+        try:
+            if hasattr(self.args, 'logging_config') and path.isfile(self.args.logging_config):
+                logging.config.fileConfig(self.args.logging_config)
+        except ConfigParser.Error as e:
+            logger.error('failed config reload: invalid logger configuration')
+            logger.error('logging configuration error: {}'.format(e.message))
+        self.__supervisor.forward(signal.SIGHUP)
+
+    def __serve_worker(self, channel):
+        """
+        Run the application in a forked worker until interrupted
+        :param channel: Worker end of the socket pair to the supervisor
+        :return: Exit code
+        """
+        # A restarted worker inherits the listening socket of the health server of the supervisor
+        if self.__monitoring_server is not None:
+            self.__monitoring_server.close()
+            self.__monitoring_server = None
+        self.monitoring_context = self.__worker_context
+        self.profiler = self.__worker_profiler
+        self.__supervisor = None
+        self.__register_signal_handlers()
+        self.__start_executor()
         self.initialize()
+        WorkerChannel(channel, self).start()
+        self.run()
+        self.__shut_down()
+        return 0
+
+    def __stop_event_loop(self):
+        if self.__event_loop is not None:
+            self.__event_loop.stop()
+
+    @property
+    def event_loop(self):
+        """
+        Event loop of the asyncio mode for the callbacks built on the adapters of the aio module, started on first use
+        :return: EventLoop
+        """
+        if self.__event_loop is None:
+            self.__event_loop = EventLoop()
+            self.__event_loop.start()
+            self.monitoring_context.register(EventLoopMonitor('event_loop', self.__event_loop))
+        return self.__event_loop
 
     def __interrupt_handler(self, sig, frame):
         if self.__keep_running_lock.acquire(False):
@@ -127,6 +295,27 @@ class Application:
         """
         raise NotImplementedError('requires implementation')
 
+    def drain(self, drain):
+        """
+        Application specific drain hook called on shutdown before destroy. Stop taking new work, then wait for the work
+        in flight and flush the buffers within the deadline of the drain, leaving the DXL client connected
+        :param drain: Drain
+        :return: None
+        """
+        pass
+
+    @property
+    def drain_timeout(self):
+        return getattr(self.args, 'drain_timeout', 30)
+
+    def start_drain(self, name):
+        """
+        Start a drain with the configured timeout, reported by the drain monitor once finished
+        :param name: What's being drained, e.g. reload
+        :return: Drain
+        """
+        return Drain(name, self.drain_timeout, self.__drain_monitor)
+
     def bootstrap(self):
         """
         Generic bootstrap activities so that we end up with a working application
@@ -137,6 +326,11 @@ class Application:
 
         self.__load_configuration()
 
+        workers = getattr(self.args, 'workers', 1)
+        if workers > 1:
+            self.__supervise(workers)
+            return
+
         self.__register_signal_handlers()
 
         self.__initialize()
@@ -149,5 +343,20 @@ class Application:
         raise NotImplementedError('requires implementation')
 
     def run(self):
+        if self.__supervisor is not None:
+            self.__supervisor.run()
+            return
         while self.__keep_running:
             signal.pause()
+
+    def main(self):
+        """
+        Bootstrap the application and run it until interrupted, then drain and tear it down. With several workers the
+        process supervises the forked workers instead, the workers draining and tearing down the application on their
+        own
+        :return: None
+        """
+        self.bootstrap()
+        self.run()
+        if self.__supervisor is None:
+            self.__shut_down()
@@ -0,0 +1,155 @@
+"""
+Micro-benchmarks of the kit components used on the hot paths of the services.
+
+Usage: python -m robobluekit.benchmark [-n ITERATIONS] BENCHMARK...
+"""
+import argparse
+import threading
+import time
+import timeit
+
+from . import codec
+from .kit import ServiceEndpointMonitor
+from .metrics import Counter
+
+# Messages representative of the ones handled by the services
+SAMPLE_MESSAGES = {
+    'reputation_request': '{"type": "ip", "key": "192.168.1.1", "reputation": -10}',
+    'wazuh_response': codec.dumps({
+        'error': 0,
+        'data': {
+            'totalItems': 50,
+            'items': [{
+                'id': '{:03d}'.format(i),
+                'name': 'agent-{}'.format(i),
+                'ip': '10.0.{}.{}'.format(i // 256, i % 256),
+                'status': 'Active',
+                'os': {'name': 'Debian GNU/Linux', 'version': '9', 'platform': 'debian', 'arch': 'x86_64'},
+                'version': 'Wazuh v3.7.2',
+                'dateAdd': '2019-01-31 10:11:12',
+                'lastKeepAlive': '2019-01-31 12:13:14'
+            } for i in range(50)]
+        }
+    }),
+    'health_report': codec.dumps({
+        'healthy': True,
+        'monitors': {
+            'connection': {'initial_connection': 15489123456780, 'latest_connection': 15489123456780,
+                           'latest_disconnection': None, 'healthy': True},
+            'endpoints': dict(('/opendxl-wazuh/service/wazuh-api/Endpoint{}'.format(i), {
+                'first_request_received': 15489123456780, 'latest_request_received': 15489123456780,
+                'request_count': 1234, 'error_count': 1, 'healthy': True
+            }) for i in range(100))
+        }
+    })
+}
+
+
+def benchmark_codec(iterations):
+    """
+    Time decoding and encoding the sample messages with each available JSON codec backend
+    """
+    selected = codec.backend
+    results = {}
+    try:
+        for name in codec.available():
+            codec.select(name)
+            for message, raw in SAMPLE_MESSAGES.items():
+                decoded = codec.loads(raw)
+                results[(message, name)] = (
+                    timeit.timeit(lambda: codec.loads(raw), number=iterations) / iterations,
+                    timeit.timeit(lambda: codec.dumps(decoded), number=iterations) / iterations
+                )
+    finally:
+        codec.select(selected)
+
+    print '{:<20} {:<8} {:>12} {:>12}'.format('message', 'backend', 'loads (us)', 'dumps (us)')
+    for message, name in sorted(results):
+        decode, encode = results[(message, name)]
+        print '{:<20} {:<8} {:>12.2f} {:>12.2f}'.format(message, name, decode * 1e6, encode * 1e6)
+
+
+class LockedCounter:
+    """
+    Counter guarded by a single lock, the baseline sharded counters are compared against
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+
+def endpoint_cycle(monitor):
+    """
+    The monitor calls made by a dispatcher processing a single request
+    """
+    def cycle():
+        monitor.register_success(monitor.register_request())
+    return cycle
+
+
+def contended(operation, threads, iterations):
+    """
+    Time the operation performed concurrently by the number of threads
+    :return: Operations per second across all threads
+    """
+    start = threading.Event()
+
+    def work():
+        start.wait()
+        for _ in xrange(iterations):
+            operation()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    started = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    return threads * iterations / (time.time() - started)
+
+
+def benchmark_counters(iterations):
+    """
+    Compare the throughput of lock guarded and sharded counters and of the endpoint monitor as the number of threads
+    recording concurrently grows, the way a callback pool records under load
+    """
+    subjects = [
+        ('locked counter', lambda: LockedCounter().inc),
+        ('sharded counter', lambda: Counter().inc),
+        ('endpoint monitor', lambda: endpoint_cycle(ServiceEndpointMonitor('benchmark')))
+    ]
+    print '{:<20} {:>8} {:>16}'.format('subject', 'threads', 'ops/s')
+    for name, subject in subjects:
+        for threads in [1, 4, 16, 64]:
+            rate = contended(subject(), threads, max(iterations // threads, 1))
+            print '{:<20} {:>8} {:>16.0f}'.format(name, threads, rate)
+
+
+BENCHMARKS = {
+    'codec': benchmark_codec,
+    'counters': benchmark_counters
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roboblue kit micro-benchmarks')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run, one of: {}. Runs all when omitted'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('-n', '--iterations', type=int, default=10000, help='iterations per measurement')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print '== {}'.format(name)
+        BENCHMARKS[name](args.iterations)
+
+
+if __name__ == '__main__':
+    main()
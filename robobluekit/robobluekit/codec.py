@@ -0,0 +1,92 @@
+"""
+JSON codec used on the hot paths of the services. The fastest available backend is selected on import with the standard
+library json module as the fallback. The backend can be forced by setting the ROBOBLUEKIT_JSON_CODEC environment
+variable to the name of a registered backend.
+
+Callers are expected to reference the functions through the module (codec.loads) rather than importing them directly
+so that selecting another backend takes effect everywhere.
+"""
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Backends in the order of preference
+PREFERENCE = ['ujson', 'json']
+
+# Error raised by all the backends when decoding fails
+DecodeError = ValueError
+
+__backends = {}
+
+
+def __load_ujson():
+    import ujson
+
+    def loads(s):
+        try:
+            return ujson.loads(s, precise_float=True)
+        except ValueError:
+            # ujson rejects integers outside of 64 bits, let json decide whether the document is valid
+            return json.loads(s)
+
+    # The ujson encoder rounds floats to a fixed number of decimals and encodes unknown types as objects, encoding
+    # stays with json so that stored and forwarded payloads are not altered
+    return loads, json.dumps
+
+
+def __load_json():
+    return json.loads, json.dumps
+
+
+def register(name, loader):
+    """
+    Make a backend available for selection
+    :param name: Name of the backend
+    :param loader: Function returning a (loads, dumps) tuple, raising ImportError if the backend is unavailable
+    :return: None
+    """
+    __backends[name] = loader
+
+
+def select(name=None):
+    """
+    Select the backend used for encoding and decoding
+    :param name: Name of the backend, the most preferred available backend is selected when omitted
+    :return: Name of the selected backend
+    """
+    global loads, dumps, backend
+    for candidate in [name] if name is not None else PREFERENCE:
+        try:
+            loads, dumps = __backends[candidate]()
+        except ImportError:
+            continue
+        backend = candidate
+        logger.debug('selected %s as the JSON codec', candidate)
+        return candidate
+    raise ValueError('JSON codec backend {} is not available'.format(name))
+
+
+def available():
+    """
+    List the names of the backends that can be selected
+    :return: list of backend names
+    """
+    names = []
+    for name in __backends:
+        try:
+            __backends[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+register('ujson', __load_ujson)
+register('json', __load_json)
+
+loads = None
+dumps = None
+backend = None
+select(os.environ.get('ROBOBLUEKIT_JSON_CODEC'))
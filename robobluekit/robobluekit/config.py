@@ -1,6 +1,7 @@
 from configobj import ConfigObj
 
-from .kit import require, optional_and_enforce_type, require_and_try_coercion, run_validators
+from .kit import require, optional_and_enforce_type, require_and_try_coercion, optional_and_try_coercion, \
+    optional_and_enforce_values, run_validators, ErrorRatioRule, InvalidConfigException, ServiceEndpointMonitor
 
 
 class HealthServerConfig:
@@ -16,9 +17,147 @@ class HealthServerConfig:
         run_validators([
             ('Host', str, optional_and_enforce_type),
             ('Port', int, require_and_try_coercion),
+            ('CacheTTL', float, optional_and_try_coercion),
+            ('Profiling', ['True', 'False'], optional_and_enforce_values)
         ], self.__parsed['Server'])
+        if 'EndpointHealth' in self.__parsed:
+            container = self.__parsed['EndpointHealth']
+            run_validators([
+                ('Window', float, optional_and_try_coercion),
+                ('MaxErrorRatio', float, optional_and_try_coercion),
+                ('MinRequests', int, optional_and_try_coercion)
+            ], container)
+            rule = self.endpoint_health
+            if not 0 < rule.window <= ServiceEndpointMonitor.WINDOWS[-1][1]:
+                raise InvalidConfigException('EndpointHealth Window must be between 0 and {} seconds'.format(
+                    ServiceEndpointMonitor.WINDOWS[-1][1]))
+            if not 0 <= rule.max_error_ratio <= 1:
+                raise InvalidConfigException('EndpointHealth MaxErrorRatio must be between 0 and 1')
+        if 'Tracing' in self.__parsed:
+            run_validators([
+                ('SampleRate', float, optional_and_try_coercion),
+                ('Capacity', int, optional_and_try_coercion),
+                ('Output', str, optional_and_enforce_type)
+            ], self.__parsed['Tracing'])
+            tracing = self.tracing_config
+            if not 0 <= tracing.sample_rate <= 1:
+                raise InvalidConfigException('Tracing SampleRate must be between 0 and 1')
+            if tracing.capacity < 1:
+                raise InvalidConfigException('Tracing Capacity must be positive')
+        if 'Executor' in self.__parsed:
+            container = self.__parsed['Executor']
+            limits = [
+                ('MaxConcurrency', int, optional_and_try_coercion),
+                ('QueueSize', int, optional_and_try_coercion)
+            ]
+            run_validators([('Workers', int, optional_and_try_coercion)] + limits, container)
+            for endpoint in container.sections:
+                run_validators(limits, container[endpoint])
+            executor = self.executor_config
+            if executor.workers < 1:
+                raise InvalidConfigException('Executor Workers must be positive')
+            values = [executor.max_concurrency, executor.queue_size]
+            for limit in executor.limits.values():
+                values.extend(limit)
+            if any(value is not None and value < 1 for value in values):
+                raise InvalidConfigException('Executor MaxConcurrency and QueueSize must be positive')
 
     @property
     def httpd_address(self):
         container = self.__parsed['Server']
         return container.get('Host', ''), int(container['Port'])
+
+    @property
+    def cache_ttl(self):
+        """
+        Seconds the health reports are cached for, 0 disables caching
+        """
+        return float(self.__parsed['Server'].get('CacheTTL', 1.0))
+
+    @property
+    def profiling(self):
+        """
+        Whether profiling sessions can be started with a POST to /profile
+        """
+        return self.__parsed['Server'].get('Profiling', 'False') == 'True'
+
+    @property
+    def endpoint_health(self):
+        """
+        Error ratio health rule of the service endpoints
+        """
+        container = self.__parsed.get('EndpointHealth', {})
+        return ErrorRatioRule(
+            float(container.get('Window', 60)),
+            float(container.get('MaxErrorRatio', 0.1)),
+            int(container.get('MinRequests', 10))
+        )
+
+    @property
+    def tracing_config(self):
+        return TracingConfig(self.__parsed.get('Tracing', {}))
+
+    @property
+    def executor_config(self):
+        """
+        Configuration of the executor of the service endpoints, None when the endpoints process the requests on the
+        threads of the DXL client
+        """
+        return ExecutorConfig(self.__parsed['Executor']) if 'Executor' in self.__parsed else None
+
+
+class TracingConfig:
+    """
+    Configuration of the sampling of request traces
+    """
+    def __init__(self, container):
+        self.__container = container
+
+    @property
+    def sample_rate(self):
+        return float(self.__container.get('SampleRate', 0.01))
+
+    @property
+    def capacity(self):
+        return int(self.__container.get('Capacity', 100))
+
+    @property
+    def output(self):
+        return self.__container.get('Output')
+
+
+class ExecutorConfig:
+    """
+    Configuration of the executor of the service endpoints. Subsections named after the topics of the endpoints
+    override the concurrency cap and queue size of the endpoints
+    """
+    def __init__(self, container):
+        self.__container = container
+
+    @property
+    def workers(self):
+        return int(self.__container.get('Workers', 16))
+
+    @property
+    def queue_size(self):
+        return int(self.__container.get('QueueSize', 100))
+
+    @property
+    def max_concurrency(self):
+        value = self.__container.get('MaxConcurrency')
+        return int(value) if value is not None else None
+
+    @property
+    def limits(self):
+        """
+        :return: dict of the topics of the endpoints to (max_concurrency, queue_size) tuples, None standing for the
+        default
+        """
+        limits = {}
+        for endpoint in self.__container.sections:
+            section = self.__container[endpoint]
+            limits[endpoint] = (
+                int(section['MaxConcurrency']) if 'MaxConcurrency' in section else None,
+                int(section['QueueSize']) if 'QueueSize' in section else None
+            )
+        return limits
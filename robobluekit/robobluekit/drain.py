@@ -0,0 +1,157 @@
+"""
+Drain phase of shutting down and reloading.
+
+Tearing a component down right away loses the requests it's processing and the records it has buffered. Components are
+drained first instead: they stop taking new work, wait for the callbacks in flight and flush their buffers, all within
+the deadline of the drain, and only then disconnect. The work left once the deadline passes is abandoned, the duration
+of the drain and the work abandoned being logged and reported by the drain monitor.
+"""
+import logging
+import threading
+import time
+
+from .kit import format_timestamp, format_duration
+from .metrics import Counter, Gauge
+from .monitor import Monitor
+
+logger = logging.getLogger(__name__)
+
+
+class InFlight:
+    """
+    Count of the callbacks in flight. Callbacks enter the flight as they're called and leave it once they've responded,
+    possibly on another thread. Counted with sharded counters so that the callbacks don't contend on a lock
+    """
+
+    def __init__(self):
+        self.__entered = Counter()
+        self.__left = Counter()
+
+    def enter(self):
+        self.__entered.inc()
+
+    def leave(self):
+        self.__left.inc()
+
+    def run(self, function, *args):
+        """
+        Call the function on behalf of a callback that has entered the flight, leaving the flight once it returns
+        """
+        try:
+            return function(*args)
+        finally:
+            self.leave()
+
+    @property
+    def count(self):
+        # Read in this order the count errs on the side of work still in flight
+        left = self.__left.value
+        return self.__entered.value - left
+
+
+class Drain:
+    """
+    Drain of a component, keeping the deadline and the work abandoned by kind
+    """
+
+    # Seconds between checks of the work pending
+    INTERVAL = 0.01
+
+    def __init__(self, name, timeout, monitor=None):
+        """
+        :param name: What's being drained, e.g. shutdown or reload
+        :param timeout: Seconds given to the drain
+        :param monitor: DrainMonitor to report the drain to once finished
+        """
+        self.name = name
+        self.started = time.time()
+        self.deadline = self.started + timeout
+        self.finished = None
+        self.abandoned = {}
+        self.__monitor = monitor
+
+    @property
+    def remaining(self):
+        return max(0, self.deadline - time.time())
+
+    @property
+    def duration(self):
+        return (self.finished if self.finished is not None else time.time()) - self.started
+
+    def wait(self, pending, kind):
+        """
+        Wait for the work pending to be done, abandoning what's left once the deadline passes
+        :param pending: Function returning the amount of work pending
+        :param kind: Kind of the work, e.g. callbacks
+        :return: Amount of work abandoned
+        """
+        count = pending()
+        while count > 0 and time.time() < self.deadline:
+            time.sleep(self.INTERVAL)
+            count = pending()
+        self.abandon(kind, count)
+        return count
+
+    def abandon(self, kind, count):
+        """
+        Record work abandoned by the component
+        :param kind: Kind of the work, e.g. events
+        :param count: Amount of work
+        :return: None
+        """
+        if count > 0:
+            self.abandoned[kind] = self.abandoned.get(kind, 0) + count
+
+    def finish(self):
+        self.finished = time.time()
+        if self.abandoned:
+            logger.warn('%s drain abandoned %s after %.3f seconds', self.name,
+                        ', '.join('{} {}'.format(count, kind) for kind, count in sorted(self.abandoned.items())),
+                        self.duration)
+        else:
+            logger.info('%s drain finished in %.3f seconds', self.name, self.duration)
+        if self.__monitor is not None:
+            self.__monitor.record(self)
+
+
+class DrainMonitor(Monitor):
+    """
+    Drain monitor reports the drains of the application along with the latest one
+    """
+
+    def __init__(self, name):
+        self.__lock = threading.Lock()
+        self.__latest = None
+        self.__drains = Counter('roboblue_drains_total', 'Drains of the application on shutdown and reload')
+        self.__abandoned = Counter('roboblue_drain_abandoned_total', 'Work abandoned by drains past their deadline')
+        self.__duration = Gauge('roboblue_drain_duration_seconds', 'Duration of the latest drain')
+        Monitor.__init__(self, name)
+
+    def record(self, drain):
+        # type: (Drain) -> None
+        with self.__lock:
+            self.__latest = drain
+        self.__drains.inc()
+        self.__abandoned.inc(sum(drain.abandoned.values()))
+        self.__duration.set(drain.duration)
+
+    @property
+    def healthy(self):
+        return None
+
+    @property
+    def metrics(self):
+        return [self.__drains, self.__abandoned, self.__duration]
+
+    def report_status(self):
+        drain = self.__latest
+        return {
+            'drain_count': self.__drains.value,
+            'abandoned_count': self.__abandoned.value,
+            'latest': None if drain is None else {
+                'name': drain.name,
+                'started': format_timestamp(drain.started),
+                'duration': format_duration(drain.duration),
+                'abandoned': drain.abandoned
+            }
+        }
@@ -3,8 +3,10 @@ from dxlclient import _on_connect, _on_disconnect
 import threading
 import time
 
+from .drain import InFlight
 from .monitor import Monitor
 from .kit import format_timestamp
+from .metrics import Counter
 
 
 class DxlClientMonitor(Monitor):
@@ -17,6 +19,9 @@ class DxlClientMonitor(Monitor):
         self.__latest_conn = None
         self.__latest_dc = None
         self.__lock = threading.Lock()
+        self.__connections = Counter('roboblue_dxl_connections_total', 'Connections of the DXL client to the broker')
+        self.__disconnections = Counter('roboblue_dxl_disconnections_total',
+                                        'Disconnections of the DXL client from the broker')
         self.client = None
         Monitor.__init__(self, name)
 
@@ -30,10 +35,16 @@ class DxlClientMonitor(Monitor):
             if self.__initial_conn is None:
                 self.__initial_conn = now
             self.__latest_conn = now
+        self.__connections.inc()
 
     def record_disconnection(self):
         with self.__lock:
             self.__latest_dc = time.time()
+        self.__disconnections.inc()
+
+    @property
+    def metrics(self):
+        return [self.__connections, self.__disconnections]
 
     def report_status(self):
         return {
@@ -46,13 +57,16 @@ class DxlClientMonitor(Monitor):
 class MonitorableDxlClient(DxlClient):
     """
     A DxlClient that can have a monitor attached to itself and report on some events by rudely overriding some
-    of the callbacks given to the underlying MQTT client.
+    of the callbacks given to the underlying MQTT client. The callbacks of the client count themselves in flight for
+    the client to be drained before it's disconnected.
     """
 
     def __init__(self, config, monitor):
         DxlClient.__init__(self, config)
         self.__monitor = monitor
+        self.in_flight = InFlight()
         monitor.client = self
+        monitor.notify_health()
 
         # Not a nice thing to do, but for monitoring purposes we need to tinker with some internal callbacks in order
         # to wrap them with calls to the monitor
@@ -62,7 +76,9 @@ class MonitorableDxlClient(DxlClient):
     def on_connect(self, client, userdata, flags, rc):
         self.__monitor.record_connection()
         _on_connect(client, userdata, flags, rc)
+        self.__monitor.notify_health()
 
     def on_disconnect(self, client, userdata, rc):
         self.__monitor.record_disconnection()
         _on_disconnect(client, userdata, rc)
+        self.__monitor.notify_health()
@@ -0,0 +1,158 @@
+"""
+Bounded executor for the request callbacks of the service endpoints.
+
+dxlclient calls the request callbacks of every endpoint of a service on the threads of one incoming message pool, an
+endpoint slow to respond taking up every thread and starving the others. The endpoints hand their requests over to a
+lane of the executor instead. Every lane queues up to a bounded number of requests and runs at most its concurrency cap
+of them at a time on the threads of the executor, the threads serving the lanes in turn. A lane with a full queue
+rejects requests at once, for the endpoint to answer that it's overloaded rather than to let the requests time out.
+"""
+from collections import deque
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Lane:
+    """
+    Lane of the executor for the requests of one endpoint
+    """
+
+    def __init__(self, executor, name, max_concurrency, queue_size):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.running = 0
+        self.__executor = executor
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def submit(self, function, *args):
+        """
+        Queue a call to run on the threads of the executor
+        :return: False when the queue is full and the call was rejected
+        """
+        return self.__executor.submit(self, function, args)
+
+
+class Executor:
+    """
+    Executor runs the calls queued in its lanes on a fixed number of threads
+    """
+
+    def __init__(self, workers=16, queue_size=100, max_concurrency=None, limits=None):
+        """
+        :param workers: Number of threads
+        :param queue_size: Default queue size of the lanes
+        :param max_concurrency: Default concurrency cap of the lanes, half the threads when omitted
+        :param limits: Concurrency caps and queue sizes of the lanes by name as (max_concurrency, queue_size) tuples,
+        either may be None for the default
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_concurrency = max_concurrency if max_concurrency is not None else max(1, workers // 2)
+        self.__limits = limits if limits is not None else {}
+        self.__condition = threading.Condition()
+        self.__lanes = {}
+        self.__order = []  # Lanes in the order served
+        self.__next = 0
+        self.__threads = []
+        self.__running = False
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: ExecutorConfig
+        :return: Executor, None when the executor isn't configured
+        """
+        if config is None:
+            return None
+        return Executor(config.workers, config.queue_size, config.max_concurrency, config.limits)
+
+    def lane(self, name):
+        """
+        The lane of the given name, created on first use
+        :return: Lane
+        """
+        with self.__condition:
+            lane = self.__lanes.get(name)
+            if lane is None:
+                max_concurrency, queue_size = self.__limits.get(name, (None, None))
+                lane = Lane(
+                    self,
+                    name,
+                    max_concurrency if max_concurrency is not None else self.max_concurrency,
+                    queue_size if queue_size is not None else self.queue_size
+                )
+                self.__lanes[name] = lane
+                self.__order.append(lane)
+            return lane
+
+    def start(self):
+        self.__running = True
+        for i in range(self.workers):
+            thread = threading.Thread(name='Executor-{}'.format(i), target=self.__work)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, lane, function, args):
+        with self.__condition:
+            if len(lane.queue) >= lane.queue_size:
+                return False
+            lane.queue.append((function, args))
+            self.__condition.notify()
+        return True
+
+    def __take(self):
+        """
+        Take the next call of the lanes in turn, skipping the lanes running as many calls as their cap allows
+        """
+        count = len(self.__order)
+        for i in range(count):
+            lane = self.__order[(self.__next + i) % count]
+            if lane.queue and lane.running < lane.max_concurrency:
+                self.__next = (self.__next + i + 1) % count
+                lane.running += 1
+                return lane, lane.queue.popleft()
+        return None
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                task = self.__take()
+                while task is None:
+                    if not self.__running:
+                        return
+                    self.__condition.wait()
+                    task = self.__take()
+            lane, (function, args) = task
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('call queued in lane %s failed', lane.name)
+            finally:
+                with self.__condition:
+                    lane.running -= 1
+                    # A lane that was at its cap may have calls to run
+                    if lane.queue:
+                        self.__condition.notify()
+
+    def stop(self, timeout=5):
+        """
+        Stop the threads once they've run the queued calls
+        :param timeout: Seconds to wait for the threads
+        :return: None
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        deadline = time.time() + timeout
+        for thread in self.__threads:
+            thread.join(max(0, deadline - time.time()))
+        self.__threads = []
@@ -1,62 +1,269 @@
 import threading
 import time
 
+from .metrics import Counter, Gauge, LatencyHistogram, RollingWindow
 from .monitor import Monitor
+from .tracing import Trace, Tracer
+
+
+class ErrorRatioRule:
+    """
+    Health rule considering a service endpoint unhealthy while the ratio of internal errors to requests received within
+    the window exceeds the maximum. Endpoints having received fewer requests than the minimum within the window are
+    considered healthy, a handful of errors isn't telling
+    """
+    def __init__(self, window=60, max_error_ratio=0.1, min_requests=10):
+        self.window = window
+        self.max_error_ratio = max_error_ratio
+        self.min_requests = min_requests
+
+    def healthy(self, requests, errors):
+        return requests < self.min_requests or errors <= self.max_error_ratio * requests
 
 
 class ServiceEndpointMonitor(Monitor):
     """
     Service endpoint monitor is included with the roboblue kit to create an unified way to monitor OpenDXL service
-    endpoints
+    endpoints. Besides the cumulative totals it keeps the rates and latency of the past 1, 5 and 15 minutes, health
+    being decided by the error ratio rule of the monitoring context unless one is given. The latency of the phases of
+    processing a request is kept per phase from the traces started with the monitor
     """
-    def __init__(self, name):
+
+    # Reported windows as (label, seconds) tuples
+    WINDOWS = [('1m', 60), ('5m', 300), ('15m', 900)]
+
+    # Seconds between health evaluations on the request path
+    EVALUATION_INTERVAL = 1
+
+    # The errors of the latest evaluation interval are only judged by the next request, if any
+    POLLED_HEALTH = True
+
+    DEFAULT_HEALTH_RULE = ErrorRatioRule()
+
+    def __init__(self, name, health_rule=None):
+        # type: (str, ErrorRatioRule) -> None
         self.__lock = threading.Lock()
         self.__first_request = None
         self.__latest_request = None
-        self.__request_count = 0
-        self.__error_count = 0  # Internal errors
-        self.__in_error = False
+        self.__requests = Counter('roboblue_endpoint_requests_total', 'Requests received by the service endpoint')
+        self.__errors = Counter('roboblue_endpoint_errors_total', 'Internal errors of the service endpoint')
+        self.__latency = LatencyHistogram('roboblue_endpoint_latency_seconds',
+                                          'Time taken by the service endpoint to process a request')
+        self.__window = RollingWindow(span=self.WINDOWS[-1][1])
+        self.__rule = health_rule
+        self.__configured = health_rule is not None
+        self.__healthy = True
+        self.__evaluated = 0
+        self.__error_ratio = Gauge('roboblue_endpoint_error_ratio',
+                                   'Ratio of internal errors to requests within the health rule window',
+                                   self.__current_error_ratio)
+        self.__tracer = None
+        self.__phases = {}  # phase -> LatencyHistogram
+        self.__lane = None
+        self.__rejected = Counter('roboblue_endpoint_rejected_total',
+                                  'Requests rejected by the service endpoint with its queue full')
         Monitor.__init__(self, name)
 
+    def attach(self, context):
+        if not self.__configured:
+            self.__rule = context.endpoint_health
+        self.__tracer = context.tracer
+        if context.executor is not None:
+            # Lanes are named after the topic of the endpoint, the part of the monitor name after its group
+            self.__lane = context.executor.lane(self.name.partition('.')[2] or self.name)
+
+    def submit(self, function, *args):
+        """
+        Process a request in the executor lane of the endpoint, or right away on the calling thread when the monitoring
+        context has no executor
+        :param function: Function processing the request
+        :return: False when the queue of the endpoint is full and the request was rejected
+        """
+        lane = self.__lane
+        if lane is None:
+            function(*args)
+            return True
+        if lane.submit(function, *args):
+            return True
+        self.__rejected.inc()
+        return False
+
+    def trace(self):
+        """
+        Start tracing the phases of processing a request on the calling thread, the trace is to be finished once the
+        request has been responded to
+        :return: Trace
+        """
+        tracer = self.__tracer
+        if tracer is None:
+            return Trace(self.name, listener=self.__record_phases)
+        return tracer.start(self.name, self.__record_phases)
+
+    def __record_phases(self, trace):
+        for phase, _, duration in trace.spans:
+            histogram = self.__phases.get(phase)
+            if histogram is None:
+                with self.__lock:
+                    histogram = self.__phases.setdefault(phase, LatencyHistogram(
+                        'roboblue_endpoint_phase_seconds', 'Time taken by a phase of processing a request',
+                        labels=[('phase', phase)]
+                    ))
+            histogram.record(duration)
+
+    @property
+    def health_rule(self):
+        return self.__rule if self.__rule is not None else self.DEFAULT_HEALTH_RULE
+
+    def __current_error_ratio(self):
+        _, requests, errors = self.__window.counts(self.health_rule.window)
+        return errors / float(requests) if requests else None
+
+    def __evaluate(self, now):
+        """
+        Apply the health rule to the recent history, notifying the listeners when the health flips
+        """
+        self.__evaluated = now
+        rule = self.health_rule
+        _, requests, errors = self.__window.counts(rule.window, now)
+        healthy = rule.healthy(requests, errors)
+        with self.__lock:
+            changed = healthy != self.__healthy
+            self.__healthy = healthy
+        if changed:
+            self.notify_health()
+        return healthy
+
     def register_request(self):
         """
         Register the receipt of a new DXL request message
-        :return: None
+        :return: Time of receipt to be passed on when registering the outcome of the request
         """
-        with self.__lock:
-            now = time.time()
-            if self.__first_request is None:
-                self.__first_request = now
-            self.__latest_request = now
-            self.__request_count += 1
+        now = time.time()
+        if self.__first_request is None:
+            with self.__lock:
+                if self.__first_request is None:
+                    self.__first_request = now
+        self.__latest_request = now
+        self.__requests.inc()
+        self.__window.record_request(now)
+        return now
+
+    def __register_outcome(self, error, received):
+        now = time.time()
+        latency = None
+        if received is not None:
+            latency = now - received
+            self.__latency.record(latency)
+        self.__window.record_outcome(error, latency, now)
+        if now - self.__evaluated >= self.EVALUATION_INTERVAL:
+            self.__evaluate(now)
 
-    def register_success(self):
+    def register_success(self, received=None):
         """
         Register the successful processing of a DXL request
+        :param received: Time of receipt returned by register_request, the latency isn't recorded when omitted
         :return: None
         """
-        with self.__lock:
-            self.__in_error = False
+        self.__register_outcome(False, received)
 
-    def register_error(self):
+    def register_error(self, received=None):
         """
         Register an internal error that occurred within the service
+        :param received: Time of receipt returned by register_request, the latency isn't recorded when omitted
         :return: None
         """
-        with self.__lock:
-            self.__in_error = True
-            self.__error_count += 1
+        self.__errors.inc()
+        self.__register_outcome(True, received)
 
     @property
     def healthy(self):
-        return not self.__in_error
+        # Errors fall out of the window while idle, evaluate afresh
+        return self.__evaluate(time.time())
+
+    @property
+    def metrics(self):
+        metrics = [self.__requests, self.__errors, self.__latency, self.__error_ratio] + self.__phases.values()
+        lane = self.__lane
+        if lane is not None:
+            metrics += [
+                self.__rejected,
+                Gauge('roboblue_endpoint_queue_depth', 'Requests waiting in the queue of the service endpoint',
+                      lambda: lane.depth),
+                Gauge('roboblue_endpoint_requests_in_progress', 'Requests being processed by the service endpoint',
+                      lambda: lane.running)
+            ]
+        return metrics
+
+    def __report_window(self, seconds, now):
+        elapsed, requests, errors, counts, total, maximum = self.__window.summary(seconds, now)
+        return {
+            'request_rate': round(requests / elapsed, 3) if elapsed > 0 else None,
+            'error_rate': round(errors / elapsed, 3) if elapsed > 0 else None,
+            'error_ratio': round(errors / float(requests), 4) if requests else None,
+            'latency': format_latency(self.__window.buckets, counts, sum(counts), total, maximum)
+        }
 
     def report_status(self):
+        now = time.time()
         return {
             'first_request_received': format_timestamp(self.__first_request),
             'latest_request_received': format_timestamp(self.__latest_request),
-            'request_count': self.__request_count,
-            'error_count': self.__error_count
+            'request_count': self.__requests.value,
+            'error_count': self.__errors.value,
+            'latency': format_histogram(self.__latency),
+            'windows': dict((label, self.__report_window(seconds, now)) for label, seconds in self.WINDOWS),
+            'phases': dict((phase, format_histogram(histogram)) for phase, histogram in self.__phases.items()),
+            'queue': self.__report_queue()
+        }
+
+    def __report_queue(self):
+        lane = self.__lane
+        if lane is None:
+            return None
+        return {
+            'depth': lane.depth,
+            'queue_size': lane.queue_size,
+            'in_progress': lane.running,
+            'max_concurrency': lane.max_concurrency,
+            'rejected_count': self.__rejected.value
+        }
+
+
+class TracingMonitor(Monitor):
+    """
+    Tracing monitor reports on the traces sampled by the tracer, listing the slowest of the traces kept
+    """
+
+    # Number of the slowest traces reported
+    SLOWEST = 5
+
+    def __init__(self, name, tracer):
+        # type: (str, Tracer) -> None
+        self.__tracer = tracer
+        Monitor.__init__(self, name)
+
+    @property
+    def healthy(self):
+        return None
+
+    @property
+    def metrics(self):
+        return [
+            self.__tracer.requests,
+            Counter('roboblue_traces_sampled_total', 'Traces sampled', lambda: self.__tracer.sampled)
+        ]
+
+    def report_status(self):
+        tracer = self.__tracer
+        traces = tracer.traces
+        traces.sort(key=lambda t: t.duration, reverse=True)
+        return {
+            'sample_rate': tracer.sample_rate,
+            'traced': tracer.requests.value,
+            'sampled': tracer.sampled,
+            'exported': tracer.exported,
+            'kept': len(traces),
+            'slowest': [format_trace(t) for t in traces[:self.SLOWEST]]
         }
 
 
@@ -69,6 +276,59 @@ def format_timestamp(stamp):
     return None if stamp is None else int(stamp * 10e3)
 
 
+def format_duration(duration):
+    """
+    Consistent way to format a floating point duration in seconds to a ms resolution one
+    :param duration: floating point duration in seconds
+    :return: Float, ms resolution duration
+    """
+    return None if duration is None else round(duration * 1e3, 3)
+
+
+def format_histogram(histogram):
+    """
+    Consistent way to summarize a latency histogram
+    :param histogram: LatencyHistogram
+    :return: dict of the sample count and ms resolution average, percentiles and max
+    """
+    counts, count, total, maximum = histogram.snapshot()
+    return format_latency(histogram.buckets, counts, count, total, maximum)
+
+
+def format_latency(buckets, counts, count, total, maximum):
+    """
+    Consistent way to summarize latency bucket counts
+    :return: dict of the sample count and ms resolution average, percentiles and max
+    """
+    p50, p90, p99 = LatencyHistogram.percentiles_of(buckets, counts, count, maximum, [0.5, 0.9, 0.99])
+    return {
+        'count': count,
+        'average_ms': format_duration(total / count if count else None),
+        'p50_ms': format_duration(p50),
+        'p90_ms': format_duration(p90),
+        'p99_ms': format_duration(p99),
+        'max_ms': format_duration(maximum)
+    }
+
+
+def format_trace(trace):
+    """
+    Consistent way to summarize a finished trace
+    :param trace: Trace
+    :return: dict of the trace with ms resolution durations
+    """
+    return {
+        'name': trace.name,
+        'started': format_timestamp(trace.started),
+        'duration_ms': format_duration(trace.duration),
+        'error': trace.error,
+        'spans': [
+            {'phase': phase, 'offset_ms': format_duration(offset), 'duration_ms': format_duration(duration)}
+            for phase, offset, duration in trace.spans
+        ]
+    }
+
+
 class InvalidConfigException(Exception):
     pass
 
@@ -102,12 +362,22 @@ def require_and_try_coercion(keyword, t, container):
         raise InvalidConfigException('{} must be coercible to {}'.format(keyword, t))
 
 
+def optional_and_try_coercion(keyword, t, container):
+    if keyword in container:
+        require_and_try_coercion(keyword, t, container)
+
+
 def require_and_enforce_values(keyword, possible_values, container):
     require(keyword, container)
     if container[keyword] not in possible_values:
         raise InvalidConfigException('Value for keyword {} is not allowed')
 
 
+def optional_and_enforce_values(keyword, possible_values, container):
+    if keyword in container:
+        require_and_enforce_values(keyword, possible_values, container)
+
+
 def run_validators(spec, container):
     for triple in spec:
         keyword, t, validator = triple
@@ -0,0 +1,419 @@
+"""
+Fixed memory metric primitives for monitors to record measurements on the hot paths of the services.
+
+Metrics carry a name and help text so that monitors can declare them for exposition in the Prometheus text format.
+Metrics of the same name declared by different monitors form a single metric family told apart by the monitor label.
+
+Counters and histograms are sharded per thread so that the threads of a callback pool recording measurements don't
+contend on a lock, the shards are only aggregated when read.
+
+Rolling windows complement the cumulative metrics with the counts of the recent past, kept in a ring of time slots
+sharded per thread in the same way.
+"""
+from bisect import bisect_left
+import math
+import threading
+import time
+
+
+class Shards:
+    """
+        Shards keeps a shard of a metric per thread. Every thread updates its own shard without locking, the shards
+        are aggregated when the metric is read. The shards of threads that have exited are folded into a retired
+        shard as new shards are created, bounding memory use by the number of live threads
+    """
+
+    def __init__(self, factory, merge):
+        """
+        :param factory: Function creating an empty shard
+        :param merge: Function merging the second shard into the first one
+        """
+        self.__factory = factory
+        self.__merge = merge
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__shards = []  # (owning thread, shard) tuples
+        self.__retired = factory()
+
+    def local(self):
+        """
+        The shard of the calling thread, to be updated only by the calling thread
+        """
+        try:
+            return self.__local.shard
+        except AttributeError:
+            return self.__create()
+
+    def __create(self):
+        shard = self.__factory()
+        with self.__lock:
+            live = []
+            for owner, other in self.__shards:
+                if owner.is_alive():
+                    live.append((owner, other))
+                else:
+                    self.__merge(self.__retired, other)
+            live.append((threading.current_thread(), shard))
+            self.__shards = live
+        self.__local.shard = shard
+        return shard
+
+    def aggregate(self):
+        """
+        Merge all the shards
+        :return: A new shard holding the aggregate
+        """
+        result = self.__factory()
+        with self.__lock:
+            self.__merge(result, self.__retired)
+            for _, shard in self.__shards:
+                self.__merge(result, shard)
+        return result
+
+
+def merge_counts(into, shard):
+    into[0] += shard[0]
+
+
+class Counter:
+    """
+        Counter is a monotonically increasing count. The count is either incremented explicitly or read from the
+        function given when the counter is sampled, the latter exposing a count the monitor keeps on its own
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name=None, help=None, function=None):
+        self.name = name
+        self.help = help
+        self.__function = function
+        self.__shards = Shards(lambda: [0], merge_counts)
+
+    def inc(self, amount=1):
+        self.__shards.local()[0] += amount
+
+    @property
+    def value(self):
+        return self.__function() if self.__function is not None else self.__shards.aggregate()[0]
+
+    def samples(self):
+        """
+        Samples of the metric for exposition
+        :return: list of (name suffix, extra labels, value) tuples
+        """
+        return [('', (), self.value)]
+
+
+class Gauge:
+    """
+        Gauge is a value that can go up and down. The value is either set explicitly or read from the function given
+        when the gauge is sampled
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name=None, help=None, function=None):
+        self.name = name
+        self.help = help
+        self.__function = function
+        self.__value = None
+
+    def set(self, value):
+        self.__value = value
+
+    @property
+    def value(self):
+        return self.__function() if self.__function is not None else self.__value
+
+    def samples(self):
+        value = self.value
+        return [] if value is None else [('', (), value)]
+
+
+def log_buckets(lowest, highest, factor):
+    """
+    Put together logarithmically spaced bucket upper bounds
+    :param lowest: Upper bound of the first bucket
+    :param highest: Value the upper bound of the last bucket is to reach
+    :param factor: Ratio of the upper bounds of neighbouring buckets
+    :return: list of upper bounds
+    """
+    bounds = [lowest]
+    while bounds[-1] < highest:
+        bounds.append(bounds[-1] * factor)
+    return bounds
+
+
+# Latency bucket upper bounds in seconds from 10us to ~2min, each bucket being ~41% wider than the previous one
+LATENCY_BUCKETS = log_buckets(1e-5, 100, 2 ** 0.5)
+
+
+class LatencyHistogram:
+    """
+        LatencyHistogram counts latency samples in logarithmically spaced buckets. Memory use is fixed by the number
+        of buckets, recording a sample is a binary search and an increment. Percentiles are accurate to the width of
+        the bucket they fall in
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name=None, help=None, buckets=LATENCY_BUCKETS, labels=()):
+        """
+        :param labels: (name, value) tuples telling apart the histograms of a monitor sharing the metric name
+        """
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = tuple(labels)
+        # Shards are [bucket counts, sample count, sample sum, max sample] lists, the last bucket counting the
+        # samples exceeding the highest bound
+        self.__shards = Shards(lambda: [[0] * (len(buckets) + 1), 0, 0.0, None], LatencyHistogram.__merge)
+
+    @staticmethod
+    def __merge(into, shard):
+        counts = into[0]
+        for i, n in enumerate(shard[0]):
+            counts[i] += n
+        into[1] += shard[1]
+        into[2] += shard[2]
+        if shard[3] is not None and (into[3] is None or shard[3] > into[3]):
+            into[3] = shard[3]
+
+    def record(self, latency):
+        """
+        Record a latency sample
+        :param latency: Latency in seconds
+        :return: None
+        """
+        shard = self.__shards.local()
+        shard[0][bisect_left(self.buckets, latency)] += 1
+        shard[1] += 1
+        shard[2] += latency
+        if shard[3] is None or latency > shard[3]:
+            shard[3] = latency
+
+    def snapshot(self):
+        """
+        Copy of the histogram, samples being recorded while copying may be partially included
+        :return: (bucket counts, sample count, sample sum, max sample) tuple
+        """
+        counts, _, total, maximum = self.__shards.aggregate()
+        # Counted from the buckets for the two to agree
+        return counts, sum(counts), total, maximum
+
+    @staticmethod
+    def percentiles_of(buckets, counts, count, maximum, quantiles):
+        """
+        Estimate the percentiles as the upper bounds of the buckets they fall in, capped by the largest sample
+        """
+        result = []
+        for q in quantiles:
+            if count == 0:
+                result.append(None)
+                continue
+            rank = q * count
+            seen = 0
+            for i, n in enumerate(counts):
+                seen += n
+                if seen >= rank and n:
+                    break
+            result.append(min(buckets[i], maximum) if i < len(buckets) else maximum)
+        return result
+
+    def percentiles(self, quantiles):
+        """
+        Estimate the percentiles of the recorded samples
+        :param quantiles: list of quantiles from 0 to 1
+        :return: list of latencies in seconds, None when there are no samples
+        """
+        counts, count, _, maximum = self.snapshot()
+        return self.percentiles_of(self.buckets, counts, count, maximum, quantiles)
+
+    def samples(self):
+        counts, count, total, _ = self.snapshot()
+        labels = self.labels
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            samples.append(('_bucket', labels + (('le', repr(bound)),), cumulative))
+        samples.append(('_bucket', labels + (('le', '+Inf'),), count))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, count))
+        return samples
+
+
+class RollingWindow:
+    """
+        RollingWindow counts requests, errors and latency samples over the recent past in a ring of fixed duration
+        slots. Memory is fixed by the span and the resolution as a slot is reused once it falls out of the span, the
+        latency counts of a slot are only allocated once a sample is recorded in it. Every thread records in a ring of
+        its own, the rings being merged when the window is read
+    """
+
+    def __init__(self, span=900, resolution=5, buckets=LATENCY_BUCKETS):
+        """
+        :param span: Seconds of history kept
+        :param resolution: Duration of a slot in seconds, windows are accurate to a slot
+        :param buckets: Latency bucket upper bounds
+        """
+        self.span = span
+        self.resolution = resolution
+        self.buckets = buckets
+        self.__size = int(math.ceil(span / float(resolution)))
+        self.__shards = Shards(self.__ring, RollingWindow.__merge)
+        self.__created = time.time()
+
+    def __ring(self):
+        # Slots are [slot number, requests, errors, bucket counts, latency sum, max latency] lists
+        return [[None, 0, 0, None, 0.0, None] for _ in range(self.__size)]
+
+    @staticmethod
+    def __merge(into, ring):
+        for slot, other in zip(into, ring):
+            number, requests, errors, counts, total, maximum = other
+            if number is None or (slot[0] is not None and slot[0] > number):
+                continue
+            if slot[0] != number:
+                slot[:] = [number, 0, 0, None, 0.0, None]
+            slot[1] += requests
+            slot[2] += errors
+            if counts is not None:
+                if slot[3] is None:
+                    slot[3] = [0] * len(counts)
+                for i, n in enumerate(counts):
+                    slot[3][i] += n
+                slot[4] += total
+                if slot[5] is None or maximum > slot[5]:
+                    slot[5] = maximum
+
+    def __slot(self, now):
+        number = int(now // self.resolution)
+        slots = self.__shards.local()
+        slot = slots[number % len(slots)]
+        if slot[0] is None or slot[0] < number:
+            slot[:] = [number, 0, 0, None, 0.0, None]
+        elif slot[0] > number:
+            # Older than the span, the clock may have been set back
+            return None
+        return slot
+
+    def record_request(self, now=None):
+        """
+        Count a received request
+        :param now: Time of receipt, the current time by default
+        :return: None
+        """
+        slot = self.__slot(time.time() if now is None else now)
+        if slot is not None:
+            slot[1] += 1
+
+    def record_outcome(self, error, latency=None, now=None):
+        """
+        Count the outcome of a request
+        :param error: Whether the request failed
+        :param latency: Latency in seconds, not recorded when omitted
+        :param now: Time of the outcome, the current time by default
+        :return: None
+        """
+        slot = self.__slot(time.time() if now is None else now)
+        if slot is None:
+            return
+        if error:
+            slot[2] += 1
+        if latency is not None:
+            if slot[3] is None:
+                slot[3] = [0] * (len(self.buckets) + 1)
+            slot[3][bisect_left(self.buckets, latency)] += 1
+            slot[4] += latency
+            if slot[5] is None or latency > slot[5]:
+                slot[5] = latency
+
+    def __range(self, seconds, now):
+        current = int(now // self.resolution)
+        oldest = current - int(math.ceil(min(seconds, self.span) / float(self.resolution))) + 1
+        # The current slot is only partially elapsed and a young window doesn't cover the whole span, rates over the
+        # first moments being meaningless the elapsed time is at least a second
+        elapsed = max(min(now - oldest * self.resolution, now - self.__created), 1.0)
+        return oldest, current, elapsed
+
+    def counts(self, seconds, now=None):
+        """
+        Count the requests and errors within the window
+        :param seconds: Duration of the window, up to the span
+        :param now: End of the window, the current time by default
+        :return: (elapsed seconds, requests, errors) tuple
+        """
+        oldest, current, elapsed = self.__range(seconds, time.time() if now is None else now)
+        requests = errors = 0
+        for slot in self.__shards.aggregate():
+            if slot[0] is not None and oldest <= slot[0] <= current:
+                requests += slot[1]
+                errors += slot[2]
+        return elapsed, requests, errors
+
+    def summary(self, seconds, now=None):
+        """
+        Put together the counts and the latency histogram of the window
+        :param seconds: Duration of the window, up to the span
+        :param now: End of the window, the current time by default
+        :return: (elapsed seconds, requests, errors, bucket counts, latency sum, max latency) tuple
+        """
+        oldest, current, elapsed = self.__range(seconds, time.time() if now is None else now)
+        requests = errors = 0
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        maximum = None
+        for number, slot_requests, slot_errors, slot_counts, slot_total, slot_maximum in self.__shards.aggregate():
+            if number is None or not oldest <= number <= current:
+                continue
+            requests += slot_requests
+            errors += slot_errors
+            if slot_counts is not None:
+                for i, n in enumerate(slot_counts):
+                    counts[i] += n
+                total += slot_total
+                if maximum is None or slot_maximum > maximum:
+                    maximum = slot_maximum
+        return elapsed, requests, errors, counts, total, maximum
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(monitors):
+    """
+    Render the metrics declared by the monitors in the Prometheus text exposition format
+    :param monitors: list of (monitor name, metrics) tuples. Metrics with a monitor attribute of their own, those
+    relayed from another process, are labelled with it instead
+    :return: The exposition
+    """
+    families = {}
+    for monitor, metrics in monitors:
+        for metric in metrics:
+            if metric.name not in families:
+                families[metric.name] = (metric.kind, metric.help, [])
+            families[metric.name][2].append((getattr(metric, 'monitor', None) or monitor, metric))
+
+    lines = []
+    for name in sorted(families):
+        kind, help, members = families[name]
+        if help:
+            lines.append('# HELP {} {}'.format(name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for monitor, metric in members:
+            for suffix, labels, value in metric.samples():
+                labels = [('monitor', monitor)] + list(labels)
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, ','.join(
+                    '{}="{}"'.format(k, escape_label(v)) for k, v in labels
+                ), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
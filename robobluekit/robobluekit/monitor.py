@@ -1,7 +1,13 @@
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-import json
+from SocketServer import ThreadingMixIn
 import logging
 import threading
+import time
+import urllib
+import urlparse
+
+from . import codec
+from .metrics import Gauge, render
 
 logger = logging.getLogger(__name__)
 
@@ -11,8 +17,13 @@ class Monitor:
     A monitor reports information about some aspect of an running system.
     """
 
+    # Whether the health of the monitor changes with time, without the monitor being able to notify of it. The health of
+    # such monitors is polled whenever the aggregate health is asked for
+    POLLED_HEALTH = False
+
     def __init__(self, name):
         self.name = name
+        self.__listeners = []
 
     @property
     def healthy(self):
@@ -29,14 +40,115 @@ class Monitor:
         """
         raise NotImplementedError('Requires implementation')
 
+    @property
+    def metrics(self):
+        """
+        Typed metrics of the system under monitoring for exposition
+        :return: list of Counter, Gauge and LatencyHistogram instances
+        """
+        return []
+
+    def attach(self, context):
+        """
+        Hook called when the monitor is registered with a monitoring context
+        :param context: The MonitoringContext
+        :return: None
+        """
+        pass
 
-class MonitoringContext:
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def notify_health(self):
+        """
+        Let the listeners know that the health of the monitored system may have changed. Monitors are expected to call
+        this whenever their health changes so that the aggregate health is kept up to date without polling
+        :return: None
+        """
+        for listener in list(self.__listeners):
+            listener(self)
+
+
+class StatusNode:
     """
-    MonitoringContext manages the registration of Monitors and acts as a registry
+    Node of the status tree, a node holds the monitor registered under its path if any and the nodes below it
     """
 
     def __init__(self):
+        self.monitor = None
+        self.children = {}
+
+
+class MonitoringContext:
+    """
+    MonitoringContext manages the registration of Monitors and acts as a registry. Monitors are kept in a tree by
+    their dot separated names, the tree and the aggregate health being kept up to date as monitors are registered,
+    unregistered and notify of changes in their health
+    """
+
+    def __init__(self, endpoint_health=None, tracer=None, executor=None):
+        """
+        :param endpoint_health: Health rule of the service endpoint monitors registered with the context, the default
+        rule of the monitors when omitted
+        :param tracer: Tracer sampling the traces of the service endpoint monitors registered with the context, no
+        traces are sampled when omitted
+        :param executor: Executor the service endpoints registered with the context process their requests in, the
+        requests are processed on the threads of the DXL client when omitted
+        """
+        self.endpoint_health = endpoint_health
+        self.tracer = tracer
+        self.executor = executor
+        self.__lock = threading.RLock()
         self.__monitors = {}
+        self.__root = StatusNode()
+        self.__unhealthy = set()
+        self.__polled = set()
+
+    def __health_changed(self, monitor):
+        self.__set_health(monitor, monitor.healthy)
+
+    def __set_health(self, monitor, healthy):
+        with self.__lock:
+            if self.__monitors.get(monitor.name) is not monitor:
+                return
+            if healthy is False:
+                self.__unhealthy.add(monitor.name)
+            else:
+                self.__unhealthy.discard(monitor.name)
+
+    def __attach(self, monitor):
+        node = self.__root
+        for v in monitor.name.split('.'):
+            if v not in node.children:
+                node.children[v] = StatusNode()
+            node = node.children[v]
+        node.monitor = monitor
+        self.__monitors[monitor.name] = monitor
+        if monitor.POLLED_HEALTH:
+            self.__polled.add(monitor.name)
+        monitor.attach(self)
+        monitor.add_listener(self.__health_changed)
+        self.__health_changed(monitor)
+
+    def __detach(self, name):
+        monitor = self.__monitors.pop(name)
+        monitor.remove_listener(self.__health_changed)
+        self.__unhealthy.discard(name)
+        self.__polled.discard(name)
+        path = [self.__root]
+        for v in name.split('.'):
+            path.append(path[-1].children[v])
+        path[-1].monitor = None
+        # Prune the nodes left empty
+        for parent, v in reversed(zip(path[:-1], name.split('.'))):
+            child = parent.children[v]
+            if child.monitor is not None or child.children:
+                break
+            del parent.children[v]
 
     def register(self, monitor, preserve=True):
         """
@@ -46,14 +158,17 @@ class MonitoringContext:
         :return: Returns a registered monitor instance
         """
         # type: (Monitor, bool) -> Monitor
-        if preserve and monitor.name in self.__monitors:
-            if type(self.__monitors[monitor.name]) == type(monitor):
-                # Just give them a pointer at the already existent monitor
-                monitor = self.__monitors[monitor.name]
+        with self.__lock:
+            if preserve and monitor.name in self.__monitors:
+                if type(self.__monitors[monitor.name]) == type(monitor):
+                    # Just give them a pointer at the already existent monitor
+                    monitor = self.__monitors[monitor.name]
+                else:
+                    raise ValueError('mismatch in monitor types blocks registration in preservation mode')
             else:
-                raise ValueError('mismatch in monitor types blocks registration in preservation mode')
-        else:
-            self.__monitors[monitor.name] = monitor
+                if monitor.name in self.__monitors:
+                    self.__detach(monitor.name)
+                self.__attach(monitor)
         return monitor
 
     def unregister(self, name):
@@ -63,91 +178,301 @@ class MonitoringContext:
         :return: None
         """
         # type: (str) -> None
-        if name in self.__monitors:
-            del self.__monitors[name]
+        with self.__lock:
+            if name in self.__monitors:
+                self.__detach(name)
 
-    def report_status(self):
+    @property
+    def healthy(self):
+        """
+        Aggregate health of all registered monitors, maintained as the monitors notify of changes in their health and
+        polled from the monitors whose health changes with time
+        """
+        # Health judged on recent history recovers as the history ages, without anything to notify of it
+        with self.__lock:
+            names = self.__unhealthy | self.__polled
+        for name in names:
+            monitor = self.__monitors.get(name)
+            if monitor is not None:
+                self.__set_health(monitor, monitor.healthy)
+        return not self.__unhealthy
+
+    def __find(self, path):
+        """
+        Resolve the node addressed by the path. As monitor names may contain slashes, a path segment may span several
+        slash separated components. A path ending in the middle of names addresses all the nodes starting with it
+        """
+        node = self.__root
+        path = path.strip('/')
+        while path:
+            matched = None
+            for key in node.children.keys():
+                stripped = key.strip('/')
+                if path == stripped or path.startswith(stripped + '/'):
+                    if matched is None or len(stripped) > len(matched.strip('/')):
+                        matched = key
+            if matched is not None:
+                node = node.children[matched]
+                path = path[len(matched.strip('/')):].lstrip('/')
+                continue
+            # Nodes whose names start with the rest of the path
+            prefixed = StatusNode()
+            for key, child in node.children.items():
+                if key.strip('/').startswith(path + '/'):
+                    prefixed.children[key] = child
+            return prefixed if prefixed.children else None
+        return node
+
+    def __render(self, node):
         """
-        Reports the aggregate status retrieved from all registered monitors
-        :return: object
+        Put together the status of the subtree, returning whether all of its monitors are healthy
         """
-        status = {'monitors': {}}
+        status = {}
         healthy = True
-        for key in self.__monitors:
-            target = status['monitors']
-            splits = key.split('.')
-            if len(splits) > 1:
-                for v in splits[:-1]:
-                    if v not in target:
-                        target[v] = {}
-                    target = target[v]
-            monitor = self.__monitors[key]
-            if healthy:
-                # See if the monitor affects aggregate
-                healthy = healthy if monitor.healthy is None else monitor.healthy
-            mon_status = monitor.report_status()
-            if monitor.healthy is not None:
-                mon_status['healthy'] = monitor.healthy
-            target[splits[-1]] = mon_status
-
-        status['healthy'] = healthy
-        return status
+        monitor = node.monitor
+        if monitor is not None:
+            # Health may be costly to determine, ask only once
+            monitor_healthy = monitor.healthy
+            status = monitor.report_status()
+            if monitor_healthy is not None:
+                status['healthy'] = monitor_healthy
+                healthy = monitor_healthy
+            self.__set_health(monitor, monitor_healthy)
+        for key, child in node.children.items():
+            status[key], child_healthy = self.__render(child)
+            healthy = healthy and child_healthy
+        return status, healthy
+
+    def report_status(self, path=''):
+        """
+        Reports the aggregate status retrieved from the registered monitors
+        :param path: Slash separated path of the part of the status tree to report on, the whole tree by default
+        :return: object, None if nothing was found under the path
+        """
+        node = self.__find(path)
+        if node is None:
+            return None
+        monitors, healthy = self.__render(node)
+        return {'monitors': monitors, 'healthy': healthy}
+
+    def report_metrics(self):
+        """
+        Reports the metrics declared by all registered monitors along with their health in the Prometheus text format
+        :return: str
+        """
+        return render(self.collect_metrics())
+
+    def collect_metrics(self):
+        """
+        Collect the metrics declared by all registered monitors along with their health
+        :return: list of (monitor name, metrics) tuples
+        """
+        monitors = []
+        # Monitors may be registered while reporting
+        for name, monitor in self.__monitors.items():
+            metrics = list(monitor.metrics)
+            healthy = monitor.healthy
+            if healthy is not None:
+                gauge = Gauge('roboblue_monitor_healthy', 'Whether the monitored system is healthy')
+                gauge.set(healthy)
+                metrics.append(gauge)
+            monitors.append((name, metrics))
+        return monitors
+
+
+class Registrations:
+    """
+    Registrations keeps track of the monitors a component registers with the monitoring context. When the component is
+    replaced on reload its replacement registers with the same context, getting hold of the monitors of the same name,
+    and the monitors no longer registered by the replacement are unregistered
+    """
+
+    def __init__(self, context):
+        # type: (MonitoringContext) -> None
+        self.context = context
+        self.names = set()
+
+    def register(self, monitor, preserve=True):
+        monitor = self.context.register(monitor, preserve)
+        self.names.add(monitor.name)
+        return monitor
+
+    def release(self, replacement=None):
+        """
+        Unregister the monitors not registered by the replacement
+        :param replacement: Registrations of the replacing component, None when the component isn't replaced
+        :return: None
+        """
+        kept = replacement.names if replacement is not None else set()
+        for name in self.names - kept:
+            self.context.unregister(name)
+        self.names = set()
 
 
 class HealthServer:
     """
     HealthServer is a Python HTTP server reporting Health information about the monitored service on the configured
-    host and port
+    host and port. Requests are served concurrently and the reports are cached for the configured time to live so that
+    frequent probes don't have to walk all the monitors every time
     """
 
-    class HTTPD(HTTPServer):
+    class HTTPD(ThreadingMixIn, HTTPServer):
         """
-        HTTPD is a custom HTTPServer implementation needed so that the monitoring context can be provided to the
-        HTTP request handler responsible for the Health endpoint
+        HTTPD is a custom threading HTTPServer implementation needed so that the monitoring context can be provided to
+        the HTTP request handler responsible for the Health endpoint
 
         """
 
-        def __init__(self, server_address, request_handler_class, bind_and_activate=True, monitorable=None):
+        daemon_threads = True
+
+        # Bound on the number of cached reports, every addressed part of the status tree is cached separately
+        __CACHE_SIZE = 256
+
+        def __init__(self, server_address, request_handler_class, bind_and_activate=True, monitorable=None,
+                     cache_ttl=0, profiling=False):
             self.monitorable = monitorable
+            self.profiling = profiling
+            self.__cache_ttl = cache_ttl
+            self.__cache_lock = threading.Lock()
+            self.__cache = {}  # report -> (monitoring context, expiry, report)
             HTTPServer.__init__(self, server_address, request_handler_class, bind_and_activate)
 
         def finish_request(self, request, client_address):
             self.RequestHandlerClass(request, client_address, self, self.monitorable.monitoring_context)
 
+        def cached(self, report, monitors, produce):
+            """
+            Produce the report unless a fresh enough copy of it is cached
+            :param report: Name of the report
+            :param monitors: The monitoring context the report is produced from
+            :param produce: Function producing the report from the monitoring context
+            :return: The report
+            """
+            if self.__cache_ttl <= 0:
+                return produce(monitors)
+            # Concurrent probes wait for the report being produced rather than producing it again
+            with self.__cache_lock:
+                now = time.time()
+                context, expiry, content = self.__cache.get(report, (None, 0, None))
+                # The context is swapped out on reload
+                if context is not monitors or now >= expiry:
+                    if len(self.__cache) >= self.__CACHE_SIZE:
+                        self.__cache = {}
+                    content = produce(monitors)
+                    self.__cache[report] = (monitors, now + self.__cache_ttl, content)
+                return content
+
     class HealthEndpoint(BaseHTTPRequestHandler):
         """
         HealthEndpoint is a custom HTTP request handler implementation responsible for reporting on the health of the
         application based on the status report provided by the Monitoring context
         """
 
+        # Keep-alive connections for probes polling frequently
+        protocol_version = 'HTTP/1.1'
+
+        # Seconds after which an idle connection is closed
+        timeout = 30
+
         def __init__(self, request, client_address, server, monitors):
             self.monitors = monitors
             self.log_message = logger.debug
             self.log_error = logger.error
             BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
+        @staticmethod
+        def __status_report(monitors, path=''):
+            status = monitors.report_status(path)
+            if status is None:
+                return 404, 'application/json', codec.dumps({'error': 'no monitors under {}'.format(path)})
+            return 200 if status.get('healthy') else 503, 'application/json', codec.dumps(status)  # indicate health
+
+        @staticmethod
+        def __metrics_report(monitors):
+            return 200, 'text/plain; version=0.0.4', monitors.report_metrics()
+
+        def __respond(self, code, content_type, content, headers=()):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        @staticmethod
+        def __healthy_report(monitors):
+            healthy = monitors.healthy
+            return 200 if healthy else 503, 'application/json', codec.dumps({'healthy': healthy})
+
+        def __start_profiling(self):
+            profiler = getattr(self.server.monitorable, 'profiler', None)
+            if profiler is None:
+                self.__respond(404, 'application/json', codec.dumps({'error': 'profiling not available'}))
+                return
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            try:
+                seconds = float(query.get('seconds', [30])[0])
+            except ValueError:
+                self.__respond(400, 'application/json', codec.dumps({'error': 'seconds must be a number'}))
+                return
+            output = profiler.start(seconds)
+            if output is None:
+                self.__respond(409, 'application/json', codec.dumps({'error': 'profiling in progress'}))
+                return
+            self.__respond(202, 'application/json', codec.dumps({'output': output}))
+
+        def do_POST(self):
+            # The body is of no use, read for the connection to be kept alive
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > 0:
+                self.rfile.read(length)
+            path = urllib.unquote(self.path.split('?')[0])
+            if path == '/profile' and self.server.profiling:
+                self.__start_profiling()
+                return
+            self.__respond(404, 'application/json', codec.dumps({'error': 'not found'}))
+
         def do_GET(self):
+            path = urllib.unquote(self.path.split('?')[0])
+            if path == '/profile' and self.server.profiling:
+                self.__respond(405, 'application/json', codec.dumps({'error': 'profiling is started with POST'}),
+                               [('Allow', 'POST')])
+                return
+            if path == '/metrics':
+                report, produce = 'metrics', self.__metrics_report
+            elif path == '/healthy':
+                # Cheap enough not to be cached
+                self.__respond(*self.__healthy_report(self.monitors))
+                return
+            elif path.startswith('/health/'):
+                subtree = path[len('/health/'):]
+                report, produce = 'status/' + subtree, lambda monitors: self.__status_report(monitors, subtree)
+            else:
+                report, produce = 'status', self.__status_report
             try:
-                status = self.monitors.report_status()
-                healthy = status.get('healthy')
-                content = json.dumps(status)
-                self.send_response(200 if healthy else 503)  # indicate unhealthy state
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(content)
+                code, content_type, content = self.server.cached(report, self.monitors, produce)
             except BaseException as e:
-                self.send_response(500)
-                logger.error('failed to provide health information: %s', e.message)
-                self.wfile.write('Something went wrong')
+                logger.error('failed to provide %s: %s', report, e.message)
+                self.__respond(500, 'text/plain', 'Something went wrong')
+                return
+            self.__respond(code, content_type, content)
 
     def __init__(self, config, monitorable):
         if not hasattr(monitorable, 'monitoring_context') or \
                 not isinstance(monitorable.monitoring_context, MonitoringContext):
             raise ValueError('invalid monitoring_context attribute for monitorable')
-        self.__httpd = HealthServer.HTTPD(config.httpd_address, HealthServer.HealthEndpoint, True, monitorable)
+        self.__httpd = HealthServer.HTTPD(config.httpd_address, HealthServer.HealthEndpoint, True, monitorable,
+                                          config.cache_ttl, config.profiling)
 
     def serve(self):
         logger.debug("starting httpd to serve health information")
         httpd_thread = threading.Thread(name="HealthServer", target=lambda: self.__httpd.serve_forever())
         httpd_thread.daemon = True
         httpd_thread.start()
+
+    def close(self):
+        """
+        Close the listening socket without waiting for the serving thread, which a forked process doesn't have
+        """
+        self.__httpd.server_close()
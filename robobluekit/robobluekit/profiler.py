@@ -0,0 +1,115 @@
+"""
+Sampling profiler for finding out where a running service spends its time without restarting it under a profiler.
+
+The stacks of all threads are sampled at a fixed interval from a thread of the profiler's own and written in the
+collapsed stack format, one line per distinct stack with the number of times it was sampled. The output is readable
+as is and turns into a flame graph with flamegraph.pl or speedscope.
+"""
+import logging
+import os
+import os.path as path
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    SamplingProfiler samples the stacks of the threads of the process for a given number of seconds, one profiling
+    session running at a time
+    """
+
+    # Bound on the duration of a profiling session
+    MAX_SECONDS = 600
+
+    def __init__(self, directory=None, interval=0.005):
+        """
+        :param directory: Directory the collapsed stacks are written to, the temporary directory by default
+        :param interval: Seconds between samples
+        """
+        self.directory = directory if directory is not None else tempfile.gettempdir()
+        self.interval = interval
+        self.__lock = threading.Lock()
+        self.__output = None
+
+    @property
+    def running(self):
+        return self.__output is not None
+
+    def start(self, seconds):
+        """
+        Start sampling in the background
+        :param seconds: Duration of the profiling session, capped at MAX_SECONDS
+        :return: Path of the file the collapsed stacks will be written to, None when a session is already running
+        """
+        seconds = max(min(float(seconds), self.MAX_SECONDS), self.interval)
+        with self.__lock:
+            if self.__output is not None:
+                return None
+            output = self.__output = path.join(self.directory, 'profile-{}-{}.collapsed'.format(
+                os.getpid(), time.strftime('%Y%m%dT%H%M%S')
+            ))
+        thread = threading.Thread(name='SamplingProfiler', target=self.__run, args=(seconds, output))
+        thread.daemon = True
+        thread.start()
+        logger.info('profiling for %.1f seconds into %s', seconds, output)
+        return output
+
+    def __run(self, seconds, output):
+        try:
+            stacks, samples = self.sample(seconds)
+            self.write(stacks, output)
+            logger.info('profiling done, %d samples of %d distinct stacks written to %s', samples, len(stacks), output)
+        except BaseException as e:
+            logger.error('profiling failed: %s', e)
+        finally:
+            with self.__lock:
+                self.__output = None
+
+    def sample(self, seconds):
+        """
+        Sample the stacks of all threads but the calling one
+        :param seconds: Duration of the sampling
+        :return: (dict of collapsed stack -> sample count, number of samples) tuple
+        """
+        me = threading.current_thread().ident
+        stacks = {}
+        labels = {}  # code object -> frame label, labels are only formatted once per function
+        samples = 0
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = self.label(code)
+                    frames.append(label)
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)).replace(';', ':'))
+                stack = ';'.join(reversed(frames))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+    @staticmethod
+    def label(code):
+        # Semicolons separate the frames of a collapsed stack
+        return '{} ({}:{})'.format(code.co_name, path.basename(code.co_filename), code.co_firstlineno).replace(';', ':')
+
+    @staticmethod
+    def write(stacks, output):
+        # Written aside and renamed for the file to be complete whenever it exists
+        partial = output + '.partial'
+        with open(partial, 'w') as f:
+            for stack in sorted(stacks):
+                f.write('{} {}\n'.format(stack, stacks[stack]))
+        os.rename(partial, output)
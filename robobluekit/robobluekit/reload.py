@@ -0,0 +1,62 @@
+"""
+Configuration diffing for reloads to rebuild only what a change of configuration affects.
+
+A snapshot of a configuration file is taken whenever it is loaded. On reload the file is read again and compared to the
+snapshot section by section, the application rebuilding the components configured by the changed sections and keeping
+the others, the DXL connection among them, running.
+"""
+import os
+import os.path as path
+
+from configobj import ConfigObj, ConfigObjError
+
+# Section name given to the keywords outside of any section and to the whole file when it can't be parsed
+TOP_LEVEL = None
+
+
+class ConfigSnapshot:
+    """
+    Snapshot of the content of a configuration file. Values naming existing files, such as certificates, are
+    snapshotted by the modification time and size of the file too, for replaced files to count as a change
+    """
+
+    def __init__(self, config_file):
+        self.path = config_file
+        self.sections = {}
+        try:
+            parsed = ConfigObj(config_file, list_values=False, interpolation=False)
+        except ConfigObjError:
+            with open(config_file, 'r') as f:
+                self.sections[TOP_LEVEL] = f.read()
+            return
+        directory = path.dirname(path.abspath(config_file))
+        for key in parsed.scalars:
+            self.sections.setdefault(TOP_LEVEL, {})[key] = self.__stat(directory, parsed[key])
+        for key in parsed.sections:
+            self.sections[key] = self.__section(directory, parsed[key])
+
+    def __section(self, directory, section):
+        content = dict((key, self.__stat(directory, section[key])) for key in section.scalars)
+        for key in section.sections:
+            content[key] = self.__section(directory, section[key])
+        return content
+
+    @staticmethod
+    def __stat(directory, value):
+        candidate = value if path.isabs(value) else path.join(directory, value)
+        if value and path.isfile(candidate):
+            stat = os.stat(candidate)
+            return value, stat.st_mtime, stat.st_size
+        return value
+
+    def changes(self, previous):
+        """
+        Compare the snapshot to a previous snapshot of the file
+        :param previous: ConfigSnapshot, None when there is no previous snapshot
+        :return: set of the names of the sections added, removed or changed. TOP_LEVEL stands for the keywords outside
+        of any section
+        """
+        if previous is None:
+            return set(self.sections)
+        names = set(self.sections) | set(previous.sections)
+        return set(name for name in names if self.sections.get(name) != previous.sections.get(name))
@@ -0,0 +1,399 @@
+"""
+Pre-fork multi-process mode of the Application.
+
+The supervisor forks the configured number of workers, every worker initializing the application on its own, DXL client
+included, so that the service is registered once per worker and the broker balances the requests across them. Workers
+that die are restarted. The supervisor runs the one health server, asking the workers for their health, status and
+metrics over a socket pair per worker.
+"""
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from . import codec
+from .kit import format_timestamp
+from .monitor import Monitor
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerChannel:
+    """
+    Worker end of the socket pair, answering the requests of the supervisor on a thread of its own. Requests and
+    responses are JSON objects, one per line
+    """
+
+    def __init__(self, sock, application):
+        self.__sock = sock
+        self.__application = application
+
+    def start(self):
+        thread = threading.Thread(name='WorkerChannel', target=self.__serve)
+        thread.daemon = True
+        thread.start()
+
+    def __answer(self, request):
+        context = self.__application.monitoring_context
+        report = request.get('report')
+        if report == 'healthy':
+            return context.healthy
+        if report == 'status':
+            return context.report_status()
+        if report == 'metrics':
+            return [
+                [monitor, [[m.name, m.kind, m.help, m.samples()] for m in metrics]]
+                for monitor, metrics in context.collect_metrics()
+            ]
+        if report == 'profile':
+            profiler = self.__application.profiler
+            return profiler.start(request.get('seconds', 30)) if profiler is not None else None
+        raise ValueError('unknown report {}'.format(report))
+
+    def __serve(self):
+        stream = self.__sock.makefile('r')
+        for line in iter(stream.readline, ''):
+            request = codec.loads(line)
+            response = {'id': request.get('id')}
+            try:
+                response['result'] = self.__answer(request)
+            except Exception as e:
+                logger.exception('failed to answer the supervisor')
+                response['error'] = str(e)
+            self.__sock.sendall(codec.dumps(response) + '\n')
+        # The supervisor is gone, there's no one left to restart or stop the worker
+        logger.error('lost the supervisor, shutting down')
+        os.kill(os.getpid(), signal.SIGINT)
+
+
+class Worker:
+    """
+    Supervisor side handle of a worker process
+    """
+
+    # Seconds to wait for a worker to answer
+    TIMEOUT = 5
+
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.started = None
+        self.restarts = 0
+        self.exits = 0
+        self.restart_at = 0
+        self.__sock = None
+        self.__stream = None
+        self.__lock = threading.Lock()
+        self.__next_id = 0
+
+    @property
+    def alive(self):
+        return self.pid is not None
+
+    def attach(self, pid, sock):
+        with self.__lock:
+            if self.started is not None:
+                self.restarts += 1
+            self.pid = pid
+            self.started = time.time()
+            sock.settimeout(self.TIMEOUT)
+            self.__sock = sock
+            self.__stream = sock.makefile('r')
+
+    def detach(self):
+        with self.__lock:
+            self.pid = None
+            if self.__sock is not None:
+                self.__sock.close()
+            self.__sock = None
+            self.__stream = None
+
+    def abandon(self):
+        """
+        Drop the handle in a forked worker. A thread of the supervisor may have held the lock at the time of forking,
+        never to release it in the worker, the lock is replaced rather than taken
+        """
+        self.__lock = threading.Lock()
+        self.pid = None
+        if self.__sock is not None:
+            self.__sock.close()
+        self.__sock = None
+        self.__stream = None
+
+    def request(self, report, **arguments):
+        """
+        Ask the worker for a report
+        :param report: One of healthy, status, metrics and profile
+        :return: The report
+        :raise IOError: When the worker can't be reached or fails to answer in time
+        """
+        with self.__lock:
+            if self.__sock is None:
+                raise IOError('worker {} is not running'.format(self.index))
+            self.__next_id += 1
+            request = dict(arguments, report=report, id=self.__next_id)
+            try:
+                self.__sock.sendall(codec.dumps(request) + '\n')
+                while True:
+                    line = self.__stream.readline()
+                    if not line:
+                        raise IOError('worker {} closed the channel'.format(self.index))
+                    response = codec.loads(line)
+                    # Late answers to requests that timed out are skipped
+                    if response.get('id') == self.__next_id:
+                        break
+            except socket.timeout:
+                raise IOError('worker {} failed to answer in time'.format(self.index))
+            except socket.error as e:
+                raise IOError('worker {} unreachable: {}'.format(self.index, e))
+        if 'error' in response:
+            raise IOError('worker {} failed to report: {}'.format(self.index, response['error']))
+        return response['result']
+
+
+class RemoteMetric:
+    """
+    Metric reported by a worker, keeping the name of the worker monitor it comes from and telling the workers apart by
+    the worker label
+    """
+
+    def __init__(self, monitor, worker, name, kind, help, samples):
+        self.monitor = monitor
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.__samples = [
+            (suffix, (('worker', str(worker)),) + tuple(tuple(label) for label in labels), value)
+            for suffix, labels, value in samples
+        ]
+
+    def samples(self):
+        return self.__samples
+
+
+class WorkerMonitor(Monitor):
+    """
+    Worker monitor stands in for a worker in the monitoring context of the supervisor. The health is polled by the
+    supervisor, the status and metrics are requested from the worker when reported
+    """
+
+    def __init__(self, name, worker):
+        # type: (str, Worker) -> None
+        self.worker = worker
+        self.__healthy = None
+        Monitor.__init__(self, name)
+
+    def refresh(self):
+        """
+        Poll the health of the worker, notifying the listeners when it changes
+        :return: None
+        """
+        try:
+            healthy = self.worker.request('healthy') is True
+        except IOError as e:
+            logger.warn('%s', e)
+            healthy = False
+        changed = healthy != self.__healthy
+        self.__healthy = healthy
+        if changed:
+            self.notify_health()
+
+    @property
+    def healthy(self):
+        return self.__healthy if self.worker.alive else False
+
+    @property
+    def metrics(self):
+        try:
+            monitors = self.worker.request('metrics')
+        except IOError as e:
+            logger.warn('%s', e)
+            return []
+        return [
+            RemoteMetric(monitor, self.worker.index, name, kind, help, samples)
+            for monitor, metrics in monitors
+            for name, kind, help, samples in metrics
+        ]
+
+    def report_status(self):
+        worker = self.worker
+        status = {
+            'pid': worker.pid,
+            'started': format_timestamp(worker.started),
+            'restarts': worker.restarts,
+            'monitors': None
+        }
+        try:
+            status['monitors'] = worker.request('status')['monitors']
+        except IOError as e:
+            status['error'] = str(e)
+        return status
+
+
+class WorkerProfiler:
+    """
+    Stands in for the profiler of the supervisor, profiling every worker instead
+    """
+
+    def __init__(self, workers):
+        self.__workers = workers
+
+    def start(self, seconds):
+        outputs = []
+        for worker in self.__workers:
+            try:
+                output = worker.request('profile', seconds=seconds)
+            except IOError as e:
+                logger.warn('%s', e)
+                continue
+            if output is not None:
+                outputs.append(output)
+        return outputs or None
+
+
+def reinitialize_logging_locks():
+    """
+    Locks held by other threads of the parent at the time of forking are never released in the child, give the
+    logging module fresh ones
+    """
+    logging._lock = threading.RLock()
+    for reference in logging._handlerList:
+        handler = reference()
+        if handler is not None:
+            handler.createLock()
+
+
+class Supervisor:
+    """
+    Supervisor forks and restarts the workers. A worker exiting soon after being started is restarted with an
+    exponentially growing delay so that a worker failing to initialize doesn't spin
+    """
+
+    # Seconds between checks of the workers
+    INTERVAL = 1
+
+    # Seconds a worker has to run for its exit not to delay the restart
+    MIN_UPTIME = 10
+
+    # Bounds of the restart delay in seconds
+    MIN_DELAY = 1
+    MAX_DELAY = 60
+
+    # Seconds the workers are given to shut down before being killed
+    SHUTDOWN_TIMEOUT = 30
+
+    def __init__(self, count, serve, monitoring_context, shutdown_timeout=None):
+        """
+        :param count: Number of workers
+        :param serve: Function run by the forked workers given the worker end of the channel, returning the exit code.
+        Workers restarted once the supervisor serves its health are forked off a parent running threads, the function
+        closes what it inherits of them
+        :param monitoring_context: Monitoring context of the supervisor the worker monitors are registered with
+        :param shutdown_timeout: Seconds the workers are given to shut down, SHUTDOWN_TIMEOUT when omitted
+        """
+        self.workers = [Worker(i) for i in range(count)]
+        self.__shutdown_timeout = shutdown_timeout if shutdown_timeout is not None else self.SHUTDOWN_TIMEOUT
+        self.__serve = serve
+        self.__monitors = [monitoring_context.register(WorkerMonitor('workers.{}'.format(w.index), w))
+                           for w in self.workers]
+        self.__keep_running = True
+        self.__delays = dict((w.index, self.MIN_DELAY) for w in self.workers)
+
+    def __spawn(self, worker):
+        # Wrapped for the file objects of the sockets to honour the timeout
+        parent, child = [socket.socket(_sock=sock) for sock in socket.socketpair()]
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                parent.close()
+                for other in self.workers:
+                    other.abandon()
+                reinitialize_logging_locks()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                code = self.__serve(child)
+            except BaseException:
+                logger.exception('worker %d failed', worker.index)
+            finally:
+                logging.shutdown()
+                os._exit(code or 0)
+        child.close()
+        worker.attach(pid, parent)
+        logger.info('started worker %d with pid %d', worker.index, pid)
+
+    def start(self):
+        for worker in self.workers:
+            self.__spawn(worker)
+
+    def stop(self, sig, frame):
+        self.__keep_running = False
+
+    def forward(self, sig):
+        for worker in self.workers:
+            if worker.alive:
+                try:
+                    os.kill(worker.pid, sig)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+
+    def __reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            for worker in self.workers:
+                if worker.pid == pid:
+                    worker.detach()
+                    worker.exits += 1
+                    if self.__keep_running:
+                        self.__schedule_restart(worker, status)
+
+    def __schedule_restart(self, worker, status):
+        now = time.time()
+        if now - worker.started < self.MIN_UPTIME:
+            delay = self.__delays[worker.index]
+            self.__delays[worker.index] = min(delay * 2, self.MAX_DELAY)
+        else:
+            delay = self.__delays[worker.index] = self.MIN_DELAY
+        worker.restart_at = now + delay
+        logger.error('worker %d exited with status %d, restarting in %d seconds', worker.index, status, delay)
+
+    def run(self):
+        """
+        Supervise the workers until stopped, then shut them down
+        :return: None
+        """
+        while self.__keep_running:
+            time.sleep(self.INTERVAL)
+            self.__reap()
+            now = time.time()
+            for worker in self.workers:
+                if not worker.alive and self.__keep_running and now >= worker.restart_at:
+                    self.__spawn(worker)
+            for monitor in self.__monitors:
+                if monitor.worker.alive:
+                    monitor.refresh()
+        self.__shutdown()
+
+    def __shutdown(self):
+        logger.info('shutting down the workers')
+        self.forward(signal.SIGINT)
+        deadline = time.time() + self.__shutdown_timeout
+        while any(w.alive for w in self.workers) and time.time() < deadline:
+            time.sleep(0.1)
+            self.__reap()
+        for worker in self.workers:
+            if worker.alive:
+                logger.error('worker %d failed to shut down in time, killing it', worker.index)
+                os.kill(worker.pid, signal.SIGKILL)
+                os.waitpid(worker.pid, 0)
+                worker.detach()
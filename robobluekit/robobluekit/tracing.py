@@ -0,0 +1,197 @@
+"""
+Lightweight tracing of the phases of processing a request.
+
+A trace is started for every request and the phases of processing it are timed with spans. The phase timings of every
+trace are recorded by the endpoint monitor the trace was started from. A sample of the traces is additionally kept in a
+ring buffer reported on by the TracingMonitor and, when configured, appended to a file as JSON lines.
+
+The trace being processed by a thread is kept thread local, code called by the dispatcher adds spans with the module
+level span function without the trace being passed along.
+"""
+from collections import deque
+import logging
+import random
+import threading
+import time
+
+from . import codec
+from .metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+
+
+class Span:
+    """
+    Context manager timing a phase of the trace
+    """
+
+    def __init__(self, trace, phase):
+        self.__trace = trace
+        self.__phase = phase
+        self.__started = None
+
+    def __enter__(self):
+        self.__started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__trace.record(self.__phase, self.__started, time.time() - self.__started)
+        return False
+
+
+class Trace:
+    """
+    Trace collects the spans of processing a single request
+    """
+
+    def __init__(self, name, tracer=None, sampled=False, listener=None):
+        """
+        :param name: Name of the traced endpoint
+        :param tracer: Tracer keeping the trace when it is sampled
+        :param sampled: Whether the trace is kept once finished
+        :param listener: Function called with the finished trace
+        """
+        self.name = name
+        self.sampled = sampled
+        self.started = time.time()
+        self.duration = None
+        self.error = False
+        self.spans = []  # (phase, start offset, duration) tuples
+        self.__tracer = tracer
+        self.__listener = listener
+        _current.trace = self
+
+    def span(self, phase):
+        return Span(self, phase)
+
+    def record(self, phase, started, duration):
+        self.spans.append((phase, started - self.started, duration))
+
+    def finish(self, error=False):
+        """
+        Finish the trace, handing it to the listener and the tracer
+        :param error: Whether processing the request failed
+        :return: None
+        """
+        self.duration = time.time() - self.started
+        self.error = error
+        if getattr(_current, 'trace', None) is self:
+            _current.trace = None
+        if self.__listener is not None:
+            self.__listener(self)
+        if self.sampled and self.__tracer is not None:
+            self.__tracer.keep(self)
+
+    def export(self):
+        """
+        JSON serializable form of the trace, times being UNIX timestamps and durations in seconds
+        """
+        return {
+            'name': self.name,
+            'started': self.started,
+            'duration': self.duration,
+            'error': self.error,
+            'spans': [
+                {'phase': phase, 'offset': offset, 'duration': duration} for phase, offset, duration in self.spans
+            ]
+        }
+
+
+class NullSpan:
+    """
+    Span of code running outside of a trace
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def current():
+    """
+    The trace being processed by the calling thread
+    :return: Trace, None outside of a trace
+    """
+    return getattr(_current, 'trace', None)
+
+
+def span(phase):
+    """
+    Time a phase of the trace being processed by the calling thread, does nothing outside of a trace
+    :param phase: Name of the phase
+    :return: Context manager
+    """
+    trace = getattr(_current, 'trace', None)
+    return NULL_SPAN if trace is None else Span(trace, phase)
+
+
+class Tracer:
+    """
+    Tracer samples the traces to keep, keeping the latest ones in a ring buffer and appending them to the output file
+    if there is one
+    """
+
+    def __init__(self, sample_rate=0.01, capacity=100, output=None):
+        """
+        :param sample_rate: Ratio of the traces kept
+        :param capacity: Number of the latest sampled traces kept in memory
+        :param output: Path of the file the sampled traces are appended to as JSON lines
+        """
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.output = output
+        self.__lock = threading.Lock()
+        self.__traces = deque(maxlen=capacity)
+        self.__file = None
+        self.requests = Counter('roboblue_traces_total', 'Requests traced')
+        self.sampled = 0
+        self.exported = 0
+
+    @staticmethod
+    def from_config(config):
+        return Tracer(config.sample_rate, config.capacity, config.output)
+
+    def start(self, name, listener=None):
+        """
+        Start tracing a request on the calling thread
+        :param name: Name of the traced endpoint
+        :param listener: Function called with the finished trace
+        :return: Trace
+        """
+        self.requests.inc()
+        return Trace(name, self, random.random() < self.sample_rate, listener)
+
+    def keep(self, trace):
+        line = codec.dumps(trace.export()) + '\n' if self.output is not None else None
+        with self.__lock:
+            self.sampled += 1
+            self.__traces.append(trace)
+            if line is None:
+                return
+            try:
+                if self.__file is None:
+                    self.__file = open(self.output, 'a')
+                self.__file.write(line)
+                self.__file.flush()
+                self.exported += 1
+            except (IOError, OSError) as e:
+                logger.error('failed to export trace to %s: %s', self.output, e)
+                self.__file = None
+
+    @property
+    def traces(self):
+        with self.__lock:
+            return list(self.__traces)
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
@@ -28,7 +28,10 @@ REQUIRED = [
 ]
 
 # What packages are optional?
-EXTRAS = {}
+EXTRAS = {
+    'ujson': ['ujson<2.0.0'],
+    'asyncio': ['trollius>=2.1']
+}
 
 CLASSIFIERS = [
     # Trove classifiers